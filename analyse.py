@@ -0,0 +1,165 @@
+import argparse
+import collections
+import json
+import multiprocessing
+import queue
+import sys
+import time
+
+import chess
+
+from engine import Engine, MAX_DEPTH_KEY, MAX_NODES_KEY, MAX_PLY, MULTI_PV_KEY, VERBOSE_KEY
+
+# Batch analysis of a stream of FEN/EPD positions over a pool of worker processes
+#
+# Each worker holds one long-lived Engine and reuses its search tables from position to position.
+# At most IN_FLIGHT_PER_WORKER positions per worker are outstanding at any time, so memory is
+#   bounded regardless of the size of the input.
+# Results are written as JSONL, either in input order or as they complete.
+# Without -d the search depth is DEFAULT_DEPTH, unless a time (-t) or node (-n) limit is given -
+#   then the search deepens until that limit stops it.
+
+IN_FLIGHT_PER_WORKER = 8
+
+DEFAULT_DEPTH = 4
+
+# The TT maps fen4 -> move for every non-all node ever searched - drop it when it gets this big
+DEFAULT_MAX_TT_ENTRIES = 1000000
+
+# Per-process engine, created by init_worker()
+worker_engine = None
+worker_time_limit_s = 0
+worker_max_tt_entries = DEFAULT_MAX_TT_ENTRIES
+
+def init_worker(config, time_limit_s, max_tt_entries):
+    global worker_engine, worker_time_limit_s, worker_max_tt_entries
+    worker_engine = Engine(chess.Board(), config)
+    worker_time_limit_s = time_limit_s
+    worker_max_tt_entries = max_tt_entries
+
+# Parse a line as a FEN, falling back to EPD (with opcodes); returns (board, epd ops)
+def parse_position(line):
+    try:
+        return chess.Board(line), {}
+    except ValueError:
+        return chess.Board.from_epd(line)
+
+def analyse_position(engine, board, time_limit_s):
+    engine.set_board(board)
+    start_s = time.time()
+    # time limit is hard (abort mid-iteration) for batch analysis; the first iteration always completes
+    engine_move, val, pv, stats = engine.iterative_deepening(0, time_limit_s)
+    elapsed_s = time.time() - start_s
+    result = {
+        "best_move": engine_move.uci(),
+        "best_move_san": board.san(engine_move),
+    }
+    result.update(engine.iteration_info(engine.id_depth, elapsed_s))
+    return result
+
+def analyse_line(index, line):
+    result = {"index": index, "position": line}
+    try:
+        board, ops = parse_position(line)
+        if "id" in ops:
+            result["id"] = ops["id"]
+        if board.is_game_over():
+            result["error"] = "game over: %s" % board.result()
+            return result
+        result.update(analyse_position(worker_engine, board, worker_time_limit_s))
+    except ValueError as e:
+        result["error"] = str(e)
+
+    limit_tables(worker_engine, worker_max_tt_entries)
+    return result
+
+# The quiescence TT is bounded by the engine's qtt-size-mb
+def limit_tables(engine, max_tt_entries):
+    if len(engine.tt) > max_tt_entries:
+        engine.tt.clear()
+
+def read_positions(input_file):
+    for line in input_file:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            yield line
+
+# Yields func(*args) for each args in args_iter, in input order, with at most max_in_flight outstanding tasks
+def imap_in_order(pool, func, args_iter, max_in_flight):
+    pending = collections.deque()
+    for args in args_iter:
+        pending.append(pool.apply_async(func, args))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+# Yields func(*args) for each args in args_iter, as they are completed by the workers
+def imap_as_completed(pool, func, args_iter, max_in_flight):
+    done = queue.Queue()
+    n_in_flight = 0
+    for args in args_iter:
+        pool.apply_async(func, args, callback=done.put, error_callback=done.put)
+        n_in_flight += 1
+        if n_in_flight >= max_in_flight:
+            yield checked_result(done.get())
+            n_in_flight -= 1
+    while n_in_flight > 0:
+        yield checked_result(done.get())
+        n_in_flight -= 1
+
+def checked_result(result):
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+def analyse_stream(lines, output_file, config, n_workers, time_limit_s = 0, in_order = True, max_tt_entries = DEFAULT_MAX_TT_ENTRIES, progress_file = sys.stderr):
+    max_in_flight = n_workers * IN_FLIGHT_PER_WORKER
+    start_s = time.time()
+    n_positions = 0
+    n_nodes = 0
+    with multiprocessing.Pool(n_workers, initializer=init_worker, initargs=(config, time_limit_s, max_tt_entries)) as pool:
+        imap_bounded = imap_in_order if in_order else imap_as_completed
+        results = imap_bounded(pool, analyse_line, enumerate(lines), max_in_flight)
+        for result in results:
+            output_file.write(json.dumps(result) + "\n")
+            n_positions += 1
+            n_nodes += result.get("nodes", 0)
+            if progress_file is not None and n_positions % 1000 == 0:
+                elapsed_s = time.time() - start_s
+                print("%d positions %.1f positions/s %.0f nodes/s" % (n_positions, n_positions/elapsed_s, n_nodes/elapsed_s), file=progress_file)
+    elapsed_s = time.time() - start_s
+    if progress_file is not None:
+        print("analysed %d positions in %.3fs - %.1f positions/s %.0f nodes/s" % (n_positions, elapsed_s, n_positions/max(elapsed_s, 1e-9), n_nodes/max(elapsed_s, 1e-9)), file=progress_file)
+    return n_positions, elapsed_s
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyse a stream of FEN/EPD positions - one per line - writing JSONL results")
+    parser.add_argument("input", nargs="?", default="-", help="input file of FEN/EPD lines - '-' for stdin")
+    parser.add_argument("-o", "--output", default="-", help="output JSONL file - '-' for stdout")
+    parser.add_argument("-j", "--workers", type=int, default=multiprocessing.cpu_count(), help="number of worker processes")
+    parser.add_argument("-d", "--depth", type=int, default=None, help="maximum search depth - default %d, or unlimited with -t or -n" % DEFAULT_DEPTH)
+    parser.add_argument("-n", "--nodes", type=int, default=0, help="maximum (q)nodes per position - 0 for no limit")
+    parser.add_argument("-t", "--time", type=float, default=0, help="maximum time per position in seconds - 0 for no limit; searches to this time unless -d is given")
+    parser.add_argument("-m", "--multi-pv", type=int, default=1, help="number of best moves (with lines) to report")
+    parser.add_argument("--unordered", action="store_true", help="write results as they complete rather than in input order")
+    parser.add_argument("--max-tt-entries", type=int, default=DEFAULT_MAX_TT_ENTRIES, help="worker TT size at which the TT is cleared")
+    args = parser.parse_args()
+
+    depth = args.depth
+    if depth == None:
+        depth = MAX_PLY-1 if args.time > 0 or args.nodes > 0 else DEFAULT_DEPTH
+    config = {MAX_DEPTH_KEY: depth, MAX_NODES_KEY: args.nodes, MULTI_PV_KEY: args.multi_pv, VERBOSE_KEY: False}
+
+    input_file = sys.stdin if args.input == "-" else open(args.input)
+    output_file = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        analyse_stream(read_positions(input_file), output_file, config, args.workers, args.time, not args.unordered, args.max_tt_entries)
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+
+if __name__ == "__main__":
+    main()
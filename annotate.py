@@ -0,0 +1,219 @@
+import argparse
+import io
+import multiprocessing
+import sys
+import time
+
+import chess
+import chess.pgn
+
+import evaluate
+
+from bitbase import BITBASE_WIN_VAL, NO_WIN_DTM
+from engine import Engine, MAX_DEPTH_KEY, MAX_NODES_KEY, MAX_PLY, VERBOSE_KEY
+from analyse import IN_FLIGHT_PER_WORKER, DEFAULT_DEPTH, DEFAULT_MAX_TT_ENTRIES, imap_in_order, limit_tables
+
+# Streaming PGN annotation over a pool of worker processes - one game per task
+#
+# Each worker holds one long-lived Engine. Within a game the search tables are carried from
+#   position to position - either walking forwards with Engine.make_move(), or walking backwards
+#   from the final position, which warms the TT better since the positions searched later in the
+#   walk are the ancestors of those already searched.
+# Each move gets an [%eval] comment (White's point of view, after the move) and a NAG if it
+#   loses more than the thresholds below against the engine's best move, plus the engine line.
+# Without -d the search depth is DEFAULT_DEPTH, unless a time (-t) or node (-n) limit is given -
+#   then the search deepens until that limit stops it.
+
+DUBIOUS_LOSS_CP = 70
+MISTAKE_LOSS_CP = 150
+BLUNDER_LOSS_CP = 300
+
+# Per-process engine, created by init_worker()
+worker_engine = None
+worker_time_limit_s = 0
+worker_backward = False
+worker_max_tt_entries = DEFAULT_MAX_TT_ENTRIES
+
+def init_worker(config, time_limit_s, backward, max_tt_entries):
+    global worker_engine, worker_time_limit_s, worker_backward, worker_max_tt_entries
+    worker_engine = Engine(chess.Board(), config)
+    worker_time_limit_s = time_limit_s
+    worker_backward = backward
+    worker_max_tt_entries = max_tt_entries
+
+# Split a PGN stream into the text of each game without parsing the moves
+def read_game_texts(pgn_file):
+    lines = []
+    in_movetext = False
+    for line in pgn_file:
+        stripped = line.strip()
+        if stripped.startswith("[") and in_movetext:
+            yield "".join(lines)
+            lines = []
+            in_movetext = False
+        elif stripped and not stripped.startswith("[") and not stripped.startswith("%"):
+            in_movetext = True
+        lines.append(line)
+    if in_movetext:
+        yield "".join(lines)
+
+# Search the current engine position; returns (best move, side-to-move-relative eval, pv)
+def search_position(engine, time_limit_s):
+    board = engine.board
+    if board.is_checkmate():
+        return None, -evaluate.CHECKMATE_VAL, []
+    if board.is_stalemate() or board.is_insufficient_material():
+        return None, evaluate.DRAW_VAL, []
+    engine_move, val, pv, stats = engine.iterative_deepening(0, time_limit_s)
+    return engine_move, val, pv
+
+# Returns a list with the search result for each position along the mainline, including the final position
+def search_game(engine, game, time_limit_s, backward):
+    board = game.board()
+    moves = list(game.mainline_moves())
+    results = [None] * (len(moves) + 1)
+
+    if backward:
+        for move in moves:
+            board.push(move)
+        for ply in range(len(moves), -1, -1):
+            engine.set_board(board)
+            results[ply] = search_position(engine, time_limit_s)
+            if ply > 0:
+                board.pop()
+    else:
+        engine.set_board(board)
+        for ply in range(len(moves) + 1):
+            results[ply] = search_position(engine, time_limit_s)
+            if ply < len(moves):
+                engine.make_move(moves[ply])
+
+    return results
+
+# Plies to mate of a side-to-move-relative val of board with its pv, or None if the PV doesn't
+#   show the mate
+# The search doesn't adjust mate scores by distance - a mate scores +/-CHECKMATE_VAL and a bitbase
+#   win BITBASE_WIN_VAL - dtm. The PV stops at the quiescence root, so a mate found in quiescence
+#   has a PV that doesn't end in mate; only PVs ending in checkmate, or in a bitbase position for a
+#   bitbase win, give the distance.
+def mate_plies(val, board, pv):
+    abs_val = abs(val)
+    is_mate_val = abs_val >= evaluate.CHECKMATE_VAL
+    is_bitbase_val = BITBASE_WIN_VAL - NO_WIN_DTM < abs_val <= BITBASE_WIN_VAL
+    if not pv or not (is_mate_val or is_bitbase_val):
+        return None
+    pv_board = board.copy(stack=False)
+    for move in pv:
+        pv_board.push(move)
+    if is_mate_val and pv_board.is_checkmate():
+        return len(pv)
+    if is_bitbase_val and chess.popcount(pv_board.occupied) == 3:
+        return len(pv) + BITBASE_WIN_VAL - abs_val
+    return None
+
+# PGN eval of a White-relative val of board with its pv - pawns, or #N / #-N for White / Black
+#   mating in N moves, or #0 for checkmate
+def format_eval(white_val, board, pv):
+    if board.is_checkmate():
+        return "#0"
+    plies = mate_plies(white_val, board, pv)
+    if plies != None:
+        return "#%s%d" % ("-" if white_val < 0 else "", (plies + 1) // 2)
+    return "%+.2f" % (white_val / 100)
+
+def annotate_game(game, results):
+    node = game
+    board = game.board()
+    ply = 0
+    while node.variations:
+        child = node.variations[0]
+        best_move, best_val, best_pv = results[ply]
+        next_move, next_val, next_pv = results[ply + 1]
+
+        # eval of the played move from the mover's point of view
+        played_val = -next_val
+        loss = best_val - played_val
+        white_val = played_val * [-1, 1][board.turn]
+
+        # the position after the move - a stalemate gets no eval
+        board.push(child.move)
+        if not board.is_stalemate():
+            comment = "[%%eval %s]" % format_eval(white_val, board, next_pv)
+            if child.comment:
+                comment = child.comment + " " + comment
+            child.comment = comment
+        board.pop()
+
+        if child.move != best_move and best_move is not None:
+            nag = None
+            if loss >= BLUNDER_LOSS_CP:
+                nag = chess.pgn.NAG_BLUNDER
+            elif loss >= MISTAKE_LOSS_CP:
+                nag = chess.pgn.NAG_MISTAKE
+            elif loss >= DUBIOUS_LOSS_CP:
+                nag = chess.pgn.NAG_DUBIOUS_MOVE
+            if nag is not None:
+                child.nags.add(nag)
+                variation = node.add_line(best_pv)
+                variation.comment = "[%%eval %s]" % format_eval(best_val * [-1, 1][board.turn], board, best_pv)
+
+        board.push(child.move)
+        node = child
+        ply += 1
+
+def annotate_game_text(index, game_text):
+    game = chess.pgn.read_game(io.StringIO(game_text))
+    if game is None:
+        return index, "", 0
+    results = search_game(worker_engine, game, worker_time_limit_s, worker_backward)
+    annotate_game(game, results)
+    limit_tables(worker_engine, worker_max_tt_entries)
+    exporter = chess.pgn.StringExporter(headers=True, variations=True, comments=True)
+    return index, game.accept(exporter) + "\n\n", len(results)
+
+def annotate_stream(game_texts, output_file, config, n_workers, time_limit_s = 0, backward = False, max_tt_entries = DEFAULT_MAX_TT_ENTRIES, progress_file = sys.stderr):
+    start_s = time.time()
+    n_games = 0
+    n_positions = 0
+    with multiprocessing.Pool(n_workers, initializer=init_worker, initargs=(config, time_limit_s, backward, max_tt_entries)) as pool:
+        for index, pgn, n_game_positions in imap_in_order(pool, annotate_game_text, enumerate(game_texts), n_workers * IN_FLIGHT_PER_WORKER):
+            output_file.write(pgn)
+            n_games += 1
+            n_positions += n_game_positions
+            if progress_file is not None and n_games % 100 == 0:
+                elapsed_s = time.time() - start_s
+                print("%d games %d positions %.1f positions/s" % (n_games, n_positions, n_positions/elapsed_s), file=progress_file)
+    elapsed_s = time.time() - start_s
+    if progress_file is not None:
+        print("annotated %d games - %d positions in %.3fs - %.1f positions/s" % (n_games, n_positions, elapsed_s, n_positions/max(elapsed_s, 1e-9)), file=progress_file)
+    return n_games, elapsed_s
+
+def main():
+    parser = argparse.ArgumentParser(description="Annotate the games of a PGN file with engine evals and blunder marks")
+    parser.add_argument("input", nargs="?", default="-", help="input PGN file - '-' for stdin")
+    parser.add_argument("-o", "--output", default="-", help="output PGN file - '-' for stdout")
+    parser.add_argument("-j", "--workers", type=int, default=multiprocessing.cpu_count(), help="number of worker processes")
+    parser.add_argument("-d", "--depth", type=int, default=None, help="maximum search depth - default %d, or unlimited with -t or -n" % DEFAULT_DEPTH)
+    parser.add_argument("-n", "--nodes", type=int, default=0, help="maximum (q)nodes per position - 0 for no limit")
+    parser.add_argument("-t", "--time", type=float, default=0, help="maximum time per position in seconds - 0 for no limit")
+    parser.add_argument("--backward", action="store_true", help="analyse each game from the final position backwards")
+    parser.add_argument("--max-tt-entries", type=int, default=DEFAULT_MAX_TT_ENTRIES, help="worker TT size at which the TT is cleared")
+    args = parser.parse_args()
+
+    depth = args.depth
+    if depth == None:
+        depth = MAX_PLY-1 if args.time > 0 or args.nodes > 0 else DEFAULT_DEPTH
+    config = {MAX_DEPTH_KEY: depth, MAX_NODES_KEY: args.nodes, VERBOSE_KEY: False}
+
+    input_file = sys.stdin if args.input == "-" else open(args.input)
+    output_file = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        annotate_stream(read_game_texts(input_file), output_file, config, args.workers, args.time, args.backward, args.max_tt_entries)
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+
+if __name__ == "__main__":
+    main()
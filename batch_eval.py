@@ -0,0 +1,91 @@
+import numpy as np
+
+import chess
+
+import evaluate
+
+# Vectorized version of evaluate.static_eval() over a batch of positions
+#
+# Positions are represented either as an (N, 12, 64) occupancy array or as (N, 12) packed
+#   bitboards, with plane index (color * 6 + piece_type - 1), so black planes come first as
+#   in evaluate.PIECE_VALS/PIECE_POS_VALS.
+# Values are White-relative like static_eval() unless a side-to-move array is given.
+
+N_PLANES = 12
+N_FEATURES = N_PLANES * 64
+
+PIECE_TYPES = [chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN, chess.KING]
+
+# Bitboards are unpacked and evaluated in chunks of this many positions to bound temporary memory
+CHUNK_SIZE = 1 << 15
+
+def plane_index(color, piece_type):
+    return int(color) * 6 + piece_type - 1
+
+# (12, 64) material + piece-pos value of each piece on each square
+def make_weights(piece_vals = evaluate.PIECE_VALS, piece_pos_vals = evaluate.PIECE_POS_VALS):
+    weights = np.zeros((N_PLANES, 64), dtype=np.int64)
+    for color in [chess.BLACK, chess.WHITE]:
+        for piece_type in PIECE_TYPES:
+            weights[plane_index(color, piece_type)] = np.array(piece_pos_vals[color][piece_type], dtype=np.int64) + piece_vals[color][piece_type]
+    return weights
+
+WEIGHTS = make_weights()
+
+# Values are small integers so float32 BLAS matmul is exact - |sum| stays far below 2^24
+WEIGHTS_F32 = WEIGHTS.reshape(N_FEATURES).astype(np.float32)
+
+# (N, 12) uint64 bitboards from python-chess boards
+# Board masks are python ints so this can't be zero-copy, but np.fromiter fills the array in place
+#   without building intermediate lists.
+def boards_to_bitboards(boards, n_boards = -1):
+    def masks():
+        for board in boards:
+            occupied_co = board.occupied_co
+            for color in [chess.BLACK, chess.WHITE]:
+                color_mask = occupied_co[color]
+                yield board.pawns & color_mask
+                yield board.knights & color_mask
+                yield board.bishops & color_mask
+                yield board.rooks & color_mask
+                yield board.queens & color_mask
+                yield board.kings & color_mask
+    count = -1 if n_boards < 0 else n_boards * N_PLANES
+    return np.fromiter(masks(), dtype=np.uint64, count=count).reshape(-1, N_PLANES)
+
+# (N,) bool side-to-move array - True for White
+def boards_to_turns(boards, n_boards = -1):
+    return np.fromiter((board.turn for board in boards), dtype=bool, count=n_boards)
+
+# (N, 12, 64) uint8 occupancy from (N, 12) bitboards - the uint64s are viewed (not copied) as
+#   little-endian bytes and unpacked so that bit i lands on square i
+def bitboards_to_occupancy(bitboards):
+    bitboards = np.ascontiguousarray(bitboards, dtype="<u8")
+    n = bitboards.shape[0]
+    return np.unpackbits(bitboards.view(np.uint8), bitorder="little").reshape(n, N_PLANES, 64)
+
+def occupancy_to_bitboards(occupancy):
+    n = occupancy.shape[0]
+    packed = np.packbits(occupancy.reshape(n, N_PLANES, 64).astype(bool), axis=-1, bitorder="little")
+    return np.ascontiguousarray(packed).view("<u8").reshape(n, N_PLANES)
+
+def side_relative(vals, turns):
+    if turns is None:
+        return vals
+    return np.where(turns, vals, -vals)
+
+# Static eval of each position of an (N, 12, 64) occupancy array
+def batch_static_eval(occupancy, turns = None, weights = WEIGHTS_F32):
+    n = occupancy.shape[0]
+    features = occupancy.reshape(n, N_FEATURES).astype(np.float32, copy=False)
+    vals = np.rint(features @ weights).astype(np.int64)
+    return side_relative(vals, turns)
+
+# Static eval of each position of an (N, 12) bitboard array
+def batch_static_eval_bitboards(bitboards, turns = None, weights = WEIGHTS_F32):
+    n = bitboards.shape[0]
+    vals = np.empty(n, dtype=np.int64)
+    for start in range(0, n, CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, n)
+        vals[start:end] = batch_static_eval(bitboards_to_occupancy(bitboards[start:end]), None, weights)
+    return side_relative(vals, turns)
@@ -0,0 +1,311 @@
+import argparse
+import gc
+import json
+import random
+import time
+import tracemalloc
+
+import chess
+
+import evaluate
+
+from util import move_list_to_sans
+
+# Benchmarks over a fixed set of bench positions
+#
+#   python bench.py eval [-n N]     - scalar static_eval() vs NumPy batch eval over N positions
+#   python bench.py evaluator [-n N] [--weights W]
+#                                   - evals/s of the pluggable evaluators, from scratch and incrementally
+#   python bench.py search [-d D] [-c key=value ...]
+#                                   - gen_move() to depth D on each bench position: nodes, time, GC activity
+#   python bench.py mate [-m M] [-t T]
+#                                   - time to mate of the proof-number mate search vs the alpha-beta search
+#   python bench.py threads [-d D] [-j 1,2,4]
+#                                   - time to depth D of the threaded search for each thread count, and the
+#                                     speedup over 1 thread
+
+BENCH_FENS = [
+    "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+    "r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3",
+    "r1bqk2r/ppp2ppp/2nbpn2/3p4/3P4/2N1PN2/PPP1BPPP/R1BQK2R w KQkq - 2 6",
+    "r1bq1rk1/pp2bppp/2n1pn2/2pp4/3P4/2PBPN2/PP1N1PPP/R1BQ1RK1 w - - 0 8",
+    "r2q1rk1/1b2bppp/p2ppn2/1p6/3NP3/1BN1B3/PPP2PPP/R2Q1RK1 w - - 0 12",
+    "2r1r1k1/2bn4/R1p1p3/2P2p1p/1P3P2/3B2PP/8/2BR2K1 w - - 1 32",
+    "8/5pk1/6p1/3P4/2p5/6P1/5PK1/8 w - - 0 40",
+    "6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 30",
+]
+
+# Forced mates - mate in 1, 2, 2, 3, 4, 4, 7
+MATE_FENS = [
+    "6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 30",
+    # Morphy's Opera Game
+    "4kb1r/p2n1ppp/4q3/4p1B1/4P3/1Q6/PPP2PPP/2KR4 w k - 1 16",
+    # Legal's mate
+    "r2qkbnr/ppp2ppp/2np4/4N3/2B1P3/2N5/PPPP1PPP/R1BbK2R w KQkq - 0 6",
+    "r1b1kb1r/pppp1ppp/5q2/4n3/3KP3/2N3PN/PPP4P/R1BQ1B1R b kq - 0 1",
+    # Philidor's smothered mate
+    "r6k/6pp/8/6N1/8/1Q6/1q4PP/6K1 w - - 0 1",
+    "1r2k1r1/pbppnp1p/1b3P2/8/Q7/B1PB1q2/P4PPP/3RR1K1 w - - 0 21",
+    # Ed. Lasker - Thomas 1912
+    "rn3rk1/pbppq1pp/1p2pb2/4N2Q/3PN3/3B4/PPP2PPP/R3K2R w KQ - 7 11",
+]
+
+def bench_boards():
+    return [chess.Board(fen) for fen in BENCH_FENS]
+
+# n_positions positions from seeded random playouts from the bench positions
+def random_positions(n_positions, seed = 1, max_plies = 40):
+    rng = random.Random(seed)
+    boards = []
+    while len(boards) < n_positions:
+        board = chess.Board(rng.choice(BENCH_FENS))
+        for ply in range(rng.randrange(max_plies)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+        boards.append(board)
+    return boards
+
+def report(name, n, elapsed_s, unit = "positions"):
+    print("%-32s %9d %s in %8.3fs - %12.0f %s/s" % (name, n, unit, elapsed_s, n/max(elapsed_s, 1e-9), unit))
+
+def bench_eval(args):
+    import batch_eval
+
+    boards = random_positions(args.n_positions)
+    n = len(boards)
+
+    start_s = time.time()
+    scalar_vals = [evaluate.static_eval(board) * [-1, 1][board.turn] for board in boards]
+    report("scalar static_eval", n, time.time() - start_s)
+
+    start_s = time.time()
+    bitboards = batch_eval.boards_to_bitboards(boards, n)
+    turns = batch_eval.boards_to_turns(boards, n)
+    report("boards -> bitboards", n, time.time() - start_s)
+
+    start_s = time.time()
+    batch_vals = batch_eval.batch_static_eval_bitboards(bitboards, turns)
+    report("batch eval from bitboards", n, time.time() - start_s)
+
+    occupancy = batch_eval.bitboards_to_occupancy(bitboards)
+    start_s = time.time()
+    occupancy_vals = batch_eval.batch_static_eval(occupancy, turns)
+    report("batch eval from occupancy", n, time.time() - start_s)
+
+    n_mismatches = sum(1 for i in range(n) if scalar_vals[i] != batch_vals[i] or scalar_vals[i] != occupancy_vals[i])
+    print("mismatches vs static_eval: %d" % n_mismatches)
+
+# Seeded random playouts from the bench positions - (root board, moves)
+def random_playouts(n_playouts, seed = 1, n_plies = 40):
+    rng = random.Random(seed)
+    playouts = []
+    for playout_no in range(n_playouts):
+        board = chess.Board(rng.choice(BENCH_FENS))
+        root = board.copy()
+        moves = []
+        for ply in range(n_plies):
+            legal_moves = list(board.legal_moves)
+            if not legal_moves:
+                break
+            move = rng.choice(legal_moves)
+            board.push(move)
+            moves.append(move)
+        playouts.append((root, moves))
+    return playouts
+
+def bench_evaluator(args):
+    evaluators = [
+        ("pst", evaluate.make_evaluator(evaluate.PST_EVALUATOR)),
+        ("nnue", evaluate.make_evaluator(evaluate.NNUE_EVALUATOR, args.weights)),
+    ]
+
+    boards = random_positions(args.n_positions)
+    expected_vals = [evaluate.static_eval(board) for board in boards]
+    for name, evaluator in evaluators:
+        start_s = time.time()
+        vals = []
+        for board in boards:
+            evaluator.reset(board)
+            vals.append(evaluator.evaluate(board))
+        report("%s from scratch" % name, len(boards), time.time() - start_s, "evals")
+        print("    differences from static_eval: %d" % sum(1 for i in range(len(boards)) if vals[i] != expected_vals[i]))
+
+    # Search-like use - push() before each move, evaluate() after it and pop() on the way back
+    playouts = random_playouts(max(1, args.n_positions // 40))
+    for name, evaluator in evaluators:
+        n_evals = 0
+        n_differences = 0
+        elapsed_s = 0
+        for root, moves in playouts:
+            board = root.copy()
+            vals = []
+            start_s = time.time()
+            evaluator.reset(board)
+            for move in moves:
+                evaluator.push(board, move)
+                board.push(move)
+                vals.append(evaluator.evaluate(board))
+            for move in moves:
+                board.pop()
+                evaluator.pop()
+            elapsed_s += time.time() - start_s
+            n_evals += len(moves)
+            board = root.copy()
+            for ply in range(len(moves)):
+                board.push(moves[ply])
+                if vals[ply] != evaluate.static_eval(board):
+                    n_differences += 1
+        report("%s incremental (with push/pop)" % name, n_evals, elapsed_s, "evals")
+        print("    differences from static_eval: %d" % n_differences)
+
+# Counts garbage collections and their pause times through gc.callbacks
+class GCMonitor:
+    def __init__(self):
+        self.n_collections = [0, 0, 0]
+        self.pause_s = 0
+        self.max_pause_s = 0
+        self.start_s = 0
+
+    def callback(self, phase, info):
+        if phase == "start":
+            self.start_s = time.perf_counter()
+        else:
+            pause_s = time.perf_counter() - self.start_s
+            self.n_collections[info["generation"]] += 1
+            self.pause_s += pause_s
+            self.max_pause_s = max(self.max_pause_s, pause_s)
+
+    def __enter__(self):
+        gc.callbacks.append(self.callback)
+        return self
+
+    def __exit__(self, *exc_info):
+        gc.callbacks.remove(self.callback)
+
+def bench_search(args):
+    from engine import Engine, MAX_DEPTH_KEY, VERBOSE_KEY
+
+    config = {MAX_DEPTH_KEY: args.depth, VERBOSE_KEY: False}
+    config.update(args.config)
+    total_nodes = 0
+    total_s = 0
+    if args.tracemalloc:
+        tracemalloc.start()
+    with GCMonitor() as gc_monitor:
+        for fen in BENCH_FENS:
+            engine = Engine(chess.Board(fen), config)
+            start_s = time.time()
+            engine_move, val, pv, stats = engine.gen_move()
+            elapsed_s = time.time() - start_s
+            total_nodes += engine.n_id_nodes
+            total_s += elapsed_s
+            print("%-70s %6d cp %9d nodes %8.3fs %s" % (fen, val, engine.n_id_nodes, elapsed_s, " ".join(move_list_to_sans(engine.board, pv))))
+    report("total", total_nodes, total_s, "nodes")
+    if args.tracemalloc:
+        current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("tracemalloc current %d bytes peak %d bytes" % (current_bytes, peak_bytes))
+    print("gc collections by generation %s - total pause %.1fms max pause %.2fms" % (" ".join(str(n) for n in gc_monitor.n_collections), gc_monitor.pause_s*1000, gc_monitor.max_pause_s*1000))
+
+def bench_mate(args):
+    import mate_search
+    from engine import Engine, MAX_DEPTH_KEY, VERBOSE_KEY
+
+    for fen in MATE_FENS:
+        board = chess.Board(fen)
+        print(fen)
+
+        searcher = mate_search.MateSearch(board, max_nodes=args.nodes)
+        start_s = time.time()
+        mate = searcher.find_mate(args.max_moves)
+        elapsed_s = time.time() - start_s
+        if mate != None:
+            n_moves, pv = mate
+            print("    %-12s mate in %d %9d nodes %8.3fs %s" % ("proof-number", n_moves, searcher.n_nodes, elapsed_s, " ".join(move_list_to_sans(board, pv))))
+        else:
+            print("    %-12s no mate    %9d nodes %8.3fs" % ("proof-number", searcher.n_nodes, elapsed_s))
+
+        # the alpha-beta search up to the depth of the longest mate looked for - the time of the first
+        #   iteration scoring a mate
+        engine = Engine(board.copy(), {MAX_DEPTH_KEY: 2*args.max_moves - 1, VERBOSE_KEY: False})
+        mate_infos = []
+        engine.info_callback = lambda info: mate_infos.append(info) if info["score_cp"] >= evaluate.CHECKMATE_VAL and not mate_infos else None
+        start_s = time.time()
+        engine.iterative_deepening(0, args.time)
+        elapsed_s = time.time() - start_s
+        if mate_infos:
+            info = mate_infos[0]
+            print("    %-12s depth %2d   %9d nodes %8.3fs %s" % ("alpha-beta", info["depth"], info["nodes"], info["time_s"], " ".join(move_list_to_sans(board, [chess.Move.from_uci(uci) for uci in info["pv"]]))))
+        else:
+            print("    %-12s no mate    %9d nodes %8.3fs - depth %d" % ("alpha-beta", engine.n_id_nodes, elapsed_s, engine.id_depth))
+
+def bench_threads(args):
+    import engine
+    from engine import Engine, MAX_DEPTH_KEY, THREADS_KEY, VERBOSE_KEY
+
+    if engine.gil_disabled():
+        print("free-threaded build with the GIL disabled")
+    else:
+        print("the GIL is enabled - the engine falls back to 1 thread, so expect no speedup")
+    base_s = 0
+    for n_threads in args.threads:
+        config = {MAX_DEPTH_KEY: args.depth, VERBOSE_KEY: False, THREADS_KEY: n_threads}
+        config.update(args.config)
+        total_nodes = 0
+        total_s = 0
+        for fen in BENCH_FENS:
+            search_engine = Engine(chess.Board(fen), config)
+            start_s = time.time()
+            search_engine.gen_move()
+            total_s += time.time() - start_s
+            total_nodes += search_engine.n_threads_nodes
+        if base_s == 0:
+            base_s = total_s
+        print("%2d threads (%d searching) %10d nodes %8.3fs %10.0f nodes/s speedup %.2fx" % (n_threads, search_engine.n_search_threads, total_nodes, total_s, total_nodes/max(total_s, 1e-9), base_s/max(total_s, 1e-9)))
+
+# "key=value" engine config override - the value is parsed as JSON where possible
+def config_item(item):
+    key, _, value = item.partition("=")
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+def main():
+    parser = argparse.ArgumentParser(description="klein-skakie benchmarks")
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+
+    eval_parser = subparsers.add_parser("eval", help="scalar vs batch static eval")
+    eval_parser.add_argument("-n", "--n-positions", type=int, default=100000)
+    eval_parser.set_defaults(func=bench_eval)
+
+    evaluator_parser = subparsers.add_parser("evaluator", help="pst vs nnue evaluator throughput")
+    evaluator_parser.add_argument("-n", "--n-positions", type=int, default=20000)
+    evaluator_parser.add_argument("--weights", default="", help="NNUE weights file - default the static_eval() equivalent net")
+    evaluator_parser.set_defaults(func=bench_evaluator)
+
+    search_parser = subparsers.add_parser("search", help="fixed depth search of the bench positions")
+    search_parser.add_argument("-d", "--depth", type=int, default=4)
+    search_parser.add_argument("--tracemalloc", action="store_true", help="report traced memory (slow)")
+    search_parser.add_argument("-c", "--config", type=config_item, action="append", default=[], help="engine config override key=value")
+    search_parser.set_defaults(func=bench_search)
+
+    mate_parser = subparsers.add_parser("mate", help="proof-number mate search vs alpha-beta time to mate")
+    mate_parser.add_argument("-m", "--max-moves", type=int, default=8, help="longest mate looked for")
+    mate_parser.add_argument("-n", "--nodes", type=int, default=50000, help="proof-number search node limit")
+    mate_parser.add_argument("-t", "--time", type=float, default=60, help="alpha-beta hard time limit per position in seconds")
+    mate_parser.set_defaults(func=bench_mate)
+
+    threads_parser = subparsers.add_parser("threads", help="threaded search time to depth by thread count")
+    threads_parser.add_argument("-d", "--depth", type=int, default=4)
+    threads_parser.add_argument("-j", "--threads", type=lambda item: [int(n) for n in item.split(",")], default=[1, 2, 4], help="comma-separated thread counts - the first is the speedup baseline")
+    threads_parser.add_argument("-c", "--config", type=config_item, action="append", default=[], help="engine config override key=value")
+    threads_parser.set_defaults(func=bench_threads)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+import argparse
+import mmap
+import os
+import time
+
+import numpy as np
+
+import chess
+
+import evaluate
+
+# Endgame bitbases for K+Q v K, K+R v K and K+P v K - built by retrograde analysis, cached to
+#   files and memory-mapped
+#
+# Positions are indexed with the strong side as White: ((side to move * 64 + white king) * 64 +
+#   black king) * 64 + piece square - positions with the strong side Black are colour-flipped.
+# Each position's distance to mate in plies (DTM) from the strong side's point of view is solved
+#   by iterating to a fixed point from the checkmates: a position with White to move is won in n
+#   if some move leads to a win in n-1; with Black to move, if every move leads to a win and the
+#   longest is n-1. Captures of the lone piece are draws; K+P v K positions promote into the
+#   K+Q v K and K+R v K tables, so K+P v K has to be built after those.
+# The iteration is vectorised over all positions with NumPy - the moves of every position are
+#   generated once into a (positions, moves) successor index array.
+#
+# Cache file: the win bits (bit-packed, one per position - the win/draw bitbase proper) followed
+#   by one DTM byte per position (NO_WIN_DTM for draws and illegal positions).
+# The 50-move rule is ignored, and so are castling rights.
+
+KQK = "kqk"
+KRK = "krk"
+KPK = "kpk"
+
+# Build order - K+P v K promotes into the others
+BITBASE_NAMES = [KQK, KRK, KPK]
+
+BITBASE_PIECE_TYPES = {KQK: chess.QUEEN, KRK: chess.ROOK, KPK: chess.PAWN}
+
+N_POSITIONS = 2 * 64 * 64 * 64
+WIN_BITS_BYTES = N_POSITIONS // 8
+
+NO_WIN_DTM = 255
+
+# Search value of a won bitbase position with distance to mate dtm plies is BITBASE_WIN_VAL - dtm:
+#   less than a mate on the board and more than any material advantage
+BITBASE_WIN_VAL = evaluate.CHECKMATE_VAL // 2
+
+DEFAULT_BITBASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bitbases")
+
+KING_DELTAS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+ROOK_DELTAS = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+BISHOP_DELTAS = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+def position_index(white_to_move, wk, bk, sq):
+    return (((0 if white_to_move else 1) * 64 + wk) * 64 + bk) * 64 + sq
+
+# rays[sq] - for each direction, the squares from sq outwards
+def make_rays(deltas):
+    rays = []
+    for sq in range(64):
+        file, rank = chess.square_file(sq), chess.square_rank(sq)
+        sq_rays = []
+        for file_delta, rank_delta in deltas:
+            ray = []
+            ray_file, ray_rank = file + file_delta, rank + rank_delta
+            while 0 <= ray_file < 8 and 0 <= ray_rank < 8:
+                ray.append(chess.square(ray_file, ray_rank))
+                ray_file += file_delta
+                ray_rank += rank_delta
+            sq_rays.append(ray)
+        rays.append(sq_rays)
+    return rays
+
+KING_TARGETS = [[ray[0] for ray in sq_rays if ray] for sq_rays in make_rays(KING_DELTAS)]
+PIECE_RAYS = {
+    chess.QUEEN: make_rays(ROOK_DELTAS + BISHOP_DELTAS),
+    chess.ROOK: make_rays(ROOK_DELTAS),
+}
+
+def is_adjacent(sq1, sq2):
+    return chess.square_distance(sq1, sq2) <= 1
+
+# True iff White's piece on sq attacks target with the white king on wk as the only blocker
+def piece_attacks(piece_type, sq, target, wk):
+    if piece_type == chess.PAWN:
+        return chess.square_rank(target) == chess.square_rank(sq) + 1 and chess.square_distance(sq, target) == 1 and target != sq + 8
+    for ray in PIECE_RAYS[piece_type][sq]:
+        for ray_sq in ray:
+            if ray_sq == target:
+                return True
+            if ray_sq == wk:
+                break
+    return False
+
+# Squares White's piece on sq can move to with the kings on wk and bk - promotions included
+def piece_targets(piece_type, sq, wk, bk):
+    targets = []
+    if piece_type == chess.PAWN:
+        if sq + 8 != wk and sq + 8 != bk:
+            targets.append(sq + 8)
+            if chess.square_rank(sq) == 1 and sq + 16 != wk and sq + 16 != bk:
+                targets.append(sq + 16)
+        return targets
+    for ray in PIECE_RAYS[piece_type][sq]:
+        for ray_sq in ray:
+            if ray_sq == wk or ray_sq == bk:
+                break
+            targets.append(ray_sq)
+    return targets
+
+def is_valid_piece_square(piece_type, sq):
+    return piece_type != chess.PAWN or 1 <= chess.square_rank(sq) <= 6
+
+# Solve the bitbase of piece_type - promotion_dtms maps the promotion piece type to the solved
+#   DTM array of its bitbase (K+P v K only)
+# Returns the DTM array (NO_WIN_DTM for draws and illegal positions).
+def generate(piece_type, promotion_dtms = {}):
+    n_wtm = N_POSITIONS // 2
+    # successor indices into values: the positions, then the promotion tables, then two sentinels
+    promotion_offsets = {}
+    n_values = N_POSITIONS
+    for promotion in promotion_dtms:
+        promotion_offsets[promotion] = n_values
+        n_values += N_POSITIONS
+    draw_index = n_values
+    win_index = n_values + 1
+
+    max_wtm_moves = 8 + (27 if piece_type != chess.PAWN else 2 * len(promotion_dtms) + 2)
+    wtm_successors = np.full((n_wtm, max_wtm_moves), draw_index, dtype=np.int32)
+    btm_successors = np.full((n_wtm, 8), win_index, dtype=np.int32)
+    legal = np.zeros(N_POSITIONS, dtype=bool)
+    dtm = np.full(N_POSITIONS, -1, dtype=np.int16)
+
+    for wk in range(64):
+        for bk in range(64):
+            if is_adjacent(wk, bk):
+                continue
+            for sq in range(64):
+                if sq == wk or sq == bk or not is_valid_piece_square(piece_type, sq):
+                    continue
+                bk_in_check = piece_attacks(piece_type, sq, bk, wk)
+
+                # White to move - illegal with Black in check
+                if not bk_in_check:
+                    index = position_index(True, wk, bk, sq)
+                    legal[index] = True
+                    successors = wtm_successors[index]
+                    n_moves = 0
+                    for target in KING_TARGETS[wk]:
+                        if target != sq and not is_adjacent(target, bk):
+                            successors[n_moves] = position_index(False, target, bk, sq)
+                            n_moves += 1
+                    for target in piece_targets(piece_type, sq, wk, bk):
+                        if chess.square_rank(target) == 7 and piece_type == chess.PAWN:
+                            for promotion, offset in promotion_offsets.items():
+                                successors[n_moves] = offset + position_index(False, wk, bk, target)
+                                n_moves += 1
+                        else:
+                            successors[n_moves] = position_index(False, wk, bk, target)
+                            n_moves += 1
+
+                # Black to move
+                index = position_index(False, wk, bk, sq)
+                legal[index] = True
+                successors = btm_successors[index - n_wtm]
+                n_moves = 0
+                for target in KING_TARGETS[bk]:
+                    if is_adjacent(target, wk):
+                        continue
+                    if target == sq:
+                        # capture of the undefended piece
+                        successors[n_moves] = draw_index
+                        n_moves += 1
+                    elif not piece_attacks(piece_type, sq, target, wk):
+                        successors[n_moves] = position_index(True, wk, target, sq)
+                        n_moves += 1
+                if n_moves == 0:
+                    if bk_in_check:
+                        # checkmate
+                        dtm[index] = 0
+                    else:
+                        # stalemate
+                        successors[0] = draw_index
+
+    # values[i] - the DTM of successor index i, -1 for no (known) win
+    values = np.full(n_values + 2, -1, dtype=np.int16)
+    for promotion, offset in promotion_offsets.items():
+        promotion_dtm = promotion_dtms[promotion].astype(np.int16)
+        promotion_dtm[promotion_dtm == NO_WIN_DTM] = -1
+        values[offset:offset+N_POSITIONS] = promotion_dtm
+    values[win_index] = 0
+
+    wtm_legal = legal[:n_wtm]
+    btm_unsolved = legal[n_wtm:] & (dtm[n_wtm:] < 0)
+    # Each ply's wins follow from the previous ply's, but promotions reach into the other tables
+    #   at any distance - so the iteration can only stop at a ply without wins past those
+    max_promotion_dtm = int(values[:draw_index].max())
+    n_plies = 1
+    while True:
+        values[:N_POSITIONS] = dtm
+        if n_plies % 2 == 1:
+            # White to move - won in n_plies if some move wins in n_plies-1
+            wins = wtm_legal & (dtm[:n_wtm] < 0) & (values[wtm_successors] == n_plies-1).any(axis=1)
+            dtm[:n_wtm][wins] = n_plies
+        else:
+            # Black to move - won in n_plies if every move is won, the longest in n_plies-1
+            successor_values = values[btm_successors]
+            wins = btm_unsolved & (successor_values >= 0).all(axis=1) & (successor_values.max(axis=1) == n_plies-1)
+            dtm[n_wtm:][wins] = n_plies
+            btm_unsolved &= ~wins
+        if not wins.any() and n_plies > max_promotion_dtm:
+            break
+        n_plies += 1
+
+    dtm[dtm < 0] = NO_WIN_DTM
+    return dtm.astype(np.uint8)
+
+def bitbase_path(bitbase_dir, name):
+    return os.path.join(bitbase_dir, name + ".bb")
+
+def save(path, dtm):
+    win_bits = np.packbits(dtm != NO_WIN_DTM, bitorder="little")
+    # written to a temporary file first so that concurrent loaders never map a partial file
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as bitbase_file:
+        bitbase_file.write(win_bits.tobytes())
+        bitbase_file.write(dtm.tobytes())
+    os.replace(tmp_path, path)
+
+# A memory-mapped bitbase file
+class Bitbase:
+    def __init__(self, path):
+        with open(path, "rb") as bitbase_file:
+            self.data = mmap.mmap(bitbase_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) != WIN_BITS_BYTES + N_POSITIONS:
+            raise ValueError("%s: bad bitbase file size %d" % (path, len(self.data)))
+
+    def is_win(self, index):
+        return (self.data[index >> 3] >> (index & 7)) & 1 == 1
+
+    def dtm(self, index):
+        return self.data[WIN_BITS_BYTES + index]
+
+    # DTM array view of the file - for building the K+P v K bitbase
+    def dtm_array(self):
+        return np.frombuffer(self.data, dtype=np.uint8, count=N_POSITIONS, offset=WIN_BITS_BYTES)
+
+# Load the bitbases from bitbase_dir, generating (and caching) any that are missing
+def load_bitbases(bitbase_dir = DEFAULT_BITBASE_DIR, verbose = False):
+    os.makedirs(bitbase_dir, exist_ok=True)
+    bitbases = {}
+    for name in BITBASE_NAMES:
+        path = bitbase_path(bitbase_dir, name)
+        if not os.path.exists(path):
+            start_s = time.time()
+            promotion_dtms = {}
+            if name == KPK:
+                promotion_dtms = {chess.QUEEN: bitbases[KQK].dtm_array(), chess.ROOK: bitbases[KRK].dtm_array()}
+            save(path, generate(BITBASE_PIECE_TYPES[name], promotion_dtms))
+            if verbose:
+                print("generated %s in %.1fs" % (path, time.time() - start_s))
+        bitbases[name] = Bitbase(path)
+    return bitbases
+
+# Probing K+Q v K, K+R v K and K+P v K positions
+class Bitbases:
+    def __init__(self, bitbase_dir = DEFAULT_BITBASE_DIR, verbose = False):
+        bitbases = load_bitbases(bitbase_dir, verbose)
+        self.by_piece_type = {BITBASE_PIECE_TYPES[name]: bitbase for name, bitbase in bitbases.items()}
+
+    # Side-to-move-relative value of board, or None if it isn't covered
+    # Only called with three pieces on the board.
+    def probe(self, board):
+        for piece_type, bitbase in self.by_piece_type.items():
+            pieces = board.pieces_mask(piece_type, chess.WHITE)
+            strong = chess.WHITE
+            if not pieces:
+                pieces = board.pieces_mask(piece_type, chess.BLACK)
+                strong = chess.BLACK
+            if not pieces:
+                continue
+            if board.castling_rights:
+                return None
+            sq = chess.lsb(pieces)
+            wk = board.king(strong)
+            bk = board.king(not strong)
+            white_to_move = board.turn == strong
+            if strong == chess.BLACK:
+                # colour-flip - mirror the squares vertically
+                sq ^= 56
+                wk ^= 56
+                bk ^= 56
+            index = position_index(white_to_move, wk, bk, sq)
+            if not bitbase.is_win(index):
+                return evaluate.DRAW_VAL
+            val = BITBASE_WIN_VAL - bitbase.dtm(index)
+            return val if white_to_move else -val
+        return None
+
+# map: bitbase directory -> Bitbases - shared by the engines of a process
+open_bitbases_by_dir = {}
+
+def open_bitbases(bitbase_dir = DEFAULT_BITBASE_DIR, verbose = False):
+    bitbases = open_bitbases_by_dir.get(bitbase_dir)
+    if bitbases == None:
+        bitbases = Bitbases(bitbase_dir, verbose)
+        open_bitbases_by_dir[bitbase_dir] = bitbases
+    return bitbases
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the K+Q v K, K+R v K and K+P v K bitbases")
+    parser.add_argument("-d", "--dir", default=DEFAULT_BITBASE_DIR, help="bitbase directory")
+    parser.add_argument("-f", "--force", action="store_true", help="regenerate existing bitbases")
+    args = parser.parse_args()
+    if args.force:
+        for name in BITBASE_NAMES:
+            path = bitbase_path(args.dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+    bitbases = load_bitbases(args.dir, True)
+    for name in BITBASE_NAMES:
+        dtm = bitbases[name].dtm_array()
+        n_wins = int((dtm != NO_WIN_DTM).sum())
+        print("%s: %d won positions - longest win %d plies" % (name, n_wins, int(dtm[dtm != NO_WIN_DTM].max())))
+
+if __name__ == "__main__":
+    main()
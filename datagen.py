@@ -0,0 +1,235 @@
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+import chess
+
+import batch_eval
+
+from engine import Engine, MAX_DEPTH_KEY, MAX_NODES_KEY, VERBOSE_KEY
+
+# Self-play training data - scored quiet positions from fast fixed-node games
+#
+#   python datagen.py [-g GAMES] [-n NODES] [-j WORKERS] [-o selfplay.bin] [--random-plies N] [--seed S]
+#
+# Each worker process plays games of the engine against itself with a node limit per move,
+#   starting from a few random plies to vary the openings. Positions are recorded with the
+#   search score when they are quiet - not in check and the best move is not a capture or a
+#   promotion - and get the game's result once it is over. Games are adjudicated as won once the
+#   score has been decisive for a few plies, and drawn after MAX_GAME_PLIES.
+#
+# Records are fixed-size 32 bytes (RECORD_DTYPE) appended to a flat file:
+#   occupied  <u8    occupancy bitboard
+#   pieces    u1[16] a nibble per occupied square in square order, low nibble first -
+#                    color << 3 | piece type
+#   flags     u1     bit 0 White to move, bits 1-4 castling rights KQkq
+#   ep        u1     en passant square, or NO_EP_SQUARE
+#   score     <i2    search score in cp, side-to-move relative
+#   result    i1     game result, White relative: 1, 0 or -1
+#   ply       <u2    game ply of the position
+#   pad       u1
+# read_records() maps a file as a record array without copying it - each field is a strided
+#   view - and records_to_bitboards() converts records to the batch_eval bitboards.
+
+RECORD_DTYPE = np.dtype([
+    ("occupied", "<u8"),
+    ("pieces", "u1", (16,)),
+    ("flags", "u1"),
+    ("ep", "u1"),
+    ("score", "<i2"),
+    ("result", "i1"),
+    ("ply", "<u2"),
+    ("pad", "u1"),
+])
+
+NO_EP_SQUARE = 255
+
+WHITE_TO_MOVE_FLAG = 1
+# flag bit of each castling rook square
+CASTLING_FLAGS = [(chess.H1, 2), (chess.A1, 4), (chess.H8, 8), (chess.A8, 16)]
+
+DEFAULT_NODES_PER_MOVE = 5000
+DEFAULT_RANDOM_PLIES = 8
+
+# Games are drawn after this many plies
+MAX_GAME_PLIES = 300
+
+# Games are won by the side the score favours once it has been at least this for ADJUDICATE_PLIES plies in a row
+ADJUDICATE_SCORE = 1500
+ADJUDICATE_PLIES = 6
+
+# Positions with scores beyond this - mates, bitbase wins - are decided and not recorded
+MAX_RECORD_SCORE = 3000
+
+# Positions of the first plies are too close to the random opening moves to be worth recording
+MIN_RECORD_PLY = 16
+
+def pack_position(board, score, ply):
+    record = np.zeros((), dtype=RECORD_DTYPE)
+    record["occupied"] = board.occupied
+    nibbles = [int(board.color_at(sq)) << 3 | board.piece_type_at(sq) for sq in chess.SquareSet(board.occupied)]
+    if len(nibbles) & 1:
+        nibbles.append(0)
+    record["pieces"][:len(nibbles) // 2] = [nibbles[i] | nibbles[i+1] << 4 for i in range(0, len(nibbles), 2)]
+    flags = WHITE_TO_MOVE_FLAG if board.turn else 0
+    for rook_sq, flag in CASTLING_FLAGS:
+        if board.castling_rights & chess.BB_SQUARES[rook_sq]:
+            flags |= flag
+    record["flags"] = flags
+    record["ep"] = board.ep_square if board.ep_square != None else NO_EP_SQUARE
+    record["score"] = score
+    record["ply"] = ply
+    return record
+
+# The position of a record - for checks; bulk reads go through records_to_bitboards()
+def unpack_position(record):
+    board = chess.Board(None)
+    pieces = record["pieces"]
+    for i, sq in enumerate(chess.SquareSet(int(record["occupied"]))):
+        nibble = (pieces[i >> 1] >> (4 * (i & 1))) & 15
+        board.set_piece_at(sq, chess.Piece(nibble & 7, bool(nibble >> 3)))
+    flags = int(record["flags"])
+    board.turn = bool(flags & WHITE_TO_MOVE_FLAG)
+    for rook_sq, flag in CASTLING_FLAGS:
+        if flags & flag:
+            board.castling_rights |= chess.BB_SQUARES[rook_sq]
+    if record["ep"] != NO_EP_SQUARE:
+        board.ep_square = int(record["ep"])
+    return board
+
+# The records of a file as a read-only memory map - no copy is made
+def read_records(path):
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode="r")
+
+# (N, 12) batch_eval bitboards of records - converted in chunks of batch_eval.CHUNK_SIZE to bound
+#   temporary memory
+# The i-th occupied square of a record holds the i-th nibble, so each square's nibble index is
+#   the number of occupied squares below it.
+def records_to_bitboards(records):
+    n = records.shape[0]
+    bitboards = np.empty((n, batch_eval.N_PLANES), dtype=np.uint64)
+    for start in range(0, n, batch_eval.CHUNK_SIZE):
+        end = min(start + batch_eval.CHUNK_SIZE, n)
+        chunk = records[start:end]
+        n_chunk = end - start
+        occupied = np.ascontiguousarray(chunk["occupied"], dtype="<u8")
+        occupancy = np.unpackbits(occupied.view(np.uint8), bitorder="little").reshape(n_chunk, 64).astype(bool)
+        pieces = np.asarray(chunk["pieces"])
+        nibbles = np.empty((n_chunk, 32), dtype=np.uint8)
+        nibbles[:, 0::2] = pieces & 15
+        nibbles[:, 1::2] = pieces >> 4
+        nibble_index = np.cumsum(occupancy, axis=1) - 1
+        square_nibbles = np.take_along_axis(nibbles, np.clip(nibble_index, 0, 31), axis=1)
+        # plane index is color * 6 + piece type - 1, as in batch_eval
+        planes = (square_nibbles >> 3).astype(np.int64) * 6 + (square_nibbles & 7) - 1
+        planes_occupancy = np.zeros((n_chunk, batch_eval.N_PLANES, 64), dtype=np.uint8)
+        rows, squares = np.nonzero(occupancy)
+        planes_occupancy[rows, planes[rows, squares], squares] = 1
+        bitboards[start:end] = batch_eval.occupancy_to_bitboards(planes_occupancy)
+    return bitboards
+
+# (N,) bool side-to-move array of records - True for White
+def records_to_turns(records):
+    return (records["flags"] & WHITE_TO_MOVE_FLAG) != 0
+
+# Per-process self-play engine, created by init_worker()
+worker_engine = None
+
+def init_worker(nodes_per_move):
+    global worker_engine
+    worker_engine = Engine(chess.Board(), {MAX_DEPTH_KEY: 64, MAX_NODES_KEY: nodes_per_move, VERBOSE_KEY: False})
+
+def is_quiet(board, move):
+    return not board.is_check() and move.promotion == None and not board.is_capture(move)
+
+# Plays one game; returns its records as bytes
+def play_game(game_seed, random_plies):
+    rng = random.Random(game_seed)
+    board = chess.Board()
+    for ply in range(random_plies):
+        moves = list(board.legal_moves)
+        if not moves:
+            break
+        board.push(rng.choice(moves))
+    if board.is_game_over(claim_draw=True):
+        return b""
+
+    engine = worker_engine
+    engine.set_board(board)
+    engine.tt.clear()
+    engine.qtt.clear()
+    records = []
+    result = 0
+    n_decisive_plies = 0
+    while True:
+        if board.is_game_over(claim_draw=True):
+            outcome = board.outcome(claim_draw=True)
+            result = 0 if outcome.winner == None else [-1, 1][outcome.winner]
+            break
+        if board.ply() >= MAX_GAME_PLIES:
+            break
+        engine.tt.clear()
+        move, score, pv, stats = engine.iterative_deepening(0)
+        if abs(score) >= ADJUDICATE_SCORE:
+            n_decisive_plies += 1
+            if n_decisive_plies >= ADJUDICATE_PLIES:
+                result = [-1, 1][board.turn] * (1 if score > 0 else -1)
+                break
+        else:
+            n_decisive_plies = 0
+        if board.ply() >= MIN_RECORD_PLY and abs(score) <= MAX_RECORD_SCORE and is_quiet(board, move):
+            records.append(pack_position(board, score, board.ply()))
+        board.push(move)
+        engine.make_move(move)
+
+    if not records:
+        return b""
+    records = np.array(records, dtype=RECORD_DTYPE)
+    records["result"] = result
+    return records.tobytes()
+
+def play_game_task(args):
+    return play_game(*args)
+
+# Plays n_games games over n_workers processes, appending the records to path; returns (games, positions, seconds)
+def generate(path, n_games, n_workers, nodes_per_move, random_plies, seed, progress_file = sys.stderr):
+    tasks = [(seed + i, random_plies) for i in range(n_games)]
+    n_positions = 0
+    n_games_done = 0
+    start_s = time.time()
+    with open(path, "ab") as output_file, multiprocessing.Pool(n_workers, initializer=init_worker, initargs=(nodes_per_move,)) as pool:
+        # games take seconds each, so they are handed out one at a time and written as they finish
+        for game_bytes in pool.imap_unordered(play_game_task, tasks):
+            output_file.write(game_bytes)
+            n_positions += len(game_bytes) // RECORD_DTYPE.itemsize
+            n_games_done += 1
+            elapsed_s = time.time() - start_s
+            print("%d/%d games %d positions %.1fs %.0f positions/hour" % (n_games_done, n_games, n_positions, elapsed_s, 3600*n_positions/max(elapsed_s, 1e-9)), file=progress_file)
+    return n_games_done, n_positions, time.time() - start_s
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate scored quiet positions from fixed-node self-play games")
+    parser.add_argument("-o", "--output", default="selfplay.bin", help="records file - appended to")
+    parser.add_argument("-g", "--games", type=int, default=100)
+    parser.add_argument("-n", "--nodes", type=int, default=DEFAULT_NODES_PER_MOVE, help="search nodes per move")
+    parser.add_argument("-j", "--workers", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--random-plies", type=int, default=DEFAULT_RANDOM_PLIES, help="random opening plies of each game")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the first game - by default from the clock")
+    args = parser.parse_args()
+
+    seed = args.seed if args.seed != None else int(time.time() * 1000)
+    n_games, n_positions, elapsed_s = generate(args.output, args.games, args.workers, args.nodes, args.random_plies, seed)
+    records = read_records(args.output)
+    results = records["result"]
+    print("%d games %d positions in %.1fs - %.0f positions/hour with %d workers at %d nodes/move" % (n_games, n_positions, elapsed_s, 3600*n_positions/max(elapsed_s, 1e-9), args.workers, args.nodes))
+    print("%s now holds %d positions - White wins %d draws %d Black wins %d" % (args.output, len(records), np.count_nonzero(results == 1), np.count_nonzero(results == 0), np.count_nonzero(results == -1)))
+
+if __name__ == "__main__":
+    main()
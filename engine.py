@@ -1,12 +1,16 @@
+import sys
+import threading
 import time
 
 import chess
 
+import bitbase
 import evaluate
+import mate_search
 import tt
 
-from util import fen4, move_list_to_sans
-from move_sort import search_move_sort_key
+from util import fen4, position_key, move_list_to_sans
+from move_sort import search_move_sort_key, unpack_move, packed_move_val_delta, PositionMoves, PACKED_MOVE_MASK, POSITION_MOVES_ENTRY_BYTES
 
 # Engine config
 
@@ -29,9 +33,106 @@ DEFAULT_DO_QSEARCH_MOVE_SORT = True
 DO_QSEARCH_MOVE_SORT_KEY = "do-qsearch-move-sort"
 
 # True iff we maintain and use a transition-table for quiescence search
-DEFAULT_USE_QTT = False
+DEFAULT_USE_QTT = True
 USE_QTT_KEY = "use-qtt"
 
+# Memory budget of the quiescence transition-table - entries are evicted (CLOCK) beyond this
+DEFAULT_QTT_SIZE_MB = 64
+QTT_SIZE_MB_KEY = "qtt-size-mb"
+
+# Number of entries of the static eval cache (rounded down to a power of two) - 0 disables it
+DEFAULT_EVAL_CACHE_SIZE = 1 << 18
+EVAL_CACHE_SIZE_KEY = "eval-cache-size"
+
+# True iff the search generates pseudo-legal moves at nodes not in check and only checks the
+#   legality of the moves it actually tries
+DEFAULT_PSEUDO_LEGAL = True
+PSEUDO_LEGAL_KEY = "pseudo-legal"
+
+# Memory budget of the per-position move cache - 0 disables it
+DEFAULT_MOVE_CACHE_SIZE_MB = 64
+MOVE_CACHE_SIZE_MB_KEY = "move-cache-size-mb"
+
+# 0 means no node limit; otherwise the search is aborted once this many (q)nodes have been searched
+DEFAULT_MAX_NODES = 0
+MAX_NODES_KEY = "max-nodes"
+
+# Number of best root moves searched (with their lines) on each iteration
+DEFAULT_MULTI_PV = 1
+MULTI_PV_KEY = "multi-pv"
+
+# Leaf evaluator - evaluate.PST_EVALUATOR (static_eval()) or evaluate.NNUE_EVALUATOR
+DEFAULT_EVALUATOR = evaluate.PST_EVALUATOR
+EVALUATOR_KEY = "evaluator"
+
+# NNUE weights file (see nnue.py) - "" for the net equivalent to static_eval()
+DEFAULT_NNUE_WEIGHTS = ""
+NNUE_WEIGHTS_KEY = "nnue-weights"
+
+# Root search driver - PVS_DRIVER, MTDF_DRIVER or ALPHABETA_DRIVER (the older plain alpha-beta)
+#   - MTD(f) only with a MULTI_PV of 1
+# On the 8 bench positions at depth 4 (bench.py search) all three find the same values and PVs, in
+#   118698 (PVS), 140476 (MTD(f)) and 123759 (alpha-beta) nodes.
+PVS_DRIVER = "pvs"
+MTDF_DRIVER = "mtdf"
+ALPHABETA_DRIVER = "alphabeta"
+DEFAULT_SEARCH_DRIVER = PVS_DRIVER
+SEARCH_DRIVER_KEY = "search-driver"
+
+# Memory budget of the MTD(f) bound TT
+DEFAULT_MTDF_TT_SIZE_MB = 64
+MTDF_TT_SIZE_MB_KEY = "mtdf-tt-size-mb"
+
+# Internal iterative deepening - PV and expected cut nodes with at least this depth to go and no
+#   TT or PV move first search IID_REDUCTION plies shallower for a best move to try first; 0 disables it
+DEFAULT_IID_MIN_DEPTH = 4
+IID_MIN_DEPTH_KEY = "iid-min-depth"
+IID_REDUCTION = 2
+
+# True iff the root moves after the PV move are ordered by the size (in (q)nodes) of their subtrees
+#   in the previous iteration - the moves that took more refuting come first
+# Off by default - on the bench positions at depths 4 and 5 it searched slightly more nodes than the
+#   static order.
+DEFAULT_ROOT_NODE_ORDER = False
+ROOT_NODE_ORDER_KEY = "root-node-order"
+
+# Node budget of the proof-number mate search run before the main search in sharp positions
+#   (see mate_search.is_sharp()) - 0 disables it
+DEFAULT_MATE_SEARCH_NODES = 0
+MATE_SEARCH_NODES_KEY = "mate-search-nodes"
+
+# Longest mate (in the engine's moves) the mate search looks for
+DEFAULT_MATE_SEARCH_MAX_MOVES = 8
+MATE_SEARCH_MAX_MOVES_KEY = "mate-search-max-moves"
+
+# Directory of the K+Q v K, K+R v K and K+P v K bitbases (see bitbase.py) - generated there when
+#   missing; "" disables them
+DEFAULT_BITBASE_DIR = bitbase.DEFAULT_BITBASE_DIR
+BITBASE_DIR_KEY = "bitbase-dir"
+
+# The bitbases are loaded for searches from positions with at most this many pieces
+BITBASE_LOAD_MAX_PIECES = 8
+
+# Search threads - helper threads search the same root alongside the main search, sharing its TT
+#   (lazy SMP). Only used on free-threaded CPython builds with the GIL disabled (see gil_disabled());
+#   with the GIL the threads would just take turns, so the search stays single-threaded.
+DEFAULT_THREADS = 1
+THREADS_KEY = "threads"
+
+# False suppresses the per-iteration search output - used for batch analysis
+DEFAULT_VERBOSE = True
+VERBOSE_KEY = "verbose"
+
+# How often (in search nodes) we check for search node/time limits
+ABORT_CHECK_NODES_MASK = 127
+
+# Size of the triangular PV table and the per-ply move buffers
+MAX_PLY = 64
+
+# True iff Python threads run in parallel - a free-threaded (3.13t+) build running with the GIL disabled
+def gil_disabled():
+    return hasattr(sys, "_is_gil_enabled") and not sys._is_gil_enabled()
+
 def config_val(config, key, default):
     val = default
     if key in config:
@@ -39,6 +140,18 @@ def config_val(config, key, default):
     return val
 
 class SearchStats:
+    __slots__ = (
+        "n_nodes", "n_win_nodes", "n_draw_nodes", "n_leaf_nodes", "n_pv_nodes", "n_cut_nodes", "n_all_nodes",
+        "n_depth_nodes", "n_depth_cut_nodes", "n_depth_cut_siblings",
+        "n_qnodes", "n_qpat_nodes", "n_qcut_nodes", "n_qdepth_nodes",
+        "n_qtt_hits", "n_qtt_ub_hits", "n_qtt_lb_hits", "n_qtt_exact_hits", "n_qtt_misses", "n_qtt_evictions",
+        "n_eval_cache_hits", "n_eval_cache_misses",
+        "n_move_cache_hits", "n_move_cache_misses",
+        "n_bitbase_hits",
+        "n_mtdf_passes", "n_mtdf_tt_cuts",
+        "n_iid_searches",
+    )
+
     def __init__(self, max_depth, max_qdepth):
         self.n_nodes = 0
         self.n_win_nodes = 0
@@ -60,6 +173,24 @@ class SearchStats:
         self.n_qtt_ub_hits = 0
         self.n_qtt_lb_hits = 0
         self.n_qtt_exact_hits = 0
+        self.n_qtt_misses = 0
+        self.n_qtt_evictions = 0
+
+        self.n_eval_cache_hits = 0
+        self.n_eval_cache_misses = 0
+
+        self.n_move_cache_hits = 0
+        self.n_move_cache_misses = 0
+
+        self.n_bitbase_hits = 0
+
+        self.n_mtdf_passes = 0
+        self.n_mtdf_tt_cuts = 0
+        self.n_iid_searches = 0
+
+# Raised inside the search when a hard node or time limit is hit
+class SearchAborted(Exception):
+    pass
 
 class Engine:
     
@@ -74,6 +205,25 @@ class Engine:
         self.DO_SEARCH_MOVE_SORT = config_val(config, DO_SEARCH_MOVE_SORT_KEY, DEFAULT_DO_SEARCH_MOVE_SORT)
         self.DO_QSEARCH_MOVE_SORT = config_val(config, DO_QSEARCH_MOVE_SORT_KEY, DEFAULT_DO_QSEARCH_MOVE_SORT)
         self.USE_QTT = config_val(config, USE_QTT_KEY, DEFAULT_USE_QTT)
+        self.QTT_SIZE_MB = config_val(config, QTT_SIZE_MB_KEY, DEFAULT_QTT_SIZE_MB)
+        self.MAX_NODES = config_val(config, MAX_NODES_KEY, DEFAULT_MAX_NODES)
+        self.VERBOSE = config_val(config, VERBOSE_KEY, DEFAULT_VERBOSE)
+        self.MULTI_PV = config_val(config, MULTI_PV_KEY, DEFAULT_MULTI_PV)
+        self.EVALUATOR = config_val(config, EVALUATOR_KEY, DEFAULT_EVALUATOR)
+        self.NNUE_WEIGHTS = config_val(config, NNUE_WEIGHTS_KEY, DEFAULT_NNUE_WEIGHTS)
+        self.EVAL_CACHE_SIZE = config_val(config, EVAL_CACHE_SIZE_KEY, DEFAULT_EVAL_CACHE_SIZE)
+        self.PSEUDO_LEGAL = config_val(config, PSEUDO_LEGAL_KEY, DEFAULT_PSEUDO_LEGAL)
+        self.MOVE_CACHE_SIZE_MB = config_val(config, MOVE_CACHE_SIZE_MB_KEY, DEFAULT_MOVE_CACHE_SIZE_MB)
+        self.MATE_SEARCH_NODES = config_val(config, MATE_SEARCH_NODES_KEY, DEFAULT_MATE_SEARCH_NODES)
+        self.MATE_SEARCH_MAX_MOVES = config_val(config, MATE_SEARCH_MAX_MOVES_KEY, DEFAULT_MATE_SEARCH_MAX_MOVES)
+        self.BITBASE_DIR = config_val(config, BITBASE_DIR_KEY, DEFAULT_BITBASE_DIR)
+        self.SEARCH_DRIVER = config_val(config, SEARCH_DRIVER_KEY, DEFAULT_SEARCH_DRIVER)
+        self.MTDF_TT_SIZE_MB = config_val(config, MTDF_TT_SIZE_MB_KEY, DEFAULT_MTDF_TT_SIZE_MB)
+        self.THREADS = config_val(config, THREADS_KEY, DEFAULT_THREADS)
+        self.IID_MIN_DEPTH = config_val(config, IID_MIN_DEPTH_KEY, DEFAULT_IID_MIN_DEPTH)
+        self.ROOT_NODE_ORDER = config_val(config, ROOT_NODE_ORDER_KEY, DEFAULT_ROOT_NODE_ORDER)
+        if self.SEARCH_DRIVER not in (PVS_DRIVER, MTDF_DRIVER, ALPHABETA_DRIVER):
+            raise ValueError("unknown search driver %r" % self.SEARCH_DRIVER)
             
         # timing
         self.total_engine_time_s = 0
@@ -84,51 +234,458 @@ class Engine:
         self.tt_epoch = 0
         
         # map: fen4 -> chess.Move
+        # Shared with the helper engines of a threaded search - dict item reads and writes are atomic
+        #   (under the GIL, and with per-object locks on free-threaded builds) so no lock is needed.
         self.tt = {}
 
-        # map: fen4 -> tt.TTEntry
-        self.qtt = {}
+        # bounded map: hash(position key, static val) -> tt.TTEntry
+        # The quiescence val is built incrementally from the leaf's static eval, so the same position
+        #   can be reached with different vals - keying on both keeps the stored bounds valid.
+        self.qtt = tt.ClockCache(self.QTT_SIZE_MB * 1024 * 1024)
+
+        # bounded map: hash(position key, depth to go) -> tt.TTEntry - side-to-move-relative bounds
+        #   and best move of the MTD(f) zero-window searches
+        self.mtdf_tt = None
+        if self.SEARCH_DRIVER == MTDF_DRIVER:
+            self.mtdf_tt = tt.ClockCache(self.MTDF_TT_SIZE_MB * 1024 * 1024)
+
+        # bounded map: position key -> White-relative static eval
+        # Kept across searches - the static eval of a position never changes
+        self.eval_cache = None
+        if self.EVAL_CACHE_SIZE > 0:
+            self.eval_cache = tt.EvalCache(self.EVAL_CACHE_SIZE)
+
+        # bounded map: position key -> move_sort.PositionMoves
+        # Kept across iterations and searches - a position's moves never change
+        self.move_cache = None
+        if self.MOVE_CACHE_SIZE_MB > 0:
+            self.move_cache = tt.ClockCache(self.MOVE_CACHE_SIZE_MB * 1024 * 1024, POSITION_MOVES_ENTRY_BYTES)
+
+        # bitbase.Bitbases - loaded by the first search that can reach a three-piece position
+        self.bitbases = None
+
+        # hard search limits - only checked once the first iteration has completed
+        self.search_deadline_s = 0
+        self.can_abort = False
+        # optional callable returning True to abort the search - checked even in the first iteration
+        self.stop_check = None
+        # optional callable receiving a dict of results after each completed iteration
+        self.info_callback = None
+        # (q)nodes searched by the completed iterations of the current iterative deepening search
+        self.n_id_nodes = 0
+        # deepest completed iteration of the last iterative deepening search
+        self.id_depth = 0
+        # n if the last iterative deepening search was decided by the mate search finding a mate in n
+        self.id_mate_moves = 0
+
+        # PV of the previous iteration - followed first by the next iteration
+        self.id_pv = []
+
+        # move code -> (q)nodes of the root move's subtree in the previous iteration, and in the current one
+        self.root_move_nodes = {}
+        self.next_root_move_nodes = {}
+
+        # (move, val, pv) of the best MULTI_PV root moves of the last completed iteration, best first
+        self.multi_pv_lines = []
+
+        # Triangular PV table - row ply holds the PV from ply in pv_table[ply][ply:pv_length[ply]]
+        self.pv_table = [[None] * MAX_PLY for ply in range(MAX_PLY)]
+        self.pv_length = [0] * MAX_PLY
+
+        # Per-ply move lists reused from node to node
+        self.move_buffers = [[] for ply in range(MAX_PLY)]
+
+        # Move sort keys as bound methods so that no closure is created per node
+        self.sort_pv_move = None
+        self.sort_tt_move = None
+        self.search_sort_key = self.search_move_sort_key
+
+        # Leaf evaluator - kept in step with the search's board.push()/pop() from the root
+        self.evaluator = evaluate.make_evaluator(self.EVALUATOR, self.NNUE_WEIGHTS)
+
+        # Helper engines of the threaded search - each with its own board, stats, PV table, evaluator
+        #   and caches; created on the first threaded search
+        self.helper_config = dict(config)
+        self.helper_config.update({THREADS_KEY: 1, VERBOSE_KEY: False, MULTI_PV_KEY: 1, MATE_SEARCH_NODES_KEY: 0})
+        self.helpers = []
+        # search threads used by the last gen_move() - 1 when the GIL forced a single-threaded search
+        self.n_search_threads = 1
+        # (q)nodes of the completed iterations of all threads of the last gen_move()
+        self.n_threads_nodes = 0
         
     def make_move(self, move):
         self.board.push(move)
         self.fen4s.add(fen4(self.board))
 
+    # Replace the current position, keeping the search tables
+    def set_board(self, board):
+        self.board = board.copy()
+        self.fen4s = set()
+        replay_board = board.root()
+        for move in board.move_stack:
+            replay_board.push(move)
+            self.fen4s.add(fen4(replay_board))
+
+    def check_abort(self, stats):
+        if self.stop_check != None and self.stop_check():
+            raise SearchAborted()
+        if not self.can_abort:
+            return
+        if self.MAX_NODES > 0 and self.n_id_nodes + stats.n_nodes + stats.n_qnodes >= self.MAX_NODES:
+            raise SearchAborted()
+        if self.search_deadline_s > 0 and time.time() >= self.search_deadline_s:
+            raise SearchAborted()
+
+    # White-relative static eval of the current position - from scratch, outside of the search
     def static_eval(self):
-        return evaluate.static_eval(self.board)
-
-    def iterative_deepening(self, move_time_limit_s):
-        print("                                                               id time limit is %.3fs" % move_time_limit_s)
+        pos_key = None
+        if self.eval_cache != None:
+            pos_key = position_key(self.board)
+            val = self.eval_cache.get(pos_key)
+            if val != None:
+                return val
+        self.evaluator.reset(self.board)
+        val = self.evaluator.evaluate(self.board)
+        if self.eval_cache != None:
+            self.eval_cache.put(pos_key, val)
+        return val
+
+    # White-relative static eval of the current search leaf - through the eval cache
+    def leaf_static_eval(self, stats, pos_key):
+        eval_cache = self.eval_cache
+        if eval_cache == None:
+            return self.evaluator.evaluate(self.board)
+        val = eval_cache.get(pos_key)
+        if val != None:
+            stats.n_eval_cache_hits += 1
+            return val
+        stats.n_eval_cache_misses += 1
+        val = self.evaluator.evaluate(self.board)
+        eval_cache.put(pos_key, val)
+        return val
+
+    def search_move_sort_key(self, move):
+        return search_move_sort_key(self.board, move, self.sort_pv_move, self.sort_tt_move)
+
+    def has_legal_move(self, pos_key):
+        if self.move_cache != None:
+            position_moves = self.move_cache.peek(pos_key)
+            if position_moves != None:
+                return position_moves.probe_has_legal_move(self.board)
+        return any(self.board.generate_legal_moves())
+
+    # Exact side-to-move-relative value of the current position from the bitbases, or None if it
+    #   has more than three pieces (or the bitbases aren't loaded)
+    def probe_bitbases(self, stats):
+        if self.bitbases == None or chess.popcount(self.board.occupied) != 3:
+            return None
+        val = self.bitbases.probe(self.board)
+        if val != None:
+            stats.n_bitbase_hits += 1
+        return val
+
+    # The (cached) move_sort.PositionMoves of the current position
+    # Positions with an ep square are not cached - the position key only includes the ep square
+    #   when there's a legal ep capture, but an illegal one is still generated pseudo-legal.
+    def position_moves(self, stats, pos_key):
+        move_cache = self.move_cache
+        if move_cache == None or self.board.ep_square != None:
+            return PositionMoves()
+        position_moves = move_cache.get(pos_key)
+        if position_moves != None:
+            stats.n_move_cache_hits += 1
+            return position_moves
+        stats.n_move_cache_misses += 1
+        position_moves = PositionMoves()
+        move_cache.put(pos_key, position_moves)
+        return position_moves
+
+    # Copy the child's PV up to the parent's row with move in front
+    def update_pv(self, ply, move):
+        row = self.pv_table[ply]
+        row[ply] = move
+        child_row = self.pv_table[ply+1]
+        child_length = self.pv_length[ply+1]
+        for i in range(ply+1, child_length):
+            row[i] = child_row[i]
+        self.pv_length[ply] = child_length
+
+    def root_pv(self):
+        return self.pv_table[0][:self.pv_length[0]]
+
+    # Loads (and generates if need be) the bitbases when the search can reach a three-piece position
+    def load_bitbases(self):
+        if self.bitbases == None and self.BITBASE_DIR != "" and chess.popcount(self.board.occupied) <= BITBASE_LOAD_MAX_PIECES:
+            self.bitbases = bitbase.open_bitbases(self.BITBASE_DIR, self.VERBOSE)
+
+    # start_depth > 1 skips the first iterations - used by helper threads to search ahead of the main thread
+    def iterative_deepening(self, move_time_limit_s, hard_time_limit_s = 0, start_depth = 1):
+        if self.VERBOSE:
+            print("                                                               id time limit is %.3fs" % move_time_limit_s)
         max_depth = self.MAX_DEPTH
         if move_time_limit_s > 0:
             max_depth = 16
+        max_depth = min(max_depth, MAX_PLY-1)
+        start_depth = min(start_depth, max_depth)
+        # loaded before the clock starts
+        self.load_bitbases()
         id_start_time_s = time.time() 
-        pv = []
-        stats = None
-        for depth_to_go in [n+1 for n in range(max_depth)]:
-            stats = SearchStats(depth_to_go, self.MAX_QDEPTH)
+        self.search_deadline_s = 0
+        if hard_time_limit_s > 0:
+            self.search_deadline_s = id_start_time_s + hard_time_limit_s
+        self.can_abort = False
+        self.n_id_nodes = 0
+        self.id_depth = 0
+        self.id_pv = []
+        self.root_move_nodes = {}
+        self.multi_pv_lines = []
+        self.evaluator.reset(self.board)
+        self.id_mate_moves = 0
+        if self.MATE_SEARCH_NODES > 0 and self.MULTI_PV <= 1 and mate_search.is_sharp(self.board):
+            mate_searcher = mate_search.MateSearch(self.board, max_nodes=self.MATE_SEARCH_NODES, stop_check=self.mate_search_stop_check)
+            mate = mate_searcher.find_mate(self.MATE_SEARCH_MAX_MOVES)
+            if mate != None and mate[1]:
+                return self.mate_search_result(mate, mate_searcher.n_nodes, id_start_time_s)
+        # stopped before the first iteration completed
+        engine_move, val, pv, stats = None, 0, [], None
+        for depth_to_go in range(start_depth, max_depth+1):
+            iteration_stats = SearchStats(depth_to_go, self.MAX_QDEPTH)
+            self.next_root_move_nodes = {}
             depth_start_time_s = time.time()
-            # engine_move, val, rpv = self.alphabeta(stats, pv, 0, depth_to_go)
-            engine_move, val, rpv = self.principal_variation_search(stats, pv, 0, depth_to_go)
+            board_depth = len(self.board.move_stack)
+            fen4s = set(self.fen4s)
+            n_qtt_evictions = self.qtt.n_evictions
+            try:
+                lines = self.search_root_lines(iteration_stats, depth_to_go)
+            except SearchAborted:
+                # unwind the partial search and keep the result of the last completed iteration
+                while len(self.board.move_stack) > board_depth:
+                    self.board.pop()
+                self.evaluator.reset(self.board)
+                self.fen4s = fen4s
+                # multi_pv_search() points id_pv at each root move's previous line
+                self.id_pv = pv
+                if self.VERBOSE:
+                    print("    depth %d aborted after %d nodes" % (depth_to_go, self.n_id_nodes + iteration_stats.n_nodes + iteration_stats.n_qnodes))
+                break
+            engine_move, val, pv = lines[0]
+            stats = iteration_stats
+            stats.n_qtt_evictions = self.qtt.n_evictions - n_qtt_evictions
+            self.multi_pv_lines = lines
+            self.id_pv = pv
+            self.root_move_nodes = self.next_root_move_nodes
+            self.id_depth = depth_to_go
+            self.n_id_nodes += stats.n_nodes + stats.n_qnodes
+            # only the first iteration is guaranteed to complete
+            self.can_abort = True
             depth_end_time_s = time.time()
             depth_elapsed_time_s = depth_end_time_s - depth_start_time_s
-            pv = rpv[::-1]
-            move_san = self.board.san(engine_move)
-            print("    depth %d %.3fs %s eval %d cp %s" % (depth_to_go, depth_elapsed_time_s, move_san, val, move_list_to_sans(self.board, pv)))
-            print("                                        nodes %d wins %d draws %d leaves %d pvs %d cuts %d alls %d nodes by depth: %s" % (stats.n_nodes, stats.n_win_nodes, stats.n_draw_nodes, stats.n_leaf_nodes, stats.n_pv_nodes, stats.n_cut_nodes, stats.n_all_nodes, " ".join([str(n) for n in stats.n_depth_nodes])))
-            print("                                        cut nodes nodes by depth: %s" % (" ".join(["%d/%d" % (stats.n_depth_cut_nodes[i], stats.n_depth_cut_siblings[i]) for i in range(len(stats.n_depth_cut_nodes))])))
-            print("                                        qnodes %d qpats %d qtts %d qttubs %d qttlbs %d qttxs %d qcuts %d qnodes by depth %s" % (stats.n_qnodes, stats.n_qpat_nodes, stats.n_qtt_hits, stats.n_qtt_ub_hits, stats.n_qtt_lb_hits, stats.n_qtt_exact_hits, stats.n_qcut_nodes, " ".join([str(n) for n in stats.n_qdepth_nodes])))
             id_elapsed_time_s = depth_end_time_s - id_start_time_s
-            print("                                                               id time limit is %.3fs - elapsed time is %.3fs" % (move_time_limit_s, id_elapsed_time_s))
+            if self.VERBOSE:
+                move_san = self.board.san(engine_move)
+                print("    depth %d %.3fs %s eval %d cp %s" % (depth_to_go, depth_elapsed_time_s, move_san, val, move_list_to_sans(self.board, pv)))
+                for line_no in range(1, len(lines)):
+                    line_move, line_val, line_pv = lines[line_no]
+                    print("        line %d %s eval %d cp %s" % (line_no+1, self.board.san(line_move), line_val, move_list_to_sans(self.board, line_pv)))
+                print("                                        nodes %d wins %d draws %d leaves %d pvs %d cuts %d alls %d iids %d nodes by depth: %s" % (stats.n_nodes, stats.n_win_nodes, stats.n_draw_nodes, stats.n_leaf_nodes, stats.n_pv_nodes, stats.n_cut_nodes, stats.n_all_nodes, stats.n_iid_searches, " ".join([str(n) for n in stats.n_depth_nodes])))
+                print("                                        cut nodes nodes by depth: %s" % (" ".join(["%d/%d" % (stats.n_depth_cut_nodes[i], stats.n_depth_cut_siblings[i]) for i in range(len(stats.n_depth_cut_nodes))])))
+                print("                                        qnodes %d qpats %d qtts %d qttubs %d qttlbs %d qttxs %d qttmisses %d qttevictions %d qcuts %d qnodes by depth %s" % (stats.n_qnodes, stats.n_qpat_nodes, stats.n_qtt_hits, stats.n_qtt_ub_hits, stats.n_qtt_lb_hits, stats.n_qtt_exact_hits, stats.n_qtt_misses, stats.n_qtt_evictions, stats.n_qcut_nodes, " ".join([str(n) for n in stats.n_qdepth_nodes])))
+                print("                                        eval cache hits %d misses %d move cache hits %d misses %d bitbase hits %d" % (stats.n_eval_cache_hits, stats.n_eval_cache_misses, stats.n_move_cache_hits, stats.n_move_cache_misses, stats.n_bitbase_hits))
+                print("                                                               id time limit is %.3fs - elapsed time is %.3fs" % (move_time_limit_s, id_elapsed_time_s))
+            if self.info_callback != None:
+                self.info_callback(self.iteration_info(depth_to_go, id_elapsed_time_s))
             if move_time_limit_s > 0 and id_elapsed_time_s >= move_time_limit_s:
                 break
-        print()
-        return engine_move, val, rpv, stats
+            if self.MAX_NODES > 0 and self.n_id_nodes >= self.MAX_NODES:
+                break
+        self.can_abort = False
+        if self.VERBOSE:
+            print()
+        return engine_move, val, pv, stats
         
-    def quiesce_alphabeta(self, stats, depth_from_qroot, val, alpha = -evaluate.INFINITY_VAL, beta = evaluate.INFINITY_VAL, pos_fen4 = None):
+    # The mate search's stop_check - the engine's own and the hard time limit
+    def mate_search_stop_check(self):
+        if self.stop_check != None and self.stop_check():
+            return True
+        return self.search_deadline_s > 0 and time.time() >= self.search_deadline_s
+
+    # The iterative deepening search result for a mate found by the mate search - in place of the
+    #   main search
+    def mate_search_result(self, mate, n_nodes, id_start_time_s):
+        n_moves, pv = mate
+        val = evaluate.CHECKMATE_VAL
+        self.id_mate_moves = n_moves
+        self.id_pv = pv
+        self.id_depth = len(pv)
+        self.multi_pv_lines = [(pv[0], val, pv)]
+        self.n_id_nodes = n_nodes
+        stats = SearchStats(len(pv), self.MAX_QDEPTH)
+        stats.n_nodes = n_nodes
+        id_elapsed_time_s = time.time() - id_start_time_s
+        if self.VERBOSE:
+            print("    mate in %d found by the mate search - %d nodes %.3fs %s" % (n_moves, n_nodes, id_elapsed_time_s, move_list_to_sans(self.board, pv)))
+            print()
+        if self.info_callback != None:
+            self.info_callback(self.iteration_info(self.id_depth, id_elapsed_time_s))
+        return pv[0], val, pv, stats
+
+    def iteration_info(self, depth, elapsed_time_s):
+        info = {
+            "depth": depth,
+            "score_cp": self.multi_pv_lines[0][1],
+            "pv": [move.uci() for move in self.id_pv],
+            "nodes": self.n_id_nodes,
+            "time_s": round(elapsed_time_s, 4),
+        }
+        if self.id_mate_moves > 0:
+            info["mate"] = self.id_mate_moves
+        if self.MULTI_PV > 1:
+            info["lines"] = [{"move": line_move.uci(), "score_cp": line_val, "pv": [move.uci() for move in line_pv]} for line_move, line_val, line_pv in self.multi_pv_lines]
+        return info
+
+    # Returns (move, val, pv) for each of the best MULTI_PV root moves, best first
+    def search_root_lines(self, stats, depth_to_go):
+        if self.MULTI_PV <= 1:
+            if self.SEARCH_DRIVER == MTDF_DRIVER:
+                return [self.mtdf(stats, depth_to_go)]
+            if self.SEARCH_DRIVER == ALPHABETA_DRIVER:
+                root_move, root_val = self.alphabeta(stats, True, 0, depth_to_go)
+            else:
+                root_move, root_val = self.principal_variation_search(stats, True, 0, depth_to_go)
+            return [(root_move, root_val, self.root_pv())]
+        return self.multi_pv_search(stats, depth_to_go)
+
+    # MTD(f) - converge on the root value with zero-window searches, each failing high or low
+    #   around the current guess, starting from the previous iteration's value (the static eval
+    #   on the first iteration). The bound TT makes the re-searches cheap.
+    # Returns (move, val, pv) - the PV is followed through the bound TT.
+    def mtdf(self, stats, depth_to_go):
+        if self.multi_pv_lines:
+            guess = self.multi_pv_lines[0][1]
+        else:
+            guess = self.static_eval() * [-1, 1][self.board.turn]
+        lower = -evaluate.INFINITY_VAL
+        upper = evaluate.INFINITY_VAL
+        root_move = None
+        while lower < upper:
+            beta = guess + 1 if guess == lower else guess
+            stats.n_mtdf_passes += 1
+            best_move, guess = self.mtdf_zero_window_search(stats, True, 0, depth_to_go, beta)
+            if guess < beta:
+                upper = guess
+            else:
+                lower = guess
+                # a fail high proves the move at least as good as the value converged on
+                root_move = best_move
+            if root_move == None:
+                root_move = best_move
+        return root_move, guess, self.mtdf_pv(root_move, depth_to_go)
+
+    # PV from the root move on, following the bound TT's best moves
+    def mtdf_pv(self, root_move, depth_to_go):
+        board = self.board
+        pv = [root_move]
+        board.push(root_move)
+        depth_to_go -= 1
+        while depth_to_go > 0:
+            entry = self.mtdf_tt.peek(hash((position_key(board), depth_to_go)))
+            if entry == None or entry.move == None or not board.is_legal(entry.move):
+                break
+            pv.append(entry.move)
+            board.push(entry.move)
+            depth_to_go -= 1
+        for move in pv:
+            board.pop()
+        return pv
+
+    # Multi-PV root search - one pass over the root moves keeping the best MULTI_PV lines
+    # Until MULTI_PV lines have been found each move gets a full window; after that a null window
+    #   search at the value of the worst line decides whether a move needs an exact (full window)
+    #   value to displace it. The root moves of the previous iteration's lines go first, in rank
+    #   order, and each follows its own previous line.
+    def multi_pv_search(self, stats, depth_to_go):
+        stats.n_nodes += 1
+        stats.n_depth_nodes[0] += 1
+        self.pv_length[0] = 0
+
+        moves = self.move_buffers[0]
+        moves.clear()
+        moves.extend(self.board.legal_moves)
+
+        if not moves:
+            if self.board.is_check():
+                return [(None, -evaluate.CHECKMATE_VAL, [])]
+            return [(None, evaluate.DRAW_VAL, [])]
+
+        pos_fen4 = fen4(self.board)
+        tt_move = self.tt.get(pos_fen4)
+
+        prev_line_pvs = {}
+        for line_move, line_val, line_pv in self.multi_pv_lines:
+            prev_line_pvs[line_move] = line_pv
+
+        if self.DO_SEARCH_MOVE_SORT:
+            self.sort_pv_move = None
+            self.sort_tt_move = tt_move
+            moves.sort(key=self.search_sort_key, reverse=True)
+        prev_line_moves = [line[0] for line in self.multi_pv_lines]
+        moves.sort(key=lambda move: prev_line_moves.index(move) if move in prev_line_pvs else len(prev_line_moves))
+
+        lines = []
+        for move in moves:
+            self.id_pv = prev_line_pvs.get(move, [])
+            child_on_pv = len(self.id_pv) != 0
+
+            self.evaluator.push(self.board, move)
+            self.board.push(move)
+
+            if len(lines) < self.MULTI_PV:
+                alpha = -evaluate.INFINITY_VAL
+                probe_eval = alpha + 1
+            else:
+                alpha = lines[-1][1]
+                # Null window search to see if this move beats the worst line
+                child_best_move, child_eval = self.principal_variation_search(stats, child_on_pv, 1, depth_to_go-1, -(alpha+1), -alpha)
+                probe_eval = -child_eval
+
+            if alpha < probe_eval:
+                # Full window search for the exact value of a new line
+                child_best_move, child_eval = self.principal_variation_search(stats, child_on_pv, 1, depth_to_go-1, -evaluate.INFINITY_VAL, -alpha)
+                move_eval = -child_eval
+                if alpha < move_eval:
+                    self.update_pv(0, move)
+                    lines.append((move, move_eval, self.root_pv()))
+                    lines.sort(key=lambda line: line[1], reverse=True)
+                    del lines[self.MULTI_PV:]
+
+            self.board.pop()
+            self.evaluator.pop()
+
+        if lines:
+            self.tt[pos_fen4] = lines[0][0]
+            stats.n_pv_nodes += 1
+        return lines
+
+    # Quiescence value of a node not in check without a legal capture or promotion - the stand-pat
+    #   val, unless there's no legal move at all
+    def quiesce_no_legal_qmoves(self, val, qtt_entry, position_moves):
+        if position_moves.probe_has_legal_move(self.board):
+            return val
+        # stalemate
+        if qtt_entry != None:
+            qtt_entry.lb = evaluate.DRAW_VAL
+            qtt_entry.ub = evaluate.DRAW_VAL
+        return evaluate.DRAW_VAL
+
+    def quiesce_alphabeta(self, stats, depth_from_qroot, val, alpha = -evaluate.INFINITY_VAL, beta = evaluate.INFINITY_VAL, pos_key = None):
 
         stats.n_qnodes += 1
         stats.n_qdepth_nodes[depth_from_qroot] += 1
 
+        bitbase_val = self.probe_bitbases(stats)
+        if bitbase_val != None:
+            return bitbase_val
+
         orig_alpha = alpha
 
         # If in check then stand pat is invalid and we consider all moves; not just captures/promos
@@ -156,23 +713,26 @@ class Engine:
             # print("                        %s %s val %d alpha %d beta %d check %s MAX DEPTH return %d" % ("  " * depth_from_qroot, self.board.fen(), val, orig_alpha, beta, str(is_check), val))
             return val
 
+        if pos_key == None:
+            pos_key = position_key(self.board)
+
+        qtt_entry = None
         if self.USE_QTT:
-            if pos_fen4 == None:
-                pos_fen4 = fen4(self.board)
-            
-            if pos_fen4 in self.qtt:
+            qtt_key = hash((pos_key, val))
+            qtt_entry = self.qtt.get(qtt_key)
+            if qtt_entry != None:
                 stats.n_qtt_hits += 1
-                qtt_entry = self.qtt[pos_fen4]
                 # print("qtt (%d, %d) " % (qtt_entry.lb, qtt_entry.ub), end='')
             else:
+                stats.n_qtt_misses += 1
                 qtt_entry = tt.TTEntry()
-                self.qtt[pos_fen4] = qtt_entry
+                self.qtt.put(qtt_key, qtt_entry)
 
                 # qtt_best_eval = None
                 # qtt_best_move = None
         
-            qtt_lb = qtt_entry.lb_delta + val
-            qtt_ub = qtt_entry.ub_delta + val
+            qtt_lb = qtt_entry.lb
+            qtt_ub = qtt_entry.ub
             if qtt_ub <= orig_alpha:
                 stats.n_qtt_ub_hits += 1
                 # qtt_best_eval = qtt_ub
@@ -192,64 +752,53 @@ class Engine:
                 return qtt_lb
             
 
-        moves = list(self.board.legal_moves)
+        # All moves when in check; otherwise just captures and promotions - with their static val
+        #   deltas, sorted, and when pseudo-legal checked for legality as they're tried
+        position_moves = self.position_moves(stats, pos_key)
+        if position_moves.qmoves == None:
+            position_moves.gen_qmoves(self.board, is_check, self.PSEUDO_LEGAL, self.DO_QSEARCH_MOVE_SORT)
         
         # if there are no legal moves then this is checkmate or stalemate
-        if not moves:
+        if position_moves.q_no_legal_moves:
             if is_check:
-                # relative to (static) val for QTT consistency
-                best_eval = val - evaluate.CHECKMATE_VAL
+                best_eval = -evaluate.CHECKMATE_VAL
             else:
-                # relative to (static) val for QTT consistency - we really want 0 here but doesn't work with QTT and should be an edge case
-                best_eval = val + evaluate.DRAW_VAL
+                best_eval = evaluate.DRAW_VAL
 
             if self.USE_QTT:
-                qtt_entry.lb_delta = best_eval - val
-                qtt_entry.ub_delta = best_eval - val
+                qtt_entry.lb = best_eval
+                qtt_entry.ub = best_eval
 
             # print("                        %s %s val %d alpha %d beta %d check %s c/smate return %d" % ("  " * depth_from_qroot, self.board.fen(), val, orig_alpha, beta, str(is_check), best_eval))
             return best_eval
 
-        if is_check:
-            # evaluate all moves when in check
-            qmoves = moves
-        else:
-            # ... otherwise just captures and promotions
-            qmoves = [move for move in moves if self.board.is_capture(move) or move.promotion != None]
-
-            if not qmoves:
-                # no captures possible
-                # print("                        %s %s val %d alpha %d beta %d check %s  no captures return %d" % ("  " * depth_from_qroot, self.board.fen(), val, orig_alpha, beta, str(is_check), val))
-                return val
-        
-        if self.DO_QSEARCH_MOVE_SORT:
-            qmoves.sort(key=lambda move: search_move_sort_key(self.board, move), reverse=True)
+        qmoves = position_moves.qmoves
+        check_legality = position_moves.q_check_legality
+        if not qmoves:
+            # no captures possible
+            # print("                        %s %s val %d alpha %d beta %d check %s  no captures return %d" % ("  " * depth_from_qroot, self.board.fen(), val, orig_alpha, beta, str(is_check), val))
+            if check_legality:
+                return self.quiesce_no_legal_qmoves(val, qtt_entry, position_moves)
+            return val
 
         move_no = 0
-        for move in qmoves:
+        n_legal_qmoves = 0
+        for packed_move in qmoves:
+            move = unpack_move(packed_move)
+            static_move_val = val + packed_move_val_delta(packed_move)
 
-            promo_piece_val = 0
-            if move.promotion != None:
-                # replace a pawn with the promo piece
-                promo_piece_val = evaluate.PIECE_VALS[chess.WHITE][move.promotion] - evaluate.PIECE_VALS[chess.WHITE][chess.PAWN]
-            
-            if self.board.is_capture(move):
-                captured_piece_type = self.board.piece_type_at(move.to_square)
-                if self.board.is_en_passant(move):
-                    captured_piece_type = chess.PAWN
-                static_move_val = val + evaluate.PIECE_VALS[chess.WHITE][captured_piece_type]
-            else:
-                static_move_val = val
-
-            static_move_val += promo_piece_val
+            self.board.push(move)
+            if check_legality and self.board.was_into_check():
+                self.board.pop()
+                continue
+            n_legal_qmoves += 1
 
             move_eval = static_move_val
             if depth_from_qroot+1 < self.MAX_QDEPTH:
-                self.board.push(move)
                 move_eval = -self.quiesce_alphabeta(stats, depth_from_qroot+1, -static_move_val, -beta, -alpha)
-                self.board.pop()
             else:
                 stats.n_qdepth_nodes[self.MAX_QDEPTH] += 1
+            self.board.pop()
 
             if best_eval < move_eval:
                 best_eval = move_eval
@@ -268,53 +817,70 @@ class Engine:
 
             move_no += 1
 
+        if check_legality and n_legal_qmoves == 0:
+            return self.quiesce_no_legal_qmoves(val, qtt_entry, position_moves)
+
         # if qtt_best_eval != None and qtt_best_eval != best_eval:
         #     print("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!! bingo bongo bango !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
         #     print("board fen %s qt-entry (%d, %d, %s) -> qtt_best_eval %d orig_alpha %d beta %d val %d alpha %d best_eval %d best_move %s move_no %d qmoves %s" % (pos_fen4, qtt_entry.lb, qtt_entry.ub, str(qtt_entry.move), qtt_best_eval, orig_alpha, beta, val, alpha, best_eval, str(best_move), move_no, str(qmoves)))
 
         if self.USE_QTT:
-            best_eval_delta = best_eval - val
             if best_eval <= orig_alpha:
                 # All-node: we don't get a good idea of the best move
                 node_type = "all"
-                if best_eval_delta < qtt_entry.ub_delta:
-                    qtt_entry.ub_delta = best_eval_delta
+                if best_eval < qtt_entry.ub:
+                    qtt_entry.ub = best_eval
 
             else:
                 if beta <= best_eval:
                     # Cut node
                     node_type = "cut"
                     stats.n_qcut_nodes += 1
-                    if qtt_entry.lb_delta < best_eval_delta:
+                    if qtt_entry.lb < best_eval:
                         qtt_entry.move = best_move
-                        qtt_entry.lb_delta = best_eval_delta
+                        qtt_entry.lb = best_eval
 
                 else:
                     # Pv-node - this is an exact value
                     node_type = "pv"
-                    qtt_entry.lb_delta = best_eval_delta
-                    qtt_entry.ub_delta = best_eval_delta
+                    qtt_entry.lb = best_eval
+                    qtt_entry.ub = best_eval
                     qtt_entry.move = best_move
 
         # print("                        %s %s val %d alpha %d beta %d check %s %s return %d" % ("  " * depth_from_qroot, self.board.fen(), val, orig_alpha, beta, str(is_check), node_type, best_eval))
         return best_eval
 
-    def alphabeta(self, stats, pv, depth_from_root, depth_to_go, alpha = -evaluate.INFINITY_VAL, beta = evaluate.INFINITY_VAL):
+    def alphabeta(self, stats, on_pv, depth_from_root, depth_to_go, alpha = -evaluate.INFINITY_VAL, beta = evaluate.INFINITY_VAL):
         stats.n_nodes += 1
         stats.n_depth_nodes[depth_from_root] += 1
+        if (stats.n_nodes & ABORT_CHECK_NODES_MASK) == 0:
+            self.check_abort(stats)
 
-        moves = list(self.board.legal_moves)
+        self.pv_length[depth_from_root] = depth_from_root
+
+        pos_key = position_key(self.board)
+        if depth_to_go == 0:
+            # a leaf only needs to know whether there is a legal move - and most are cut by the
+            #   quiescence stand-pat without generating moves, so they don't get a move cache entry
+            has_moves = self.has_legal_move(pos_key)
+        else:
+            position_moves = self.position_moves(stats, pos_key)
+            if position_moves.search_moves == None:
+                position_moves.gen_search_moves(self.board, self.PSEUDO_LEGAL, self.DO_SEARCH_MOVE_SORT)
+            has_moves = len(position_moves.search_moves) != 0
         
         # if there are no legal moves then this is checkmate or stalemate
-        if not moves:
+        # With pseudo-legal moves this only catches positions without any; the others are caught
+        #   after the move loop when no move turned out to be legal.
+        if not has_moves:
             if self.board.is_check():
                 stats.n_win_nodes += 1
                 # print("  %s AB %s alpha %d beta %d checkmate return %d" % ("  " * depth_from_root, self.board.fen(), alpha, beta, -evaluate.CHECKMATE_VAL))
-                return None, -evaluate.CHECKMATE_VAL, []
+                return None, -evaluate.CHECKMATE_VAL
             else:
                 stats.n_draw_nodes += 1
                 # print("  %s AB %s alpha %d beta %d stalemate return %d" % ("  " * depth_from_root, self.board.fen(), alpha, beta, evaluate.DRAW_VAL))
-                return None, evaluate.DRAW_VAL, []
+                return None, evaluate.DRAW_VAL
         
         pos_fen4 = fen4(self.board)
         
@@ -322,21 +888,25 @@ class Engine:
             # TODO draw-rep nodes
             stats.n_draw_nodes += 1
             # print("  %s AB %s alpha %d beta %d repetition return %d" % ("  " * depth_from_root, self.board.fen(), alpha, beta, evaluate.DRAW_VAL))
-            return None, evaluate.DRAW_VAL, []
+            return None, evaluate.DRAW_VAL
+
+        if depth_from_root != 0:
+            bitbase_val = self.probe_bitbases(stats)
+            if bitbase_val != None:
+                return None, bitbase_val
 
         if depth_to_go == 0:
             stats.n_leaf_nodes += 1
-            val = self.static_eval() * [-1, 1][self.board.turn]
-            qval = self.quiesce_alphabeta(stats, 0, val, alpha, beta, pos_fen4)
+            val = self.leaf_static_eval(stats, pos_key) * [-1, 1][self.board.turn]
+            qval = self.quiesce_alphabeta(stats, 0, val, alpha, beta, pos_key)
             # print("  %s AB %s alpha %d beta %d quiesce return %d" % ("  " * depth_from_root, self.board.fen(), alpha, beta, qval))
-            return None, qval, []
+            return None, qval
 
         if depth_from_root != 0:
             self.fen4s.add(pos_fen4)
 
         best_move = None
         best_eval = -evaluate.INFINITY_VAL
-        best_rpv = []
 
         orig_alpha = alpha
 
@@ -345,23 +915,30 @@ class Engine:
             tt_move = self.tt[pos_fen4]
         
         pv_move = None
-        child_pv = []
-        if pv:
-            pv_move = pv[0]
+        if on_pv and depth_from_root < len(self.id_pv):
+            pv_move = self.id_pv[depth_from_root]
 
+        # packed moves - pseudo-legal ones are checked for legality when they're tried
+        moves = self.move_buffers[depth_from_root]
+        moves.clear()
         if self.DO_SEARCH_MOVE_SORT:
-            moves.sort(key=lambda move: search_move_sort_key(self.board, move, pv_move, tt_move), reverse=True)
+            position_moves.order_search_moves(moves, pv_move, tt_move)
+        else:
+            moves.extend(position_moves.search_moves)
+        check_legality = position_moves.search_check_legality
 
         move_no = 0
-        for move in moves:
-            if move == pv_move:
-                child_pv = pv[1:]
-            else:
-                child_pv = []
-                
+        for packed_move in moves:
+            move = unpack_move(packed_move)
+            self.evaluator.push(self.board, move)
             self.board.push(move)
-            child_best_move, child_eval, child_rpv = self.alphabeta(stats, child_pv, depth_from_root+1, depth_to_go-1, -beta, -alpha)
+            if check_legality and self.board.was_into_check():
+                self.board.pop()
+                self.evaluator.pop()
+                continue
+            child_best_move, child_eval = self.alphabeta(stats, on_pv and move == pv_move, depth_from_root+1, depth_to_go-1, -beta, -alpha)
             self.board.pop()
+            self.evaluator.pop()
 
             move_eval = -child_eval
 
@@ -372,8 +949,7 @@ class Engine:
                 if beta <= move_eval:
                     break
                 
-                child_rpv.append(move)
-                best_rpv = child_rpv
+                self.update_pv(depth_from_root, move)
 
             if alpha < move_eval:
                 alpha = move_eval
@@ -383,6 +959,11 @@ class Engine:
         if depth_from_root != 0:
             self.fen4s.remove(pos_fen4)
 
+        # no legal move was tried - stalemate, since the moves in check are all legal
+        if best_move == None:
+            stats.n_draw_nodes += 1
+            return None, evaluate.DRAW_VAL
+
         if beta <= best_eval:
             stats.n_cut_nodes += 1
             stats.n_depth_cut_nodes[depth_from_root] += 1
@@ -397,80 +978,133 @@ class Engine:
             self.tt[pos_fen4] = best_move
             
         # print("  %s AB %s alpha %d beta %d recurse return %d" % ("  " * depth_from_root, self.board.fen(), orig_alpha, beta, best_eval))
-        return best_move, best_eval, best_rpv
+        return best_move, best_eval
             
-    def principal_variation_search(self, stats, pv, depth_from_root, depth_to_go, alpha = -evaluate.INFINITY_VAL, beta = evaluate.INFINITY_VAL):
+    # Returns (best_move, best_eval) - the PV from this node is left in self.pv_table[depth_from_root]
+    # on_pv is True iff all moves to this node follow the previous iteration's PV
+    # cut_node is True at the nodes expected to fail high - the zero-window children of PV nodes
+    #   and, alternately with the expected all nodes, their descendants
+    def principal_variation_search(self, stats, on_pv, depth_from_root, depth_to_go, alpha = -evaluate.INFINITY_VAL, beta = evaluate.INFINITY_VAL, cut_node = False):
         stats.n_nodes += 1
         stats.n_depth_nodes[depth_from_root] += 1
+        if (stats.n_nodes & ABORT_CHECK_NODES_MASK) == 0:
+            self.check_abort(stats)
 
-        moves = list(self.board.legal_moves)
+        self.pv_length[depth_from_root] = depth_from_root
+
+        pos_key = position_key(self.board)
+        if depth_to_go == 0:
+            # a leaf only needs to know whether there is a legal move - and most are cut by the
+            #   quiescence stand-pat without generating moves, so they don't get a move cache entry
+            has_moves = self.has_legal_move(pos_key)
+        else:
+            position_moves = self.position_moves(stats, pos_key)
+            if position_moves.search_moves == None:
+                position_moves.gen_search_moves(self.board, self.PSEUDO_LEGAL, self.DO_SEARCH_MOVE_SORT)
+            has_moves = len(position_moves.search_moves) != 0
         
         # if there are no legal moves then this is checkmate or stalemate
-        if not moves:
+        # With pseudo-legal moves this only catches positions without any; the others are caught
+        #   after the move loop when no move turned out to be legal.
+        if not has_moves:
             if self.board.is_check():
                 stats.n_win_nodes += 1
-                return None, -evaluate.CHECKMATE_VAL, []
+                return None, -evaluate.CHECKMATE_VAL
             else:
                 stats.n_draw_nodes += 1
-                return None, evaluate.DRAW_VAL, []
+                return None, evaluate.DRAW_VAL
         
         pos_fen4 = fen4(self.board)
         
         if depth_from_root != 0 and pos_fen4 in self.fen4s:
             # TODO draw-rep nodes
             stats.n_draw_nodes += 1
-            return None, evaluate.DRAW_VAL, []
+            return None, evaluate.DRAW_VAL
+
+        if depth_from_root != 0:
+            bitbase_val = self.probe_bitbases(stats)
+            if bitbase_val != None:
+                return None, bitbase_val
 
         if depth_to_go == 0:
             stats.n_leaf_nodes += 1
-            val = self.static_eval() * [-1, 1][self.board.turn]
-            qval = self.quiesce_alphabeta(stats, 0, val, alpha, beta, pos_fen4)
-            return None, qval, []
+            val = self.leaf_static_eval(stats, pos_key) * [-1, 1][self.board.turn]
+            qval = self.quiesce_alphabeta(stats, 0, val, alpha, beta, pos_key)
+            return None, qval
+
+        is_pv_node = alpha + 1 < beta
+
+        tt_move = None
+        if pos_fen4 in self.tt:
+            tt_move = self.tt[pos_fen4]
+        
+        pv_move = None
+        if on_pv and depth_from_root < len(self.id_pv):
+            pv_move = self.id_pv[depth_from_root]
+
+        # Internal iterative deepening - a shallower search of this node for a move to try first
+        # Done before this position goes into fen4s, which would make it a repetition of itself.
+        if tt_move == None and pv_move == None and (is_pv_node or cut_node) and self.IID_MIN_DEPTH > 0 and depth_to_go >= self.IID_MIN_DEPTH and self.DO_SEARCH_MOVE_SORT:
+            stats.n_iid_searches += 1
+            tt_move, iid_eval = self.principal_variation_search(stats, False, depth_from_root, depth_to_go - IID_REDUCTION, alpha, beta, cut_node)
+            self.pv_length[depth_from_root] = depth_from_root
 
         if depth_from_root != 0:
             self.fen4s.add(pos_fen4)
 
         best_move = None
         best_eval = -evaluate.INFINITY_VAL
-        best_rpv = []
 
         orig_alpha = alpha
 
-        tt_move = None
-        if pos_fen4 in self.tt:
-            tt_move = self.tt[pos_fen4]
-        
-        pv_move = None
-        child_pv = []
-        if pv:
-            pv_move = pv[0]
-
+        # packed moves - pseudo-legal ones are checked for legality when they're tried
+        moves = self.move_buffers[depth_from_root]
+        moves.clear()
         if self.DO_SEARCH_MOVE_SORT:
-            moves.sort(key=lambda move: search_move_sort_key(self.board, move, pv_move, tt_move), reverse=True)
+            position_moves.order_search_moves(moves, pv_move, tt_move)
+            if depth_from_root == 0 and self.ROOT_NODE_ORDER and self.root_move_nodes:
+                self.order_root_moves(moves, pv_move)
+        else:
+            moves.extend(position_moves.search_moves)
+        check_legality = position_moves.search_check_legality
+
+        # the zero-window children of a PV node are expected cut nodes; below those cut and all
+        #   nodes alternate
+        nws_child_cut_node = is_pv_node or not cut_node
 
         move_no = 0
-        for move in moves:
-            if move == pv_move:
-                child_pv = pv[1:]
-            else:
-                child_pv = []
+        for packed_move in moves:
+            move = unpack_move(packed_move)
+            child_on_pv = on_pv and move == pv_move
                 
+            self.evaluator.push(self.board, move)
             self.board.push(move)
+            if check_legality and self.board.was_into_check():
+                self.board.pop()
+                self.evaluator.pop()
+                continue
+
+            if depth_from_root == 0:
+                move_start_nodes = stats.n_nodes + stats.n_qnodes
 
             skip_nws = move_no == 0 or depth_to_go <= 2
             if skip_nws:
                 probe_eval = alpha + 1
             else:
                 # Null window search to see if this will raise alpha
-                child_best_move, child_eval, child_rpv = self.principal_variation_search(stats, child_pv, depth_from_root+1, depth_to_go-1, -(alpha+1), -alpha)
+                child_best_move, child_eval = self.principal_variation_search(stats, child_on_pv, depth_from_root+1, depth_to_go-1, -(alpha+1), -alpha, nws_child_cut_node)
                 probe_eval = -child_eval
 
             if skip_nws or (alpha < probe_eval and probe_eval < beta):
                 # Full window search - raise alpha since we can and our search is currently stable
                 alpha = probe_eval - 1
-                child_best_move, child_eval, child_rpv = self.principal_variation_search(stats, child_pv, depth_from_root+1, depth_to_go-1, -beta, -alpha)
+                child_best_move, child_eval = self.principal_variation_search(stats, child_on_pv, depth_from_root+1, depth_to_go-1, -beta, -alpha, nws_child_cut_node and not is_pv_node)
                 
             self.board.pop()
+            self.evaluator.pop()
+
+            if depth_from_root == 0:
+                self.next_root_move_nodes[packed_move & PACKED_MOVE_MASK] = stats.n_nodes + stats.n_qnodes - move_start_nodes
 
             move_eval = -child_eval
 
@@ -481,8 +1115,7 @@ class Engine:
                 if beta <= move_eval:
                     break
                 
-                child_rpv.append(move)
-                best_rpv = child_rpv
+                self.update_pv(depth_from_root, move)
 
             if alpha < move_eval:
                 alpha = move_eval
@@ -492,6 +1125,11 @@ class Engine:
         if depth_from_root != 0:
             self.fen4s.remove(pos_fen4)
 
+        # no legal move was tried - stalemate, since the moves in check are all legal
+        if best_move == None:
+            stats.n_draw_nodes += 1
+            return None, evaluate.DRAW_VAL
+
         if beta <= best_eval:
             stats.n_cut_nodes += 1
             stats.n_depth_cut_nodes[depth_from_root] += 1
@@ -502,26 +1140,240 @@ class Engine:
             stats.n_all_nodes += 1
 
         # Add move to TT if it's not an all node
-        if orig_alpha < best_eval and move_no != 0:
+        if orig_alpha < best_eval:
             self.tt[pos_fen4] = best_move
             
-        return best_move, best_eval, best_rpv
+        return best_move, best_eval
             
-    def gen_move(self):
+    # Orders the root moves after the PV move by the (q)nodes of their subtrees in the previous
+    #   iteration, most first - a move that took many nodes to refute is the likeliest to become
+    #   best. Moves new to this iteration keep their place after those.
+    def order_root_moves(self, moves, pv_move):
+        root_move_nodes = self.root_move_nodes
+        first = 1 if pv_move != None else 0
+        moves[first:] = sorted(moves[first:], key=lambda packed_move: -root_move_nodes.get(packed_move & PACKED_MOVE_MASK, -1))
+
+    # Fail-soft zero-window search with the window (beta-1, beta) and a bound TT - the search of
+    #   the MTD(f) driver; otherwise as principal_variation_search()
+    def mtdf_zero_window_search(self, stats, on_pv, depth_from_root, depth_to_go, beta):
+        stats.n_nodes += 1
+        stats.n_depth_nodes[depth_from_root] += 1
+        if (stats.n_nodes & ABORT_CHECK_NODES_MASK) == 0:
+            self.check_abort(stats)
+
+        pos_key = position_key(self.board)
+        if depth_to_go == 0:
+            has_moves = self.has_legal_move(pos_key)
+        else:
+            position_moves = self.position_moves(stats, pos_key)
+            if position_moves.search_moves == None:
+                position_moves.gen_search_moves(self.board, self.PSEUDO_LEGAL, self.DO_SEARCH_MOVE_SORT)
+            has_moves = len(position_moves.search_moves) != 0
+
+        if not has_moves:
+            if self.board.is_check():
+                stats.n_win_nodes += 1
+                return None, -evaluate.CHECKMATE_VAL
+            else:
+                stats.n_draw_nodes += 1
+                return None, evaluate.DRAW_VAL
+
+        pos_fen4 = fen4(self.board)
+
+        if depth_from_root != 0 and pos_fen4 in self.fen4s:
+            stats.n_draw_nodes += 1
+            return None, evaluate.DRAW_VAL
+
+        if depth_from_root != 0:
+            bitbase_val = self.probe_bitbases(stats)
+            if bitbase_val != None:
+                return None, bitbase_val
+
+        if depth_to_go == 0:
+            stats.n_leaf_nodes += 1
+            val = self.leaf_static_eval(stats, pos_key) * [-1, 1][self.board.turn]
+            qval = self.quiesce_alphabeta(stats, 0, val, beta-1, beta, pos_key)
+            return None, qval
+
+        # the bounds decide the zero-window search unless beta is inside them - not at the root,
+        #   which needs its best move searched
+        tt_key = hash((pos_key, depth_to_go))
+        tt_entry = self.mtdf_tt.get(tt_key)
+        tt_move = None
+        if tt_entry != None:
+            if depth_from_root != 0:
+                if beta <= tt_entry.lb:
+                    stats.n_mtdf_tt_cuts += 1
+                    return tt_entry.move, tt_entry.lb
+                if tt_entry.ub < beta:
+                    stats.n_mtdf_tt_cuts += 1
+                    return tt_entry.move, tt_entry.ub
+            tt_move = tt_entry.move
+        if tt_move == None:
+            tt_move = self.tt.get(pos_fen4)
+
+        if depth_from_root != 0:
+            self.fen4s.add(pos_fen4)
+
+        best_move = None
+        best_eval = -evaluate.INFINITY_VAL
+
+        pv_move = None
+        if on_pv and depth_from_root < len(self.id_pv):
+            pv_move = self.id_pv[depth_from_root]
+
+        moves = self.move_buffers[depth_from_root]
+        moves.clear()
+        if self.DO_SEARCH_MOVE_SORT:
+            position_moves.order_search_moves(moves, pv_move, tt_move)
+        else:
+            moves.extend(position_moves.search_moves)
+        check_legality = position_moves.search_check_legality
+
+        move_no = 0
+        for packed_move in moves:
+            move = unpack_move(packed_move)
+            child_on_pv = on_pv and move == pv_move
+
+            self.evaluator.push(self.board, move)
+            self.board.push(move)
+            if check_legality and self.board.was_into_check():
+                self.board.pop()
+                self.evaluator.pop()
+                continue
+
+            child_best_move, child_eval = self.mtdf_zero_window_search(stats, child_on_pv, depth_from_root+1, depth_to_go-1, 1-beta)
+
+            self.board.pop()
+            self.evaluator.pop()
+
+            move_eval = -child_eval
+            if best_eval < move_eval:
+                best_move = move
+                best_eval = move_eval
+                if beta <= move_eval:
+                    break
+
+            move_no += 1
+
+        if depth_from_root != 0:
+            self.fen4s.remove(pos_fen4)
+
+        # no legal move was tried - stalemate, since the moves in check are all legal
+        if best_move == None:
+            stats.n_draw_nodes += 1
+            return None, evaluate.DRAW_VAL
+
+        if tt_entry == None:
+            tt_entry = tt.TTEntry(-evaluate.INFINITY_VAL, evaluate.INFINITY_VAL)
+        if beta <= best_eval:
+            stats.n_cut_nodes += 1
+            stats.n_depth_cut_nodes[depth_from_root] += 1
+            stats.n_depth_cut_siblings[depth_from_root] += move_no + 1
+            tt_entry.lb = best_eval
+            # bounds from earlier searches can contradict this one's - search instability
+            if tt_entry.ub < best_eval:
+                tt_entry.ub = evaluate.INFINITY_VAL
+        else:
+            stats.n_all_nodes += 1
+            tt_entry.ub = best_eval
+            if best_eval < tt_entry.lb:
+                tt_entry.lb = -evaluate.INFINITY_VAL
+        tt_entry.move = best_move
+        self.mtdf_tt.put(tt_key, tt_entry)
+
+        return best_move, best_eval
+
+    # Lazy SMP - the main search and n_search_threads-1 helper searches of the same root share the TT,
+    #   through which they pass each other best moves. Odd helpers start an iteration deeper so the
+    #   threads spread over the depths. The search stops once any thread has searched to the full
+    #   depth (or the main search's time is up), and the result is that of the deepest completed
+    #   iteration - the main search's on a tie.
+    def threaded_iterative_deepening(self, move_time_limit_s):
+        self.load_bitbases()
+        while len(self.helpers) < self.n_search_threads-1:
+            self.helpers.append(Engine(self.board, self.helper_config))
+        helpers = self.helpers[:self.n_search_threads-1]
+        stop_event = threading.Event()
+        results = [None] * len(helpers)
+        main_stop_check = self.stop_check
+
+        def helper_stop_check():
+            return stop_event.is_set() or (main_stop_check != None and main_stop_check())
+
+        def run_helper(i):
+            try:
+                results[i] = helpers[i].iterative_deepening(move_time_limit_s, 0, 1 + (i+1) % 2)
+            finally:
+                stop_event.set()
+
+        threads = []
+        for i in range(len(helpers)):
+            helper = helpers[i]
+            helper.set_board(self.board)
+            helper.tt = self.tt
+            helper.qtt.clear()
+            helper.bitbases = self.bitbases
+            helper.stop_check = helper_stop_check
+            threads.append(threading.Thread(target=run_helper, args=(i,), daemon=True))
+        self.stop_check = helper_stop_check
+        try:
+            for thread in threads:
+                thread.start()
+            engine_move, val, pv, stats = self.iterative_deepening(move_time_limit_s)
+        finally:
+            stop_event.set()
+            for thread in threads:
+                thread.join()
+            self.stop_check = main_stop_check
+
+        self.n_threads_nodes = self.n_id_nodes
+        best_depth = self.id_depth if engine_move != None else 0
+        for i in range(len(helpers)):
+            helper = helpers[i]
+            self.n_threads_nodes += helper.n_id_nodes
+            if results[i] != None and results[i][0] != None and helper.id_depth > best_depth:
+                engine_move, val, pv, stats = results[i]
+                best_depth = helper.id_depth
+                self.id_depth = best_depth
+                self.id_pv = pv
+                if self.MULTI_PV <= 1:
+                    self.multi_pv_lines = [(engine_move, val, pv)]
+        if self.VERBOSE:
+            print("                                                   %d threads searched %d nodes - best result from depth %d" % (self.n_search_threads, self.n_threads_nodes, best_depth))
+        return engine_move, val, pv, stats
+
+    # Clears the tables that are only kept for the current search's position
+    def clear_search_tables(self):
         # TODO - implement epoch clearing...
         self.tt_epoch += 1
         self.tt.clear()
         self.qtt.clear()
+        if self.mtdf_tt != None:
+            self.mtdf_tt.clear()
+
+    # keep_tables keeps the tables of an earlier search of the same position - a background analysis
+    #   - so the search starts warm
+    def gen_move(self, keep_tables = False):
+        if not keep_tables:
+            self.clear_search_tables()
         remaining_time_s = 0
         if self.GAME_TIME_LIMIT_S > 0:
             remaining_time_s = self.GAME_TIME_LIMIT_S - self.total_engine_time_s
         move_time_limit_s = remaining_time_s/48
         gen_move_start_s = time.time()
-        engine_move, val, rpv, stats = self.iterative_deepening(move_time_limit_s)
+        self.n_search_threads = self.THREADS if self.THREADS > 1 and gil_disabled() else 1
+        if self.n_search_threads > 1:
+            engine_move, val, pv, stats = self.threaded_iterative_deepening(move_time_limit_s)
+        else:
+            if self.THREADS > 1 and self.VERBOSE:
+                print("                                                   the GIL is enabled - searching with 1 thread instead of %d" % self.THREADS)
+            engine_move, val, pv, stats = self.iterative_deepening(move_time_limit_s)
+            self.n_threads_nodes = self.n_id_nodes
         gen_move_end_s = time.time()
         gen_move_elapsed_time_s = gen_move_end_s - gen_move_start_s
         self.total_engine_time_s += gen_move_elapsed_time_s
-        print("                                                   engine time so far %.3fs of %.3fs tt size is %d qtt size is %d" % (self.total_engine_time_s, self.GAME_TIME_LIMIT_S, len(self.tt), len(self.qtt)))
-        pv = rpv[::-1]
+        if self.VERBOSE:
+            print("                                                   engine time so far %.3fs of %.3fs tt size is %d qtt size is %d" % (self.total_engine_time_s, self.GAME_TIME_LIMIT_S, len(self.tt), len(self.qtt)))
         return engine_move, val, pv, stats
         
@@ -169,3 +169,37 @@ def static_eval(board):
     return val
 
 
+
+# Pluggable evaluators
+#
+# The engine calls reset(board) on the search root, push(board, move) before each board.push(move)
+#   and pop() after the board.pop() so that an evaluator can keep incremental state, and
+#   evaluate(board) for the White-relative eval of the current position.
+
+PST_EVALUATOR = "pst"
+NNUE_EVALUATOR = "nnue"
+
+# The material + piece-square static_eval()
+class PstEvaluator:
+    def reset(self, board):
+        pass
+
+    def push(self, board, move):
+        pass
+
+    def pop(self):
+        pass
+
+    def evaluate(self, board):
+        return static_eval(board)
+
+# weights_path is the NNUE weights file - "" for the net equivalent to static_eval()
+def make_evaluator(name, weights_path = ""):
+    if name == PST_EVALUATOR:
+        return PstEvaluator()
+    if name == NNUE_EVALUATOR:
+        # NumPy is only needed for the NNUE evaluator
+        import nnue
+        weights = nnue.load_weights(weights_path) if weights_path else nnue.make_pst_weights()
+        return nnue.NnueEvaluator(weights)
+    raise ValueError("unknown evaluator %r" % name)
@@ -1,3 +1,4 @@
+import threading
 import time
 import sys
 
@@ -7,10 +8,83 @@ from util import fen4, move_list_to_sans
 
 import evaluate
 
-from engine import Engine, SearchStats
+from engine import Engine
 
 import cProfile
 
+# Effectively no time limit - the background analysis runs until it is stopped (or reaches the
+#   iterative deepening's maximum depth)
+ANALYSIS_TIME_LIMIT_S = 24*60*60
+
+# Searches the displayed position with the side to move's engine while the human thinks, printing
+#   the eval and hint of each completed iteration. The engine's tables are left warm for its
+#   gen_move() - the engine must not be used by the game until stop() returns.
+class BackgroundAnalysis:
+    def __init__(self):
+        self.engine = None
+        self.board = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        # iteration info (see Engine.iteration_info()) of the last completed iteration
+        self.last_info = None
+        # White-relative static eval of the position by the engine's configured evaluator
+        self.static_val = 0
+
+    def is_running(self, engine, board):
+        return self.thread != None and self.engine is engine and self.board == board
+
+    def start(self, engine, board):
+        if self.is_running(engine, board):
+            return
+        self.stop()
+        self.engine = engine
+        self.board = board.copy()
+        self.last_info = None
+        self.stop_event.clear()
+        # taken before the search starts - the evaluator and board are the search's from then on
+        self.static_val = engine.static_eval()
+        engine.clear_search_tables()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread == None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        engine = self.engine
+        verbose, stop_check, info_callback = engine.VERBOSE, engine.stop_check, engine.info_callback
+        engine.VERBOSE = False
+        engine.stop_check = self.stop_event.is_set
+        engine.info_callback = self.on_info
+        try:
+            engine.iterative_deepening(ANALYSIS_TIME_LIMIT_S)
+        finally:
+            engine.VERBOSE, engine.stop_check, engine.info_callback = verbose, stop_check, info_callback
+
+    # The analysis's best move if it has already searched as deep as engine's fixed depth search
+    #   would - None for engines with a time limit, which search again on the warm tables
+    def completed_move(self, engine):
+        info = self.last_info
+        if self.engine is not engine or info == None or not info["pv"]:
+            return None
+        if engine.GAME_TIME_LIMIT_S > 0 or info["depth"] < engine.MAX_DEPTH:
+            return None
+        return chess.Move.from_uci(info["pv"][0])
+
+    def on_info(self, info):
+        self.last_info = info
+        board = self.board
+        pv = [chess.Move.from_uci(uci) for uci in info["pv"]]
+        if not pv:
+            return
+        sign = [-1, 1][board.turn]
+        print()
+        print("    analysis depth %d: eval %d cp (positive is White advantage) hint %s - %s" % (info["depth"], info["score_cp"] * sign, board.san(pv[0]), " ".join(move_list_to_sans(board, pv))))
+
 class Game:
     def __init__(self, board = chess.Board(), config_b = {"time-limit-s": 120}, config_w = {"time-limit-s": 60}):
         self.board = board
@@ -23,8 +97,14 @@ class Game:
 
         w_engine = self.engines[chess.WHITE]
         b_engine = self.engines[chess.BLACK]
+
+        analysis = BackgroundAnalysis()
         
         while True:
+            # the side to move's engine searches the position while it is shown and the human thinks
+            if not self.board.is_game_over():
+                analysis.start(self.engines[self.board.turn], self.board)
+
             legal_move_sans = [self.board.san(m) for m in self.board.legal_moves]
             
             print()
@@ -60,13 +140,11 @@ class Game:
             
             print("%s to move" % ["Black", "White"][self.board.turn])
             print()
-            w_val = w_engine.static_eval()
-            b_val = b_engine.static_eval()
-            print("Static eval   - positive is White advantage: white engine %d cp black engine %d cp" % (w_val, b_val))
-            sign = [-1, 1][w_engine.board.turn]
-            w_qval = w_engine.quiesce_alphabeta(SearchStats(1, w_engine.MAX_QDEPTH), 0, w_val * sign) * sign
-            b_qval = b_engine.quiesce_alphabeta(SearchStats(1, b_engine.MAX_QDEPTH), 0, b_val * sign) * sign
-            print("Quiesced eval - positive is White advantage: white engine %d cp black engine %d cp" % (w_qval, b_qval))
+            # the searched evals are streamed by the background analysis
+            print("Static eval - positive is White advantage: %d cp" % analysis.static_val)
+            if analysis.last_info != None:
+                sign = [-1, 1][self.board.turn]
+                print("Analysis eval so far - depth %d: %d cp" % (analysis.last_info["depth"], analysis.last_info["score_cp"] * sign))
             print()
             print("Legal moves: %s" % " ".join(legal_move_sans))
             print()
@@ -85,7 +163,13 @@ class Game:
 
             elif move_san == 'engine':
                 engine = self.engines[self.board.turn]
-                engine_move, val, pv, stats = engine.gen_move()
+                # the analysis searched this position with this engine - its tables are warm
+                analysis.stop()
+                engine_move = analysis.completed_move(engine)
+                if engine_move != None:
+                    print("Engine move from the analysis at depth %d: %s" % (analysis.last_info["depth"], self.board.san(engine_move)))
+                else:
+                    engine_move, val, pv, stats = engine.gen_move(keep_tables=True)
                 
                 move = engine_move
 
@@ -98,6 +182,7 @@ class Game:
 
                 move = self.board.parse_san(move_san)
                 
+            analysis.stop()
             self.board.push(move)
             w_engine.make_move(move)
             b_engine.make_move(move)
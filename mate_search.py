@@ -0,0 +1,258 @@
+import chess
+
+import tt
+
+from util import position_key
+
+# Mate search - depth-first proof-number (df-pn) search for forced mates
+#
+# The side to move is the attacker. Attacker nodes are OR nodes (one mating move proves them) and
+#   defender nodes are AND nodes (every defence must be mated). Each node has a proof number (pn)
+#   - a lower bound on the number of leaves that still need proving - and a disproof number (dn).
+#   The search always expands the most-proving node, going depth-first with thresholds so that
+#   it only backs up when a sibling becomes more promising; unlike alpha-beta it runs as deep as
+#   the forcing lines go instead of uniformly to the mate depth.
+#
+# mate_in(n) is depth limited - the attacker gets at most n moves - so a proof is a mate in at
+#   most n, and find_mate() tries n = 1, 2, ... so the first mate found is the shortest.
+# With checks_only the attacker only plays checks. Those trees are narrow enough that long
+#   checking mates are found quickly, so find_mate() looks for one of those first and then for
+#   a shorter mate with quiet attacker moves.
+# Proof/disproof numbers live in a bounded (CLOCK) proof table keyed by (position, plies left,
+#   checks_only), with the proven positions' distance to mate for the PV.
+
+INFINITE_PN = 1 << 30
+
+# Memory budget of the proof table
+DEFAULT_MATE_TABLE_SIZE_MB = 32
+
+# Rough memory cost of one proof table entry: the key and value tuples, the dict slot and the clock slots
+MATE_ENTRY_BYTES = 250
+
+# Initial (pn, dn, plies to mate) of an unexpanded child - attacker moves that give check are the
+#   likeliest to prove
+CHECK_CHILD_ENTRY = (1, 1, 0)
+QUIET_CHILD_ENTRY = (2, 1, 0)
+DISPROVEN_ENTRY = (INFINITE_PN, 0, 0)
+
+# How often (in nodes) the node limit and stop_check are checked
+ABORT_CHECK_NODES_MASK = 1023
+
+# The position is sharp - worth a mate search - if the side to move can give check and the
+#   opponent's king has at most this many flight squares not attacked by the side to move
+SHARP_MAX_FLIGHT_SQUARES = 2
+
+# Raised inside the mate search when its node limit is hit or stop_check() returns True
+class MateSearchAborted(Exception):
+    pass
+
+def is_sharp(board):
+    king_sq = board.king(not board.turn)
+    if king_sq == None:
+        return False
+    n_flight_squares = 0
+    for sq in chess.SquareSet(chess.BB_KING_ATTACKS[king_sq] & ~board.occupied_co[not board.turn]):
+        if not board.is_attacked_by(board.turn, sq):
+            n_flight_squares += 1
+    if n_flight_squares > SHARP_MAX_FLIGHT_SQUARES:
+        return False
+    return any(board.gives_check(move) for move in board.generate_legal_moves())
+
+class MateSearch:
+    def __init__(self, board, table_size_mb = DEFAULT_MATE_TABLE_SIZE_MB, max_nodes = 0, stop_check = None):
+        self.board = board.copy()
+        self.attacker = board.turn
+        # bounded map: (position key, plies left, checks only) -> (pn, dn, plies to mate - when proven)
+        self.table = tt.ClockCache(table_size_mb * 1024 * 1024, MATE_ENTRY_BYTES)
+        self.max_nodes = max_nodes
+        self.stop_check = stop_check
+        self.n_nodes = 0
+        self.checks_only = False
+        # position keys on the current path - for repetitions
+        self.path = set()
+
+    def check_abort(self):
+        if self.max_nodes > 0 and self.n_nodes >= self.max_nodes:
+            raise MateSearchAborted()
+        if self.stop_check != None and self.stop_check():
+            raise MateSearchAborted()
+
+    # Moves of the current position worth trying with plies_left plies to go - on the attacker's
+    #   last move only checks can mate
+    def node_moves(self, plies_left):
+        board = self.board
+        if board.turn == self.attacker and (plies_left == 1 or self.checks_only):
+            return [move for move in board.generate_legal_moves() if board.gives_check(move)]
+        return list(board.generate_legal_moves())
+
+    # (pn, dn, plies to mate) of each child: from the table, or init_entries when not yet expanded
+    def child_entries(self, child_keys, init_entries, plies_left):
+        table = self.table
+        entries = []
+        for i in range(len(child_keys)):
+            entry = None
+            if child_keys[i] != None:
+                entry = table.peek((child_keys[i], plies_left-1, self.checks_only))
+            entries.append(entry if entry != None else init_entries[i])
+        return entries
+
+    # Multiple iterative deepening (MID) - expand the current position until its pn reaches
+    #   th_pn or its dn reaches th_dn; returns (pn, dn, plies to mate)
+    def mid(self, pos_key, plies_left, th_pn, th_dn):
+        self.n_nodes += 1
+        if (self.n_nodes & ABORT_CHECK_NODES_MASK) == 0:
+            self.check_abort()
+
+        board = self.board
+        or_node = board.turn == self.attacker
+        table_key = (pos_key, plies_left, self.checks_only)
+
+        moves = self.node_moves(plies_left)
+        if not moves:
+            if not or_node and board.is_check():
+                # checkmate
+                entry = (0, INFINITE_PN, 0)
+            else:
+                # stalemate, no checks on the last move, or the attacker is mated
+                entry = DISPROVEN_ENTRY
+            self.table.put(table_key, entry)
+            return entry
+        if plies_left == 0:
+            # the defender has a move and the attacker is out of moves
+            entry = DISPROVEN_ENTRY
+            self.table.put(table_key, entry)
+            return entry
+
+        # children repeating a position of the current path are disproven (a draw)
+        child_keys = []
+        init_entries = []
+        for move in moves:
+            init_entry = QUIET_CHILD_ENTRY
+            if or_node and board.gives_check(move):
+                init_entry = CHECK_CHILD_ENTRY
+            board.push(move)
+            child_key = position_key(board)
+            board.pop()
+            if child_key in self.path:
+                child_key = None
+                init_entry = DISPROVEN_ENTRY
+            child_keys.append(child_key)
+            init_entries.append(init_entry)
+
+        self.path.add(pos_key)
+        try:
+            while True:
+                entries = self.child_entries(child_keys, init_entries, plies_left)
+                # the child numbers that are minimised - pn at OR nodes, dn at AND nodes - and summed
+                best_i = -1
+                best_num = INFINITE_PN + 1
+                second_num = INFINITE_PN
+                sum_num = 0
+                for i in range(len(entries)):
+                    if or_node:
+                        num, other_num = entries[i][0], entries[i][1]
+                    else:
+                        num, other_num = entries[i][1], entries[i][0]
+                    sum_num = min(sum_num + other_num, INFINITE_PN)
+                    if num < best_num:
+                        second_num = best_num
+                        best_num = num
+                        best_i = i
+                    elif num < second_num:
+                        second_num = num
+                second_num = min(second_num, INFINITE_PN)
+                if or_node:
+                    pn, dn = best_num, sum_num
+                else:
+                    pn, dn = sum_num, best_num
+                if pn >= th_pn or dn >= th_dn or pn == 0 or dn == 0:
+                    break
+
+                best_pn, best_dn = entries[best_i][0], entries[best_i][1]
+                if or_node:
+                    child_th_pn = min(th_pn, second_num + 1)
+                    child_th_dn = min(th_dn - dn + best_dn, INFINITE_PN)
+                else:
+                    child_th_pn = min(th_pn - pn + best_pn, INFINITE_PN)
+                    child_th_dn = min(th_dn, second_num + 1)
+                board.push(moves[best_i])
+                try:
+                    self.mid(child_keys[best_i], plies_left-1, child_th_pn, child_th_dn)
+                finally:
+                    board.pop()
+        finally:
+            self.path.discard(pos_key)
+
+        mate_plies = 0
+        if pn == 0:
+            # the attacker picks the quickest mate, the defender the longest
+            proven_plies = [entry[2] for entry in entries if entry[0] == 0]
+            mate_plies = 1 + (min(proven_plies) if or_node else max(proven_plies))
+        entry = (pn, dn, mate_plies)
+        self.table.put(table_key, entry)
+        return entry
+
+    # The mating line of a proven position - the attacker's quickest mate against the defender's
+    #   longest resistance; cut short if the proof table lost an entry on the way
+    def proof_pv(self, plies_left):
+        board = self.board
+        pv = []
+        while plies_left > 0:
+            or_node = board.turn == self.attacker
+            best_move = None
+            best_plies = 0
+            for move in self.node_moves(plies_left):
+                board.push(move)
+                entry = self.table.peek((position_key(board), plies_left-1, self.checks_only))
+                board.pop()
+                if entry == None or entry[0] != 0:
+                    if not or_node:
+                        # an unproven defence - the table has lost part of the proof
+                        best_move = None
+                        break
+                    continue
+                if best_move == None or (entry[2] < best_plies if or_node else entry[2] > best_plies):
+                    best_move = move
+                    best_plies = entry[2]
+            if best_move == None:
+                break
+            board.push(best_move)
+            pv.append(best_move)
+            plies_left -= 1
+        for move in pv:
+            board.pop()
+        return pv
+
+    # Returns the PV of a mate in at most n_moves of the attacker's moves, or None if there is none
+    # Raises MateSearchAborted when a limit is hit.
+    def mate_in(self, n_moves, checks_only = False):
+        self.checks_only = checks_only
+        plies = 2*n_moves - 1
+        pn, dn, mate_plies = self.mid(position_key(self.board), plies, INFINITE_PN, INFINITE_PN)
+        if pn != 0:
+            return None
+        return self.proof_pv(plies)
+
+    # Returns (n, PV) of the shortest mate in n <= max_moves, or None if there is none
+    # When a limit is hit first the result is the shortest mate found so far, if any - a checking
+    #   mate that may not be the shortest.
+    def find_mate(self, max_moves):
+        mate = None
+        try:
+            for n_moves in range(1, max_moves+1):
+                pv = self.mate_in(n_moves, True)
+                if pv != None:
+                    mate = (n_moves, pv)
+                    max_moves = n_moves - 1
+                    break
+            for n_moves in range(1, max_moves+1):
+                pv = self.mate_in(n_moves)
+                if pv != None:
+                    mate = (n_moves, pv)
+                    break
+        except MateSearchAborted:
+            pass
+        return mate
+
+def find_mate(board, max_moves, max_nodes = 0, table_size_mb = DEFAULT_MATE_TABLE_SIZE_MB, stop_check = None):
+    return MateSearch(board, table_size_mb, max_nodes, stop_check).find_mate(max_moves)
@@ -27,24 +27,50 @@ def search_move_sort_key(board, move, pv_move=None, tt_move=None):
 
     if DO_USE_ID_TT and move == tt_move:
         return SEARCH_MOVE_TT_MOVE
-    
-    moving_piece_type = board.piece_type_at(move.from_square)
-    is_capture = board.is_capture(move)
-    is_target_attacked = board.is_attacked_by(not board.turn, move.to_square)
 
-    moving_piece_val = evaluate.PIECE_VALS[chess.WHITE][moving_piece_type]
-    moving_piece_pp = evaluate.PIECE_POS_VALS[board.turn][moving_piece_type]
-    pp_delta = (moving_piece_pp[move.to_square] - moving_piece_pp[move.from_square]) * [-1, 1][board.turn]
+    return packed_move_sort_key(board.turn, pack_move(board, move))
 
-    promotion_piece_bonus_val = 0
-    if move.promotion != None and not is_target_attacked:
-        promotion_piece_bonus_val = evaluate.PIECE_VALS[chess.WHITE][move.promotion]
+# Packed moves - an int holding the move with the board facts that ordering and the quiescence
+#   val deltas need:
+#   bits 0-5 from square, 6-11 to square, 12-14 promotion piece type (0 for none),
+#   15-17 moving piece type, 18-20 captured piece type (pawn for ep, 0 for none),
+#   bit 21 set iff the target square is attacked by the opponent
+# Plain ints also keep the move cache free of objects that the garbage collector has to track.
+PACKED_MOVE_MASK = (1 << 15) - 1
 
-    if is_capture:
+def move_code(move):
+    return move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12)
+
+def pack_move(board, move):
+    captured_piece_type = 0
+    if board.is_capture(move):
         captured_piece_type = board.piece_type_at(move.to_square)
         if board.is_en_passant(move):
             captured_piece_type = chess.PAWN
+    is_target_attacked = board.is_attacked_by(not board.turn, move.to_square)
+    return move_code(move) | (board.piece_type_at(move.from_square) << 15) | (captured_piece_type << 18) | (is_target_attacked << 21)
+
+def unpack_move(packed_move):
+    return chess.Move(packed_move & 63, (packed_move >> 6) & 63, ((packed_move >> 12) & 7) or None)
 
+# search_move_sort_key() without the PV/TT move cases - turn is the side to move
+def packed_move_sort_key(turn, packed_move):
+    from_square = packed_move & 63
+    to_square = (packed_move >> 6) & 63
+    promotion = (packed_move >> 12) & 7
+    moving_piece_type = (packed_move >> 15) & 7
+    captured_piece_type = (packed_move >> 18) & 7
+    is_target_attacked = (packed_move >> 21) & 1
+
+    moving_piece_val = evaluate.PIECE_VALS[chess.WHITE][moving_piece_type]
+    moving_piece_pp = evaluate.PIECE_POS_VALS[turn][moving_piece_type]
+    pp_delta = (moving_piece_pp[to_square] - moving_piece_pp[from_square]) * [-1, 1][turn]
+
+    promotion_piece_bonus_val = 0
+    if promotion != 0 and not is_target_attacked:
+        promotion_piece_bonus_val = evaluate.PIECE_VALS[chess.WHITE][promotion]
+
+    if captured_piece_type != 0:
         captured_piece_val = evaluate.PIECE_VALS[chess.WHITE][captured_piece_type]
         
         gvla = (captured_piece_val << 10) - moving_piece_val
@@ -74,4 +100,104 @@ def search_move_sort_key(board, move, pv_move=None, tt_move=None):
         else:
             return SEARCH_MOVE_NON_LOSING_NON_CAPTURE_BASE + pp_delta + promotion_piece_bonus_val
 
-    
+# Material gained by move for the side to move - the captured piece plus any promotion gain
+# This is the quiescence search's incremental change of the static val.
+def static_move_val_delta(board, move):
+    return packed_move_val_delta(pack_move(board, move))
+
+def packed_move_val_delta(packed_move):
+    delta = evaluate.PIECE_VALS[chess.WHITE][(packed_move >> 18) & 7]
+    promotion = (packed_move >> 12) & 7
+    if promotion != 0:
+        # replace a pawn with the promo piece
+        delta += evaluate.PIECE_VALS[chess.WHITE][promotion] - evaluate.PIECE_VALS[chess.WHITE][chess.PAWN]
+    return delta
+
+# Rough memory cost of a PositionMoves entry in the engine's move cache, with its packed moves
+POSITION_MOVES_ENTRY_BYTES = 1000
+
+# The generated moves of a position, packed and sorted - generated once and then cached by
+#   position key so that later visits, in particular on later iterations, skip move generation,
+#   the sort keys' attack tests and the capture lookups. Each part is built on first use.
+class PositionMoves:
+    __slots__ = ("search_moves", "search_check_legality", "qmoves", "q_check_legality", "q_no_legal_moves", "has_legal_move")
+
+    def __init__(self):
+        # Packed search moves - sorted by search_move_sort_key() without the PV/TT moves when
+        #   sorting is on. With check_legality they are pseudo-legal and must be checked when
+        #   they're tried.
+        self.search_moves = None
+        self.search_check_legality = False
+
+        # Packed quiescence moves - sorted by packed_move_sort_key() when sorting is on;
+        #   q_no_legal_moves is True for checkmate/stalemate when known
+        self.qmoves = None
+        self.q_check_legality = False
+        self.q_no_legal_moves = False
+
+        # None until probed
+        self.has_legal_move = None
+
+    # When in check the evasions are generated legal since most pseudo-legal moves would be illegal
+    def gen_search_moves(self, board, pseudo_legal, do_sort):
+        if pseudo_legal and not board.is_check():
+            moves = board.generate_pseudo_legal_moves()
+            self.search_check_legality = True
+        else:
+            moves = list(board.generate_legal_moves())
+            self.has_legal_move = len(moves) != 0
+        packed_moves = [pack_move(board, move) for move in moves]
+        if do_sort:
+            turn = board.turn
+            packed_moves.sort(key=lambda packed_move: packed_move_sort_key(turn, packed_move), reverse=True)
+        self.search_moves = packed_moves
+
+    # Fill moves with the packed search moves, pv_move then tt_move first - the same order as
+    #   sorting with search_move_sort_key(board, move, pv_move, tt_move)
+    # The PV and TT moves were found in this same position, so they are among the search moves.
+    def order_search_moves(self, moves, pv_move, tt_move):
+        if tt_move == pv_move:
+            tt_move = None
+        if pv_move == None and tt_move == None:
+            moves.extend(self.search_moves)
+            return
+        pv_code = -1
+        if pv_move != None:
+            pv_code = move_code(pv_move)
+            moves.append(pv_code)
+        tt_code = -1
+        if tt_move != None:
+            tt_code = move_code(tt_move)
+            moves.append(tt_code)
+        for packed_move in self.search_moves:
+            code = packed_move & PACKED_MOVE_MASK
+            if code != pv_code and code != tt_code:
+                moves.append(packed_move)
+
+    # Quiescence moves: all legal moves when in check, otherwise captures and promotions - with
+    #   pseudo_legal, the pseudo-legal ones, generated only onto enemy pieces, the ep square and the
+    #   back ranks
+    def gen_qmoves(self, board, is_check, pseudo_legal, do_sort):
+        if is_check or not pseudo_legal:
+            moves = list(board.generate_legal_moves())
+            self.has_legal_move = len(moves) != 0
+            self.q_no_legal_moves = len(moves) == 0
+        else:
+            to_mask = board.occupied_co[not board.turn] | chess.BB_BACKRANKS
+            if board.ep_square != None:
+                to_mask |= chess.BB_SQUARES[board.ep_square]
+            moves = board.generate_pseudo_legal_moves(chess.BB_ALL, to_mask)
+            self.q_check_legality = True
+        packed_moves = [pack_move(board, move) for move in moves]
+        if not is_check:
+            # captures and promotions
+            packed_moves = [packed_move for packed_move in packed_moves if packed_move & 0x1C7000]
+        if do_sort:
+            turn = board.turn
+            packed_moves.sort(key=lambda packed_move: packed_move_sort_key(turn, packed_move), reverse=True)
+        self.qmoves = packed_moves
+
+    def probe_has_legal_move(self, board):
+        if self.has_legal_move == None:
+            self.has_legal_move = any(board.generate_legal_moves())
+        return self.has_legal_move
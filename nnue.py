@@ -0,0 +1,216 @@
+import argparse
+
+import numpy as np
+
+import chess
+
+import evaluate
+
+# NNUE-style evaluator - a small quantized net with one hidden layer over king-relative features
+#
+# Features (per perspective): (own king square, piece, piece square) with squares vertically
+#   mirrored for Black's perspective, and piece being one of the 6 own or 6 opponent piece types -
+#   64 * 12 * 64 = 49152 sparse binary features.
+# The first (feature transformer) layer maps each perspective's active features into an int16
+#   accumulator of HIDDEN_SIZE - the sum of the active features' weight rows plus bias. The
+#   accumulators are kept on a stack and updated incrementally on push()/pop() - only the rows
+#   of the pieces that moved are added/subtracted. A king move changes all of its own
+#   perspective's features, so that perspective is refreshed from scratch, lazily.
+# Output: the clipped-ReLU accumulators, side to move first, dotted with the int16 output weights,
+#   plus bias, divided by OUTPUT_SCALE - a side-to-move-relative eval in cp.
+#
+# HIDDEN_SIZE int16s is a multiple of 32 bytes and the weight rows are contiguous so that the
+#   NumPy row adds vectorize.
+
+HIDDEN_SIZE = 64
+N_PIECE_INDICES = 12
+N_FEATURES = 64 * N_PIECE_INDICES * 64
+
+# Clipped ReLU range of the accumulator values
+ACTIVATION_MAX = 255
+
+# Net parameter names and shapes in the weights file
+WEIGHTS_SHAPES = {
+    "ft_weights": (N_FEATURES, HIDDEN_SIZE),
+    "ft_bias": (HIDDEN_SIZE,),
+    "out_weights": (2 * HIDDEN_SIZE,),
+}
+
+# Search stack depth - the search never gets deeper than engine.MAX_PLY
+MAX_STACK = 128
+
+# Accumulator indices of Black's and White's perspectives - ints, since NumPy takes bools as masks
+PERSPECTIVES = [int(chess.BLACK), int(chess.WHITE)]
+
+PIECE_TYPES = [chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN, chess.KING]
+
+def feature_index(perspective, king_sq, color, piece_type, sq):
+    if perspective == chess.BLACK:
+        king_sq ^= 56
+        sq ^= 56
+    piece_index = piece_type - 1
+    if color != perspective:
+        piece_index += 6
+    return (king_sq * N_PIECE_INDICES + piece_index) * 64 + sq
+
+def active_features(board, perspective):
+    king_sq = board.king(perspective)
+    features = []
+    for color in [chess.BLACK, chess.WHITE]:
+        for piece_type in PIECE_TYPES:
+            for sq in board.pieces(piece_type, color):
+                features.append(feature_index(perspective, king_sq, color, piece_type, sq))
+    return features
+
+# Split integer val into n integer parts that sum exactly to val
+def split_val(val, n):
+    return [val // n + (1 if part < val % n else 0) for part in range(n)]
+
+# A net that computes exactly evaluate.static_eval() (side-to-move relative) as long as no
+#   accumulator value is clipped - a starting point for training and a check of the machinery.
+# In each perspective's accumulator the first half of the neurons carry the own pieces' (positive)
+#   values and the second half the opponent's, each value split across the half. The bias keeps
+#   the neurons clear of the clipping at 0; the output takes own minus opponent from the
+#   side-to-move's perspective only, so the biases cancel.
+def make_pst_weights(piece_vals = evaluate.PIECE_VALS, piece_pos_vals = evaluate.PIECE_POS_VALS, bias = 32):
+    half = HIDDEN_SIZE // 2
+    ft_weights = np.zeros((N_FEATURES, HIDDEN_SIZE), dtype=np.int16)
+    for piece_type in PIECE_TYPES:
+        for sq in range(64):
+            # White's tables are from White's perspective; Black's are the negated mirror image
+            own_parts = split_val(piece_vals[chess.WHITE][piece_type] + piece_pos_vals[chess.WHITE][piece_type][sq], half)
+            opp_parts = split_val(-(piece_vals[chess.BLACK][piece_type] + piece_pos_vals[chess.BLACK][piece_type][sq]), half)
+            for king_sq in range(64):
+                ft_weights[(king_sq * N_PIECE_INDICES + piece_type - 1) * 64 + sq, :half] = own_parts
+                ft_weights[(king_sq * N_PIECE_INDICES + piece_type - 1 + 6) * 64 + sq, half:] = opp_parts
+    ft_bias = np.full(HIDDEN_SIZE, bias, dtype=np.int16)
+    out_weights = np.zeros(2 * HIDDEN_SIZE, dtype=np.int16)
+    out_weights[:half] = 1
+    out_weights[half:HIDDEN_SIZE] = -1
+    return {"ft_weights": ft_weights, "ft_bias": ft_bias, "out_weights": out_weights, "out_bias": np.int32(0), "output_scale": np.int32(1)}
+
+def save_weights(path, weights):
+    np.savez(path, **weights)
+
+def load_weights(path):
+    with np.load(path) as npz:
+        weights = {name: npz[name] for name in npz.files}
+    for name, shape in WEIGHTS_SHAPES.items():
+        if name not in weights or weights[name].shape != shape:
+            raise ValueError("%s: expected %s of shape %s" % (path, name, shape))
+        weights[name] = weights[name].astype(np.int16)
+    for name in ["out_bias", "output_scale"]:
+        if name not in weights:
+            raise ValueError("%s: missing %s" % (path, name))
+        weights[name] = np.int32(weights[name])
+    return weights
+
+class NnueEvaluator:
+    def __init__(self, weights):
+        self.ft_weights = np.ascontiguousarray(weights["ft_weights"], dtype=np.int16)
+        self.ft_bias = np.ascontiguousarray(weights["ft_bias"], dtype=np.int16)
+        out_weights = np.asarray(weights["out_weights"], dtype=np.int32)
+        # output weights lined up with the [BLACK, WHITE] perspective accumulators for each side to move
+        self.out_weights_by_turn = (
+            np.concatenate([out_weights[:HIDDEN_SIZE], out_weights[HIDDEN_SIZE:]]),
+            np.concatenate([out_weights[HIDDEN_SIZE:], out_weights[:HIDDEN_SIZE]]),
+        )
+        self.out_bias = int(weights["out_bias"])
+        self.output_scale = int(weights["output_scale"])
+
+        # accumulator stack - [ply][perspective] - and per ply the perspectives that need a refresh
+        self.accumulators = np.zeros((MAX_STACK, 2, HIDDEN_SIZE), dtype=np.int16)
+        self.dirty = [[False, False] for ply in range(MAX_STACK)]
+        self.ply = 0
+        self.activations = np.zeros(2 * HIDDEN_SIZE, dtype=np.int32)
+
+    def refresh(self, board, perspective):
+        accumulator = self.accumulators[self.ply, perspective]
+        accumulator[:] = self.ft_bias
+        features = active_features(board, perspective)
+        if features:
+            accumulator += self.ft_weights[features].sum(axis=0, dtype=np.int16)
+        self.dirty[self.ply][perspective] = False
+
+    def reset(self, board):
+        self.ply = 0
+        for perspective in PERSPECTIVES:
+            self.refresh(board, perspective)
+
+    # Called before board.push(move)
+    def push(self, board, move):
+        ply = self.ply
+        dirty = self.dirty[ply]
+        for perspective in PERSPECTIVES:
+            if dirty[perspective]:
+                self.refresh(board, perspective)
+        accumulators = self.accumulators
+        src = accumulators[ply]
+        dst = accumulators[ply+1]
+        dst[:] = src
+        self.ply = ply + 1
+        next_dirty = self.dirty[ply+1]
+        next_dirty[0] = False
+        next_dirty[1] = False
+        if not move:
+            # null move
+            return
+
+        color = board.turn
+        from_sq = move.from_square
+        to_sq = move.to_square
+        piece_type = board.piece_type_at(from_sq)
+
+        # (color, piece type, square) of the pieces removed and added by the move
+        removed = [(color, piece_type, from_sq)]
+        added = [(color, move.promotion or piece_type, to_sq)]
+        if piece_type == chess.KING:
+            next_dirty[color] = True
+            if board.is_castling(move):
+                rank_sq = from_sq & 56
+                if chess.square_file(to_sq) == 6:
+                    rook_from_sq, rook_to_sq = rank_sq + 7, rank_sq + 5
+                else:
+                    rook_from_sq, rook_to_sq = rank_sq, rank_sq + 3
+                removed.append((color, chess.ROOK, rook_from_sq))
+                added.append((color, chess.ROOK, rook_to_sq))
+        captured_piece_type = board.piece_type_at(to_sq)
+        if captured_piece_type:
+            removed.append((not color, captured_piece_type, to_sq))
+        elif piece_type == chess.PAWN and to_sq == board.ep_square:
+            removed.append((not color, chess.PAWN, to_sq ^ 8))
+
+        ft_weights = self.ft_weights
+        for perspective in PERSPECTIVES:
+            if next_dirty[perspective]:
+                continue
+            king_sq = board.king(perspective)
+            acc = dst[perspective]
+            for piece_color, piece_type, sq in removed:
+                acc -= ft_weights[feature_index(perspective, king_sq, piece_color, piece_type, sq)]
+            for piece_color, piece_type, sq in added:
+                acc += ft_weights[feature_index(perspective, king_sq, piece_color, piece_type, sq)]
+
+    def pop(self):
+        self.ply -= 1
+
+    # White-relative eval of board - the position after the pushes since the last reset()
+    def evaluate(self, board):
+        dirty = self.dirty[self.ply]
+        for perspective in PERSPECTIVES:
+            if dirty[perspective]:
+                self.refresh(board, perspective)
+        activations = self.activations
+        np.clip(self.accumulators[self.ply].reshape(2 * HIDDEN_SIZE), 0, ACTIVATION_MAX, out=activations)
+        val = (int(np.dot(activations, self.out_weights_by_turn[board.turn])) + self.out_bias) // self.output_scale
+        return val if board.turn else -val
+
+def main():
+    parser = argparse.ArgumentParser(description="Write an NNUE weights file")
+    parser.add_argument("-o", "--output", default="nnue.npz", help="output weights file (.npz)")
+    args = parser.parse_args()
+    save_weights(args.output, make_pst_weights())
+    print("wrote the static_eval()-equivalent net to %s" % args.output)
+
+if __name__ == "__main__":
+    main()
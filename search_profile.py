@@ -0,0 +1,215 @@
+import argparse
+import collections
+import os
+import sys
+import threading
+import time
+
+import chess
+
+import engine
+import move_sort
+
+from bench import BENCH_FENS, config_item
+from util import move_list_to_sans
+
+# Profiling of non-interactive searches
+#
+#   python search_profile.py [-d D] [-t T] [--fen FEN ...] [-c key=value ...] [-o search.folded] [--no-timers]
+#
+# Two views of where a search spends its time, without editing the search code:
+#
+# - Phase timers - the hot-path functions of the search are wrapped (only while profiling) to
+#   count their calls and accumulate their time per phase. The time is exclusive: a phase called
+#   from within another phase - for example eval or move generation inside quiescence - is taken
+#   out of the enclosing phase, so the phases add up to the total search time. Whatever isn't in
+#   any of the phases (board push/pop, the TT, the search control itself) is reported as "search".
+#   The timers have an overhead of their own - about a microsecond per call - which inflates
+#   the total; compare the phases with each other rather than with an unprofiled run.
+#
+# - Stack sampler - a thread that samples the search thread's Python stack every interval and
+#   writes the counts in collapsed-stack format, one "outermost;...;innermost count" line per
+#   distinct stack, as consumed by flamegraph.pl, speedscope, inferno etc.
+#   Samples are only taken when the sampler thread gets the GIL, so the effective rate is bounded
+#   by sys.getswitchinterval() - this is lowered while sampling.
+
+SEARCH_PHASE = "search"
+MOVEGEN_PHASE = "movegen"
+ORDERING_PHASE = "ordering"
+EVAL_PHASE = "eval"
+HASHING_PHASE = "hashing"
+QUIESCENCE_PHASE = "quiescence"
+
+PHASES = [MOVEGEN_PHASE, ORDERING_PHASE, EVAL_PHASE, HASHING_PHASE, QUIESCENCE_PHASE, SEARCH_PHASE]
+
+# (owner, attribute name, phase) of the functions timed - owners are modules and classes whose
+#   attribute is looked up at call time, so replacing it takes effect everywhere
+TIMED_FUNCTIONS = [
+    (move_sort.PositionMoves, "gen_search_moves", MOVEGEN_PHASE),
+    (move_sort.PositionMoves, "gen_qmoves", MOVEGEN_PHASE),
+    (move_sort.PositionMoves, "probe_has_legal_move", MOVEGEN_PHASE),
+    (engine.Engine, "has_legal_move", MOVEGEN_PHASE),
+    # the attack tests and capture lookups of the move sort keys are done by pack_move()
+    (move_sort, "pack_move", ORDERING_PHASE),
+    (move_sort, "packed_move_sort_key", ORDERING_PHASE),
+    (move_sort.PositionMoves, "order_search_moves", ORDERING_PHASE),
+    (engine, "search_move_sort_key", ORDERING_PHASE),
+    (engine.Engine, "static_eval", EVAL_PHASE),
+    (engine.Engine, "leaf_static_eval", EVAL_PHASE),
+    (engine, "fen4", HASHING_PHASE),
+    (engine, "position_key", HASHING_PHASE),
+    (engine.Engine, "quiesce_alphabeta", QUIESCENCE_PHASE),
+]
+
+DEFAULT_SAMPLE_INTERVAL_S = 0.001
+
+class PhaseTimer:
+    def __init__(self):
+        self.phase_time_s = collections.defaultdict(float)
+        self.phase_calls = collections.defaultdict(int)
+        # (phase, function name) -> calls
+        self.function_calls = collections.defaultdict(int)
+        self.stack = [SEARCH_PHASE]
+        self.last_s = 0
+        self.originals = []
+
+    def enter(self, phase, name):
+        now_s = time.perf_counter()
+        self.phase_time_s[self.stack[-1]] += now_s - self.last_s
+        self.last_s = now_s
+        self.stack.append(phase)
+        self.phase_calls[phase] += 1
+        self.function_calls[(phase, name)] += 1
+
+    def exit(self):
+        now_s = time.perf_counter()
+        self.phase_time_s[self.stack.pop()] += now_s - self.last_s
+        self.last_s = now_s
+
+    def timed(self, func, phase, name):
+        def timed_func(*args, **kwargs):
+            self.enter(phase, name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.exit()
+        return timed_func
+
+    def __enter__(self):
+        for owner, name, phase in TIMED_FUNCTIONS:
+            func = getattr(owner, name)
+            self.originals.append((owner, name, func))
+            setattr(owner, name, self.timed(func, phase, name))
+        self.last_s = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.phase_time_s[self.stack[-1]] += time.perf_counter() - self.last_s
+        for owner, name, func in reversed(self.originals):
+            setattr(owner, name, func)
+        self.originals = []
+
+    def report(self, file = sys.stdout):
+        total_s = sum(self.phase_time_s.values())
+        print("%-12s %12s %10s %7s %10s" % ("phase", "calls", "time", "share", "us/call"), file=file)
+        for phase in PHASES:
+            time_s = self.phase_time_s[phase]
+            n_calls = self.phase_calls[phase]
+            print("%-12s %12d %9.3fs %6.1f%% %10s" % (phase, n_calls, time_s, 100*time_s/max(total_s, 1e-9), "%.2f" % (1e6*time_s/n_calls) if n_calls else "-"), file=file)
+            for (function_phase, name), n_function_calls in sorted(self.function_calls.items()):
+                if function_phase == phase:
+                    print("    %-20s %12d calls" % (name, n_function_calls), file=file)
+        print("%-12s %12s %9.3fs" % ("total", "", total_s), file=file)
+
+TIMED_FUNC_CODE = PhaseTimer().timed(None, SEARCH_PHASE, "").__code__
+
+class StackSampler:
+    def __init__(self, interval_s = DEFAULT_SAMPLE_INTERVAL_S, thread_id = None):
+        self.interval_s = interval_s
+        self.thread_id = thread_id if thread_id != None else threading.get_ident()
+        # collapsed stack -> samples
+        self.stacks = collections.Counter()
+        self.n_samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.switch_interval_s = 0
+
+    def frame_name(self, frame):
+        code = frame.f_code
+        return "%s:%s" % (frame.f_globals.get("__name__", os.path.basename(code.co_filename)), code.co_name)
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        names = []
+        while frame != None:
+            # the PhaseTimer wrappers are left out of the stacks
+            if frame.f_code is not TIMED_FUNC_CODE:
+                names.append(self.frame_name(frame))
+            frame = frame.f_back
+        if names:
+            names.reverse()
+            self.stacks[";".join(names)] += 1
+            self.n_samples += 1
+
+    def run(self):
+        while not self.stop_event.wait(self.interval_s):
+            self.sample()
+
+    def __enter__(self):
+        self.switch_interval_s = sys.getswitchinterval()
+        sys.setswitchinterval(min(self.switch_interval_s, self.interval_s))
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop_event.set()
+        self.thread.join()
+        sys.setswitchinterval(self.switch_interval_s)
+
+    def write_collapsed(self, path):
+        with open(path, "w") as output_file:
+            for stack, n_samples in self.stacks.most_common():
+                output_file.write("%s %d\n" % (stack, n_samples))
+
+def search_all(engines, time_limit_s):
+    for search_engine in engines:
+        engine_move, val, pv, stats = search_engine.iterative_deepening(0, time_limit_s)
+        print("%-70s %6d cp %9d nodes %s" % (search_engine.board.fen(), val, search_engine.n_id_nodes, " ".join(move_list_to_sans(search_engine.board, pv))))
+
+# Search each position with the stack sampler and - unless use_timers is False, since they slow
+#   the search down unevenly and so skew the samples - the phase timers
+def profile_searches(fens, config, time_limit_s, collapsed_path, sample_interval_s = DEFAULT_SAMPLE_INTERVAL_S, use_timers = True):
+    engines = [engine.Engine(chess.Board(fen), config) for fen in fens]
+    start_s = time.time()
+    with StackSampler(sample_interval_s) as sampler:
+        if use_timers:
+            with PhaseTimer() as phase_timer:
+                search_all(engines, time_limit_s)
+        else:
+            search_all(engines, time_limit_s)
+    elapsed_s = time.time() - start_s
+    if use_timers:
+        print()
+        phase_timer.report()
+    print()
+    sampler.write_collapsed(collapsed_path)
+    print("%d stack samples (%.0f/s) in %d distinct stacks written to %s" % (sampler.n_samples, sampler.n_samples/max(elapsed_s, 1e-9), len(sampler.stacks), collapsed_path))
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile searches: per-phase time and collapsed stacks for flamegraphs")
+    parser.add_argument("--fen", action="append", default=[], help="position to search - default the bench positions")
+    parser.add_argument("-d", "--depth", type=int, default=4, help="maximum search depth")
+    parser.add_argument("-t", "--time", type=float, default=0, help="hard time limit per position in seconds - 0 for no limit")
+    parser.add_argument("-c", "--config", type=config_item, action="append", default=[], help="engine config override key=value")
+    parser.add_argument("-o", "--output", default="search.folded", help="collapsed stacks output file")
+    parser.add_argument("--interval", type=float, default=DEFAULT_SAMPLE_INTERVAL_S, help="stack sample interval in seconds")
+    parser.add_argument("--no-timers", action="store_true", help="stack samples only - without the phase timers' overhead")
+    args = parser.parse_args()
+
+    config = {engine.MAX_DEPTH_KEY: args.depth, engine.VERBOSE_KEY: False}
+    config.update(args.config)
+    profile_searches(args.fen or BENCH_FENS, config, args.time, args.output, args.interval, not args.no_timers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+import argparse
+import asyncio
+import heapq
+import itertools
+import json
+import multiprocessing
+import sys
+
+import chess
+
+from engine import Engine, VERBOSE_KEY
+from analyse import DEFAULT_MAX_TT_ENTRIES, limit_tables
+
+# Asyncio analysis server over a pool of long-lived Engine worker processes
+#
+# Clients connect over TCP or a Unix socket and exchange JSON objects, one per line.
+#
+# Requests:
+#   {"id": <any>, "op": "analyse", "fen": <fen - default start position>, "moves": [<uci>, ...],
+#    "game": <game key>, "priority": <int - higher first>, "depth": <int>, "nodes": <int>,
+#    "time": <seconds>, "multi_pv": <int>}
+#   {"id": <id of an earlier analyse request>, "op": "cancel"}
+#
+# Responses, tagged with the request id:
+#   {"id": ..., "type": "queued"}
+#   {"id": ..., "type": "info", "depth": ..., "score_cp": ..., "pv": [...], "nodes": ..., "time_s": ...}
+#     - streamed after each completed iteration
+#   {"id": ..., "type": "result", "best_move": ..., <the last info>}
+#   {"id": ..., "type": "cancelled"}
+#   {"id": ..., "type": "error", "error": <message>}
+#
+# Requests carrying the same "game" key go to the worker that last analysed that game when it
+#   is idle, so the worker's search tables are still warm for the related positions.
+
+DEFAULT_DEPTH = 6
+
+# Types of the optional analyse request fields - bools are rejected even though they are ints
+REQUEST_FIELD_TYPES = {"depth": int, "nodes": int, "multi_pv": int, "priority": int, "time": (int, float)}
+
+# Returns the error message for a malformed analyse request, or None if it is well-formed
+def request_error(request):
+    for field, field_type in REQUEST_FIELD_TYPES.items():
+        if field in request:
+            value = request[field]
+            if isinstance(value, bool) or not isinstance(value, field_type):
+                return "bad %s: %r" % (field, value)
+            if value < 0:
+                return "bad %s: %r" % (field, value)
+    for field in ("depth", "multi_pv"):
+        if request.get(field, 1) < 1:
+            return "bad %s: %r" % (field, request[field])
+    moves = request.get("moves", [])
+    if not isinstance(moves, list):
+        return "bad moves: %r" % (moves,)
+    try:
+        board = chess.Board(request.get("fen", chess.STARTING_FEN))
+        for uci in moves:
+            board.push_uci(uci)
+    except (TypeError, ValueError) as e:
+        return "bad position: %s" % e
+    return None
+
+# Worker process side
+
+def worker_main(conn, config, max_tt_entries):
+    engine = Engine(chess.Board(), config)
+    cancelled = []
+
+    def stop_check():
+        while conn.poll():
+            message = conn.recv()
+            if message[0] == "cancel":
+                cancelled.append(message[1])
+        return len(cancelled) != 0
+
+    engine.stop_check = stop_check
+
+    while True:
+        message = conn.recv()
+        if message[0] == "cancel":
+            # the job already finished
+            continue
+        if message[0] == "quit":
+            return
+        op, job_id, request = message
+        cancelled.clear()
+        try:
+            board = chess.Board(request.get("fen", chess.STARTING_FEN))
+            for uci in request.get("moves", []):
+                board.push_uci(uci)
+            if board.is_game_over():
+                conn.send(("error", job_id, "game over: %s" % board.result()))
+                continue
+            engine.set_board(board)
+            engine.MAX_DEPTH = request.get("depth", DEFAULT_DEPTH)
+            engine.MAX_NODES = request.get("nodes", 0)
+            engine.MULTI_PV = request.get("multi_pv", 1)
+            engine.info_callback = lambda info: conn.send(("info", job_id, info))
+            engine_move, val, pv, stats = engine.iterative_deepening(0, request.get("time", 0))
+            if engine_move == None or job_id in cancelled:
+                conn.send(("cancelled", job_id))
+            else:
+                result = {"best_move": engine_move.uci(), "best_move_san": board.san(engine_move)}
+                result.update(engine.iteration_info(engine.id_depth, 0))
+                del result["time_s"]
+                conn.send(("result", job_id, result))
+        except Exception as e:
+            # any failure is the job's - the worker stays up for the next one
+            conn.send(("error", job_id, "%s: %s" % (type(e).__name__, e)))
+        limit_tables(engine, max_tt_entries)
+
+# Server side
+
+class Job:
+    def __init__(self, job_id, client, request):
+        self.job_id = job_id
+        self.client = client
+        self.request_id = request.get("id")
+        self.request = request
+        self.game = request.get("game")
+        self.priority = request.get("priority", 0)
+        self.worker = None
+        self.done = False
+
+class Worker:
+    def __init__(self, conn, process):
+        self.conn = conn
+        self.process = process
+        self.job = None
+        self.game = None
+
+class Client:
+    def __init__(self, writer):
+        self.writer = writer
+        # map: request id -> Job
+        self.jobs = {}
+
+    def send(self, response):
+        if not self.writer.is_closing():
+            self.writer.write((json.dumps(response) + "\n").encode())
+
+class EngineServer:
+    def __init__(self, n_workers, config = {}, max_tt_entries = DEFAULT_MAX_TT_ENTRIES):
+        self.n_workers = n_workers
+        self.config = dict(config)
+        self.config[VERBOSE_KEY] = False
+        self.max_tt_entries = max_tt_entries
+        self.workers = []
+        # heap of (-priority, sequence no, Job) - cancelled jobs are skipped when popped
+        self.queue = []
+        self.job_ids = itertools.count()
+        # map: job id -> Job
+        self.jobs = {}
+
+    def start_worker(self):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=worker_main, args=(child_conn, self.config, self.max_tt_entries), daemon=True)
+        process.start()
+        child_conn.close()
+        worker = Worker(parent_conn, process)
+        self.workers.append(worker)
+        asyncio.get_running_loop().add_reader(parent_conn.fileno(), self.on_worker_message, worker)
+
+    def start_workers(self):
+        for worker_no in range(self.n_workers):
+            self.start_worker()
+
+    def stop_workers(self):
+        loop = asyncio.get_running_loop()
+        for worker in self.workers:
+            loop.remove_reader(worker.conn.fileno())
+            try:
+                worker.conn.send(("quit",))
+            except OSError:
+                # already dead
+                pass
+            worker.process.join(timeout=1)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.conn.close()
+        self.workers = []
+
+    # A worker process died - its job fails and a fresh worker takes its place
+    def replace_worker(self, worker):
+        asyncio.get_running_loop().remove_reader(worker.conn.fileno())
+        worker.conn.close()
+        worker.process.join(timeout=1)
+        print("worker %d died (exit code %s) - restarting it" % (worker.process.pid, worker.process.exitcode), file=sys.stderr)
+        self.workers.remove(worker)
+        job = worker.job
+        worker.job = None
+        if job != None:
+            job.worker = None
+            if not job.done:
+                self.finish(job, {"type": "error", "error": "worker died"})
+        self.start_worker()
+        self.dispatch()
+
+    async def serve(self, host = "127.0.0.1", port = 0, path = None):
+        self.start_workers()
+        if path != None:
+            server = await asyncio.start_unix_server(self.handle_client, path=path)
+        else:
+            server = await asyncio.start_server(self.handle_client, host, port)
+        return server
+
+    async def handle_client(self, reader, writer):
+        client = Client(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    client.send({"type": "error", "error": "bad request: %s" % e})
+                    continue
+                if not isinstance(request, dict) or isinstance(request.get("id"), (list, dict)):
+                    client.send({"type": "error", "error": "bad request: expected an object with a scalar id"})
+                    continue
+                self.handle_request(client, request)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            for job in list(client.jobs.values()):
+                self.cancel(job)
+            writer.close()
+
+    def handle_request(self, client, request):
+        op = request.get("op")
+        request_id = request.get("id")
+        if op == "analyse":
+            if request_id in client.jobs:
+                client.send({"id": request_id, "type": "error", "error": "duplicate request id"})
+                return
+            error = request_error(request)
+            if error != None:
+                client.send({"id": request_id, "type": "error", "error": error})
+                return
+            job = Job(next(self.job_ids), client, request)
+            client.jobs[request_id] = job
+            self.jobs[job.job_id] = job
+            heapq.heappush(self.queue, (-job.priority, job.job_id, job))
+            client.send({"id": request_id, "type": "queued"})
+            self.dispatch()
+        elif op == "cancel":
+            job = client.jobs.get(request_id)
+            if job == None:
+                client.send({"id": request_id, "type": "error", "error": "unknown request id"})
+            else:
+                self.cancel(job)
+        else:
+            client.send({"id": request_id, "type": "error", "error": "unknown op %r" % op})
+
+    def cancel(self, job):
+        if job.done:
+            return
+        if job.worker != None:
+            # the worker replies "cancelled" once its search has stopped - or dies, which fails the job
+            try:
+                job.worker.conn.send(("cancel", job.job_id))
+            except OSError:
+                pass
+        else:
+            self.finish(job, {"type": "cancelled"})
+
+    def finish(self, job, response):
+        job.done = True
+        response["id"] = job.request_id
+        job.client.send(response)
+        job.client.jobs.pop(job.request_id, None)
+        self.jobs.pop(job.job_id, None)
+
+    def idle_worker_for(self, job):
+        idle_workers = [worker for worker in self.workers if worker.job == None]
+        if not idle_workers:
+            return None
+        for worker in idle_workers:
+            if job.game != None and worker.game == job.game:
+                return worker
+        # prefer a worker whose tables don't belong to a game
+        for worker in idle_workers:
+            if worker.game == None:
+                return worker
+        return idle_workers[0]
+
+    def dispatch(self):
+        while self.queue:
+            job = self.queue[0][2]
+            if job.done:
+                heapq.heappop(self.queue)
+                continue
+            worker = self.idle_worker_for(job)
+            if worker == None:
+                return
+            heapq.heappop(self.queue)
+            job.worker = worker
+            worker.job = job
+            worker.game = job.game
+            try:
+                worker.conn.send(("analyse", job.job_id, job.request))
+            except OSError:
+                # the worker died - the EOF on its pipe fails the job and replaces the worker
+                pass
+
+    def on_worker_message(self, worker):
+        try:
+            message = worker.conn.recv()
+        except (EOFError, OSError):
+            self.replace_worker(worker)
+            return
+        kind, job_id = message[0], message[1]
+        job = self.jobs.get(job_id)
+        if kind == "info":
+            if job != None and not job.done:
+                response = {"id": job.request_id, "type": "info"}
+                response.update(message[2])
+                job.client.send(response)
+            return
+
+        # the job is over - free the worker
+        worker.job = None
+        if job != None:
+            job.worker = None
+            if kind == "result":
+                response = {"type": "result"}
+                response.update(message[2])
+                self.finish(job, response)
+            elif kind == "cancelled":
+                self.finish(job, {"type": "cancelled"})
+            else:
+                self.finish(job, {"type": "error", "error": message[2]})
+        self.dispatch()
+
+# Client helper - yields the responses to an analyse request until its result/cancellation/error
+async def analyse_remote(reader, writer, request):
+    writer.write((json.dumps(request) + "\n").encode())
+    await writer.drain()
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        response = json.loads(line)
+        if response.get("id") != request.get("id"):
+            continue
+        yield response
+        if response["type"] in ("result", "cancelled", "error"):
+            return
+
+async def serve_forever(args):
+    engine_server = EngineServer(args.workers)
+    server = await engine_server.serve(args.host, args.port, args.unix)
+    for sock in server.sockets:
+        print("serving on %s" % (sock.getsockname(),), file=sys.stderr)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        engine_server.stop_workers()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve engine analyses over a JSON-lines socket protocol")
+    parser.add_argument("-j", "--workers", type=int, default=multiprocessing.cpu_count(), help="number of engine worker processes")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7777)
+    parser.add_argument("--unix", default=None, help="listen on this Unix socket path instead of TCP")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve_forever(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
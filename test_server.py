@@ -0,0 +1,97 @@
+import asyncio
+import json
+
+import server
+
+# Localhost tests of the analysis server - python -m pytest test_server.py
+
+TIMEOUT_S = 60
+
+async def run_with_server(test, n_workers = 1):
+    engine_server = server.EngineServer(n_workers)
+    tcp_server = await engine_server.serve("127.0.0.1", 0)
+    port = tcp_server.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        await asyncio.wait_for(test(engine_server, reader, writer), TIMEOUT_S)
+    finally:
+        writer.close()
+        tcp_server.close()
+        await tcp_server.wait_closed()
+        engine_server.stop_workers()
+
+async def send(writer, request):
+    writer.write((json.dumps(request) + "\n").encode())
+    await writer.drain()
+
+# The responses to request id up to its result/cancellation/error
+async def responses_until_done(reader, request_id):
+    responses = []
+    while True:
+        response = json.loads(await reader.readline())
+        if response.get("id") != request_id:
+            continue
+        responses.append(response)
+        if response["type"] in ("result", "cancelled", "error"):
+            return responses
+
+def test_analyse():
+    async def test(engine_server, reader, writer):
+        await send(writer, {"id": 1, "op": "analyse", "depth": 2})
+        responses = await responses_until_done(reader, 1)
+        assert responses[0]["type"] == "queued"
+        assert [response["depth"] for response in responses if response["type"] == "info"] == [1, 2]
+        assert responses[-1]["type"] == "result"
+        assert responses[-1]["depth"] == 2
+        assert responses[-1]["best_move"] == responses[-1]["pv"][0]
+    asyncio.run(run_with_server(test))
+
+def test_cancel():
+    async def test(engine_server, reader, writer):
+        await send(writer, {"id": "deep", "op": "analyse", "depth": 30})
+        while json.loads(await reader.readline())["type"] != "info":
+            pass
+        await send(writer, {"id": "deep", "op": "cancel"})
+        responses = await responses_until_done(reader, "deep")
+        assert responses[-1]["type"] == "cancelled"
+    asyncio.run(run_with_server(test))
+
+def test_malformed_requests():
+    async def test(engine_server, reader, writer):
+        bad_requests = [
+            {"id": 1, "op": "analyse", "depth": "3"},
+            {"id": 2, "op": "analyse", "time": "1"},
+            {"id": 3, "op": "analyse", "multi_pv": 0},
+            {"id": 4, "op": "analyse", "fen": "not a fen"},
+            {"id": 5, "op": "analyse", "moves": ["e2e5"]},
+            {"id": 6, "op": "analyse", "priority": None},
+            {"id": 8, "op": "analyse", "depth": 0},
+        ]
+        for request in bad_requests:
+            await send(writer, request)
+            responses = await responses_until_done(reader, request["id"])
+            assert [response["type"] for response in responses] == ["error"]
+        await send(writer, [1, 2])
+        assert json.loads(await reader.readline())["type"] == "error"
+        # the worker is still there
+        await send(writer, {"id": 7, "op": "analyse", "depth": 1})
+        responses = await responses_until_done(reader, 7)
+        assert responses[-1]["type"] == "result"
+    asyncio.run(run_with_server(test))
+
+def test_worker_death():
+    async def test(engine_server, reader, writer):
+        await send(writer, {"id": 1, "op": "analyse", "depth": 30})
+        while json.loads(await reader.readline())["type"] != "info":
+            pass
+        dead_worker = engine_server.workers[0]
+        dead_worker.process.kill()
+        responses = await responses_until_done(reader, 1)
+        assert responses[-1]["type"] == "error"
+        assert dead_worker not in engine_server.workers
+        assert len(engine_server.workers) == 1
+        # the replacement worker takes the next job
+        await send(writer, {"id": 2, "op": "analyse", "depth": 1})
+        responses = await responses_until_done(reader, 2)
+        assert responses[-1]["type"] == "result"
+    asyncio.run(run_with_server(test))
@@ -1,7 +1,116 @@
 import evaluate
 
+# Quiescence TT entry - bounds are absolute values for the (position, static val) key
 class TTEntry:
-    def __init__(self, lb_delta = -evaluate.Q_INFINITY_VAL, ub_delta = evaluate.Q_INFINITY_VAL, move = None):
-        self.lb_delta = lb_delta
-        self.ub_delta = ub_delta
+    __slots__ = ("lb", "ub", "move")
+
+    def __init__(self, lb = -evaluate.Q_INFINITY_VAL, ub = evaluate.Q_INFINITY_VAL, move = None):
+        self.lb = lb
+        self.ub = ub
         self.move = move
+
+# Rough memory cost of one quiescence TT entry: the hashed key int, the TTEntry, the dict slot
+#   and the clock slots
+QTT_ENTRY_BYTES = 250
+
+# Fixed capacity map with CLOCK (second chance) eviction
+# Capacity is derived from a byte budget; a hit marks the entry as referenced and the clock hand
+#   evicts the first unreferenced entry it finds, clearing reference bits as it goes.
+class ClockCache:
+    def __init__(self, max_bytes, entry_bytes = QTT_ENTRY_BYTES):
+        self.capacity = max(1, max_bytes // entry_bytes)
+        # map: key -> slot
+        self.slots = {}
+        self.keys = [None] * self.capacity
+        self.values = [None] * self.capacity
+        self.referenced = bytearray(self.capacity)
+        self.hand = 0
+        self.n_used = 0
+
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_evictions = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def get(self, key):
+        slot = self.slots.get(key)
+        if slot is None:
+            self.n_misses += 1
+            return None
+        self.n_hits += 1
+        self.referenced[slot] = 1
+        return self.values[slot]
+
+    # get() without counting or marking the entry referenced
+    def peek(self, key):
+        slot = self.slots.get(key)
+        if slot is None:
+            return None
+        return self.values[slot]
+
+    def put(self, key, value):
+        slot = self.slots.get(key)
+        if slot is not None:
+            self.values[slot] = value
+            self.referenced[slot] = 1
+            return
+
+        if self.n_used < self.capacity:
+            slot = self.n_used
+            self.n_used += 1
+        else:
+            referenced = self.referenced
+            hand = self.hand
+            while referenced[hand]:
+                referenced[hand] = 0
+                hand += 1
+                if hand == self.capacity:
+                    hand = 0
+            slot = hand
+            self.hand = hand + 1 if hand + 1 < self.capacity else 0
+            del self.slots[self.keys[slot]]
+            self.n_evictions += 1
+
+        self.keys[slot] = key
+        self.values[slot] = value
+        self.referenced[slot] = 0
+        self.slots[key] = slot
+
+    def clear(self):
+        self.slots.clear()
+        for slot in range(self.n_used):
+            self.keys[slot] = None
+            self.values[slot] = None
+            self.referenced[slot] = 0
+        self.hand = 0
+        self.n_used = 0
+
+# Fixed-size, direct-mapped cache of static evals keyed by position hash
+# The slot is the low bits of the key; a colliding position simply overwrites the slot, and the
+#   full key is kept to tell positions sharing a slot apart.
+class EvalCache:
+    def __init__(self, n_entries):
+        # round down to a power of two so the slot is a mask of the key
+        n_slots = 1
+        while n_slots * 2 <= n_entries:
+            n_slots *= 2
+        self.mask = n_slots - 1
+        self.keys = [None] * n_slots
+        self.vals = [0] * n_slots
+
+    def get(self, key):
+        slot = key & self.mask
+        if self.keys[slot] == key:
+            return self.vals[slot]
+        return None
+
+    def put(self, key, val):
+        slot = key & self.mask
+        self.keys[slot] = key
+        self.vals[slot] = val
+
+    def clear(self):
+        for slot in range(len(self.keys)):
+            self.keys[slot] = None
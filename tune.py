@@ -0,0 +1,310 @@
+import argparse
+import math
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+import chess
+
+import evaluate
+import batch_eval
+import datagen
+
+from engine import Engine, SearchStats, VERBOSE_KEY
+from move_sort import search_move_sort_key, static_move_val_delta
+
+# Texel-style tuning of PIECE_VALS and PIECE_POS_VALS
+#
+# 1. Labeled positions (FEN/EPD + game result) are resolved to quiet leaves by following the
+#      quiescence search from each position. Leaves are cached as packed bitboards next to the
+#      input, so later runs (and every epoch) reuse them.
+#    datagen.py record files (.bin) hold quiet positions already and are read as they are.
+# 2. Each leaf is reduced to the (up to 32) occupied plane*64+square feature indices.
+# 3. Full-batch gradient descent (Adam) on the mean squared error between the game result and
+#      sigmoid(eval), where the eval is the sum of the table entries of the leaf's pieces.
+#
+# Parameters are White's material and piece-pos values; Black's are the negated vertical
+#   mirror, as in the Sunfish tables produced by make-piece-pos.py.
+
+RESULTS = {"1-0": 1.0, "0-1": 0.0, "1/2-1/2": 0.5}
+
+# Feature index of an empty slot - its weight is always 0
+PAD_FEATURE = batch_eval.N_FEATURES
+
+MAX_PIECES = 32
+
+# Positions are featurized/evaluated in chunks of this many to bound temporary memory
+CHUNK_SIZE = 1 << 18
+
+# Parse "<fen> <result>", "<fen> [<result>]", "<fen> | <result>" or an EPD with a c9 result opcode
+#   - returns (board, White-relative result in [0, 1]) or None
+def parse_labeled_line(line):
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    if "c9" in line:
+        board, ops = chess.Board.from_epd(line)
+        return board, RESULTS[ops["c9"]]
+    fen, _, result = line.rpartition(" ")
+    fen = fen.rstrip(" |;")
+    result = result.strip("[]\"")
+    if result in RESULTS:
+        return chess.Board(fen), RESULTS[result]
+    return chess.Board(fen), float(result)
+
+# Per-process engine for quiescence resolution, created by init_worker()
+worker_engine = None
+
+def init_worker():
+    global worker_engine
+    worker_engine = Engine(chess.Board(), {VERBOSE_KEY: False})
+
+def side_relative_static_eval(board):
+    return evaluate.static_eval(board) * [-1, 1][board.turn]
+
+# Follow the quiescence search from the board until stand-pat is best; returns the quiet leaf
+#   or None for positions in check, which have no meaningful static eval
+# The best capture at each step is the first one whose null-window search at the quiesced value
+#   succeeds - children get the same incremental val as in quiesce_alphabeta() so the values agree.
+def quiet_leaf(engine, board):
+    engine.board = board
+    stats = SearchStats(1, engine.MAX_QDEPTH)
+    for qdepth in range(engine.MAX_QDEPTH):
+        if board.is_check():
+            return None
+        val = side_relative_static_eval(board)
+        qval = engine.quiesce_alphabeta(stats, 0, val)
+        if qval <= val:
+            return board
+        qmoves = [move for move in board.legal_moves if board.is_capture(move) or move.promotion != None]
+        qmoves.sort(key=lambda move: search_move_sort_key(board, move), reverse=True)
+        best_move = None
+        for move in qmoves:
+            static_move_val = val + static_move_val_delta(board, move)
+            board.push(move)
+            move_eval = -engine.quiesce_alphabeta(stats, 1, -static_move_val, -qval, -(qval-1))
+            board.pop()
+            if qval <= move_eval:
+                best_move = move
+                break
+        if best_move is None:
+            return board
+        board.push(best_move)
+    return board
+
+def resolve_line(line):
+    labeled = parse_labeled_line(line)
+    if labeled is None:
+        return None
+    board, result = labeled
+    leaf = quiet_leaf(worker_engine, board)
+    if leaf is None:
+        return None
+    return batch_eval.boards_to_bitboards([leaf], 1)[0], result
+
+# Quiet leaf bitboards (N, 12) and White-relative results (N,) for a labeled position file
+def load_leaves(path, n_workers, cache_path = None):
+    if path.endswith(".bin"):
+        records = datagen.read_records(path)
+        return datagen.records_to_bitboards(records), (records["result"].astype(np.float32) + 1) / 2
+    if cache_path is None:
+        cache_path = path + ".leaves.npz"
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        cached = np.load(cache_path)
+        return cached["bitboards"], cached["results"]
+
+    start_s = time.time()
+    bitboards = []
+    results = []
+    with open(path) as input_file, multiprocessing.Pool(n_workers, initializer=init_worker) as pool:
+        for resolved in pool.imap(resolve_line, input_file, chunksize=256):
+            if resolved is not None:
+                bitboards.append(resolved[0])
+                results.append(resolved[1])
+    bitboards = np.array(bitboards, dtype=np.uint64).reshape(-1, batch_eval.N_PLANES)
+    results = np.array(results, dtype=np.float32)
+    print("resolved %d quiet leaves in %.3fs" % (len(results), time.time() - start_s), file=sys.stderr)
+    np.savez(cache_path, bitboards=bitboards, results=results)
+    return bitboards, results
+
+# (N, 32) int16 feature indices (plane*64 + square) of the pieces of each position, padded with PAD_FEATURE
+def bitboards_to_features(bitboards):
+    n = bitboards.shape[0]
+    features = np.full((n, MAX_PIECES), PAD_FEATURE, dtype=np.int16)
+    for start in range(0, n, CHUNK_SIZE):
+        end = min(start + CHUNK_SIZE, n)
+        occupancy = batch_eval.bitboards_to_occupancy(bitboards[start:end]).reshape(end - start, batch_eval.N_FEATURES)
+        rows, cols = np.nonzero(occupancy)
+        row_starts = np.searchsorted(rows, np.arange(end - start))
+        slots = np.arange(len(rows)) - row_starts[rows]
+        features[start + rows, slots] = cols
+    return features
+
+# Parameters are (material[6], piece_pos[6, 64]) for White - expand to a per-feature weight
+#   vector in batch_eval plane order, plus the zero pad weight
+def params_to_weights(material, piece_pos):
+    white = material[:, None] + piece_pos
+    black = -(material[:, None] + piece_pos.reshape(6, 8, 8)[:, ::-1, :].reshape(6, 64))
+    return np.concatenate([black.reshape(-1), white.reshape(-1), [0.0]]).astype(np.float32)
+
+# Chain rule from per-feature weight gradients back to (material, piece_pos) gradients
+def weights_grad_to_params_grad(weights_grad):
+    black = weights_grad[:6*64].reshape(6, 8, 8)[:, ::-1, :].reshape(6, 64)
+    white = weights_grad[6*64:12*64].reshape(6, 64)
+    piece_pos_grad = white - black
+    return piece_pos_grad.sum(axis=1), piece_pos_grad
+
+def evals(features, weights):
+    vals = np.empty(features.shape[0], dtype=np.float32)
+    for start in range(0, features.shape[0], CHUNK_SIZE):
+        vals[start:start + CHUNK_SIZE] = weights[features[start:start + CHUNK_SIZE]].sum(axis=1)
+    return vals
+
+def sigmoid(vals, k):
+    return 1.0 / (1.0 + np.power(10.0, -k * vals / 400.0))
+
+def loss(vals, results, k):
+    return float(np.mean((results - sigmoid(vals, k)) ** 2))
+
+# Scaling constant K minimizing the loss for the current tables - golden section search
+def fit_k(vals, results, lo = 0.1, hi = 4.0, n_iters = 40):
+    ratio = (math.sqrt(5) - 1) / 2
+    for _ in range(n_iters):
+        k1 = hi - ratio * (hi - lo)
+        k2 = lo + ratio * (hi - lo)
+        if loss(vals, results, k1) < loss(vals, results, k2):
+            hi = k2
+        else:
+            lo = k1
+    return (lo + hi) / 2
+
+# d(loss)/d(weights) - bincount scatters the per-position gradient onto each position's features
+def weights_grad(features, vals, results, k):
+    s = sigmoid(vals, k)
+    position_grads = (-2.0 / len(results)) * (results - s) * s * (1.0 - s) * (math.log(10.0) * k / 400.0)
+    grad = np.zeros(batch_eval.N_FEATURES + 1, dtype=np.float64)
+    for start in range(0, features.shape[0], CHUNK_SIZE):
+        chunk = features[start:start + CHUNK_SIZE]
+        grad += np.bincount(chunk.reshape(-1).astype(np.intp), weights=np.repeat(position_grads[start:start + CHUNK_SIZE], MAX_PIECES), minlength=batch_eval.N_FEATURES + 1)
+    return grad
+
+def initial_params():
+    material = np.array([evaluate.PIECE_VALS[chess.WHITE][piece_type] for piece_type in batch_eval.PIECE_TYPES], dtype=np.float64)
+    piece_pos = np.array([evaluate.PIECE_POS_VALS[chess.WHITE][piece_type] for piece_type in batch_eval.PIECE_TYPES], dtype=np.float64)
+    return material, piece_pos
+
+# Material of the king cancels out, and pawns never stand on the first or last rank
+def grad_masks():
+    material_mask = np.ones(6)
+    material_mask[chess.KING - 1] = 0
+    piece_pos_mask = np.ones((6, 64))
+    piece_pos_mask[chess.PAWN - 1, :8] = 0
+    piece_pos_mask[chess.PAWN - 1, 56:] = 0
+    return material_mask, piece_pos_mask
+
+def tune(features, results, material, piece_pos, n_epochs, learning_rate = 1.0, k = None, progress_file = sys.stderr):
+    if k is None:
+        k = fit_k(evals(features, params_to_weights(material, piece_pos)), results)
+    material_mask, piece_pos_mask = grad_masks()
+    params = [material, piece_pos]
+    masks = [material_mask, piece_pos_mask]
+    moments = [(np.zeros_like(p), np.zeros_like(p)) for p in params]
+    beta1, beta2, eps = 0.9, 0.999, 1e-8
+
+    for epoch in range(1, n_epochs + 1):
+        epoch_start_s = time.time()
+        vals = evals(features, params_to_weights(material, piece_pos))
+        grads = weights_grad_to_params_grad(weights_grad(features, vals, results, k))
+        for param, grad, mask, (m, v) in zip(params, grads, masks, moments):
+            grad = grad * mask
+            m *= beta1
+            m += (1 - beta1) * grad
+            v *= beta2
+            v += (1 - beta2) * grad * grad
+            m_hat = m / (1 - beta1 ** epoch)
+            v_hat = v / (1 - beta2 ** epoch)
+            param -= learning_rate * m_hat / (np.sqrt(v_hat) + eps)
+        if progress_file is not None:
+            print("epoch %d loss %.6f k %.4f %.3fs" % (epoch, loss(vals, results, k), k, time.time() - epoch_start_s), file=progress_file)
+
+    return material, piece_pos, k
+
+# Move the mean of each piece-pos table into the material value (pawns over the squares they can occupy)
+def normalize_params(material, piece_pos):
+    for piece_type in [chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN]:
+        table = piece_pos[piece_type - 1]
+        squares = slice(8, 56) if piece_type == chess.PAWN else slice(0, 64)
+        mean = table[squares].mean()
+        table[squares] -= mean
+        material[piece_type - 1] += mean
+    return material, piece_pos
+
+# Same layout as make-piece-pos.py - one row of 8 squares per line, starting from a1
+def dump_table(table, out):
+    for rank in range(8):
+        out.write("        (" if rank == 0 else "         ")
+        for file_ in range(8):
+            out.write("%4d" % table[8*rank + file_])
+            out.write("),\n" if rank == 7 and file_ == 7 else ",")
+        if rank != 7:
+            out.write("\n")
+
+def dump_params(material, piece_pos, out):
+    material = np.rint(material).astype(int)
+    piece_pos = np.rint(piece_pos).astype(int)
+    names = ["PAWN", "KNIGHT", "BISHOP", "ROOK", "QUEEN", "KING"]
+
+    out.write("PIECE_VALS = (\n")
+    for color, color_name, sign in [(chess.BLACK, "BLACK", -1), (chess.WHITE, "WHITE", 1)]:
+        out.write("    # %s\n" % color_name)
+        out.write("    (\n")
+        out.write("        0, # nothing\n")
+        for piece_type in batch_eval.PIECE_TYPES:
+            out.write("        %d, # %s\n" % (sign * material[piece_type - 1], names[piece_type - 1]))
+        out.write("    ),\n" if color == chess.BLACK else "    )\n")
+    out.write(")\n\n")
+
+    out.write("PIECE_POS_VALS = (\n")
+    for color, color_name in [(chess.BLACK, "BLACK"), (chess.WHITE, "WHITE")]:
+        out.write("    # %s\n" % color_name)
+        out.write("    (\n")
+        out.write("        # nothing\n")
+        out.write("        (),\n")
+        for piece_type in batch_eval.PIECE_TYPES:
+            table = piece_pos[piece_type - 1]
+            if color == chess.BLACK:
+                table = [-table[sq ^ 56] for sq in range(64)]
+            out.write("        # %s\n" % names[piece_type - 1])
+            dump_table(table, out)
+        out.write("    ),\n" if color == chess.BLACK else "    )\n")
+    out.write(")\n")
+
+def main():
+    parser = argparse.ArgumentParser(description="Texel-tune PIECE_VALS and PIECE_POS_VALS from result-labeled positions")
+    parser.add_argument("input", help="labeled positions - '<fen> <result>' lines, EPD with a c9 result or datagen.py records (.bin)")
+    parser.add_argument("-o", "--output", default="-", help="output file for the tuned tables - '-' for stdout")
+    parser.add_argument("-j", "--workers", type=int, default=multiprocessing.cpu_count(), help="processes for quiescence resolution")
+    parser.add_argument("-e", "--epochs", type=int, default=200)
+    parser.add_argument("-l", "--learning-rate", type=float, default=1.0)
+    parser.add_argument("-k", type=float, default=None, help="sigmoid scaling constant - fitted to the initial tables by default")
+    parser.add_argument("--cache", default=None, help="quiet leaf cache file - defaults to <input>.leaves.npz")
+    args = parser.parse_args()
+
+    bitboards, results = load_leaves(args.input, args.workers, args.cache)
+    features = bitboards_to_features(bitboards)
+    material, piece_pos = initial_params()
+    material, piece_pos, k = tune(features, results, material, piece_pos, args.epochs, args.learning_rate, args.k)
+    material, piece_pos = normalize_params(material, piece_pos)
+
+    output_file = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        dump_params(material, piece_pos, output_file)
+    finally:
+        if output_file is not sys.stdout:
+            output_file.close()
+
+if __name__ == "__main__":
+    main()